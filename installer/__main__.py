@@ -1,13 +1,23 @@
 """NixOS Flake Installer — entry point.
 
-Usage: sudo python3 -m installer [--dry-run]
+Usage: sudo python3 -m installer [--dry-run] [--resume] [--substituter URL ...]
+       sudo python3 -m installer --config install.toml
+       sudo python3 -m installer --host NAME --disk DEV [--disk2 DEV] [--encrypt] [--password-file FILE]
+       sudo python3 -m installer --fleet fleet.toml
+       sudo python3 -m installer bundle HOST [HOST ...]
+       sudo python3 -m installer image build HOST IMAGE [--size 48G] [--encrypt] [--compress]
+       sudo python3 -m installer image write IMAGE DEV [DEV ...] [--password-file FILE]
 """
 
 from __future__ import annotations
 
 import argparse
+import sys
+from pathlib import Path
 
-from .app import InstallerApp
+# Everything beyond argument parsing is imported once the mode is known,
+# so --help and the unattended path never load Textual
+from .exceptions import InstallerError
 
 
 def main() -> None:
@@ -17,8 +27,209 @@ def main() -> None:
         action="store_true",
         help="Show what would happen without making changes",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a failed install from its first incomplete step",
+    )
+    parser.add_argument(
+        "--substituter",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="Extra binary cache to probe and use (file://, http(s)://, ssh://); repeatable",
+    )
+    parser.add_argument(
+        "--trusted-public-key",
+        action="append",
+        default=[],
+        metavar="KEY",
+        help="Signing key of an extra binary cache; repeatable",
+    )
+    parser.add_argument(
+        "--nix-option",
+        action="append",
+        nargs=2,
+        default=[],
+        metavar=("NAME", "VALUE"),
+        help="Set a nix option for every nix invocation, overriding the installer's tuning; repeatable",
+    )
+    parser.add_argument(
+        "--benchmark-disks",
+        action="store_true",
+        help="Run a short read-only speed test and SMART check on each disk",
+    )
+    unattended = parser.add_argument_group(
+        "unattended install",
+        "Install without the TUI; --config and/or --host/--disk select this mode. "
+        "Flags override values from the config file.",
+    )
+    unattended.add_argument("--config", type=Path, metavar="FILE", help="TOML file with the install settings")
+    unattended.add_argument("--host", metavar="NAME", help="Host configuration to install")
+    unattended.add_argument("--disk", metavar="DEV", help="Target disk")
+    unattended.add_argument("--disk2", metavar="DEV", help="Second disk for a RAID0 layout")
+    unattended.add_argument(
+        "--encrypt",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Encrypt the target with LUKS",
+    )
+    unattended.add_argument(
+        "--update-flake",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Run nix flake update before installing",
+    )
+    unattended.add_argument(
+        "--refresh",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Reinstall over an existing install of the same layout, keeping /nix and /home",
+    )
+    unattended.add_argument(
+        "--password-file",
+        metavar="FILE",
+        help="File holding the user (and LUKS) password; defaults to $NIXOS_INSTALL_PASSWORD",
+    )
+    parser.add_argument(
+        "--fleet",
+        type=Path,
+        metavar="FILE",
+        help="Install every [[target]] in a TOML fleet file concurrently; "
+        "shows a per-target view on a terminal and plain lines otherwise",
+    )
+    commands = parser.add_subparsers(dest="command")
+    bundle_parser = commands.add_parser(
+        "bundle",
+        help="Export host closures to ./bundle for offline installs",
+    )
+    bundle_parser.add_argument("hosts", nargs="+", metavar="HOST")
+    image_parser = commands.add_parser(
+        "image",
+        help="Build a golden disk image once, or write one to many disks",
+    )
+    image_commands = image_parser.add_subparsers(dest="image_command", required=True)
+    build_parser = image_commands.add_parser("build", help="Install a host into a sparse image file")
+    build_parser.add_argument("image_host", metavar="HOST")
+    build_parser.add_argument("image", type=Path, metavar="IMAGE")
+    build_parser.add_argument("--size", default="48G", help="Image size (default: %(default)s)")
+    build_parser.add_argument("--encrypt", dest="image_encrypt", action="store_true", help="Encrypt the image with LUKS")
+    build_parser.add_argument("--compress", action="store_true", help="zstd-compress the finished image")
+    write_parser = image_commands.add_parser(
+        "write",
+        help="Write an image to disks (or loop devices), then set each one's password and hardware config",
+    )
+    write_parser.add_argument("image", type=Path, metavar="IMAGE")
+    write_parser.add_argument("devices", nargs="+", metavar="DEV")
+    write_parser.add_argument(
+        "--password-file",
+        dest="image_password_file",
+        metavar="FILE",
+        help="File holding each disk's user (and LUKS) password; defaults to $NIXOS_INSTALL_PASSWORD",
+    )
+    write_parser.add_argument(
+        "--no-reencrypt",
+        dest="reencrypt",
+        action="store_false",
+        help="Only replace the LUKS passphrase, keeping the volume key all copies share",
+    )
     args = parser.parse_args()
-    InstallerApp(dry_run=args.dry_run).run()
+
+    from .nixsettings import nix_settings
+    from .runner import install_handlers
+
+    install_handlers()
+    for name, value in args.nix_option:
+        nix_settings.override(name, value)
+
+    if args.command == "bundle":
+        from .bundle import export_bundle
+
+        try:
+            for line in export_bundle(args.hosts, args.dry_run):
+                print(line, flush=True)
+        except InstallerError as e:
+            print(f"error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    from .bundle import find_bundle
+
+    substituters = list(args.substituter)
+    trusted_public_keys = list(args.trusted_public_key)
+    try:
+        bundle = find_bundle()
+    except InstallerError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if bundle is not None:
+        substituters.insert(0, bundle.url)
+        if bundle.public_key:
+            trusted_public_keys.append(bundle.public_key)
+
+    if args.command == "image":
+        from .headless import run_image_build, run_image_write
+        from .image import parse_size
+
+        if args.image_command == "build":
+            try:
+                size = parse_size(args.size)
+            except InstallerError as e:
+                print(f"error: {e}", file=sys.stderr)
+                sys.exit(1)
+            sys.exit(run_image_build(
+                args.image_host, args.image, size, args.image_encrypt, args.compress, args.dry_run,
+                substituters, trusted_public_keys,
+            ))
+        sys.exit(run_image_write(
+            args.image, args.devices, {"password_file": args.image_password_file}, args.reencrypt, args.dry_run,
+            substituters, trusted_public_keys,
+        ))
+
+    fleet = None
+    if args.fleet is not None:
+        from .fleet import load_fleet_file
+
+        try:
+            fleet = load_fleet_file(args.fleet)
+        except InstallerError as e:
+            print(f"error: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not sys.stdout.isatty():
+            from .fleet import run_fleet_plain
+
+            sys.exit(run_fleet_plain(fleet, args.dry_run, args.resume, substituters, trusted_public_keys))
+
+    flags = {
+        "host": args.host,
+        "disk": args.disk,
+        "disk2": args.disk2,
+        "encrypt": args.encrypt,
+        "update_flake": args.update_flake,
+        "refresh": args.refresh,
+        "password_file": args.password_file,
+    }
+    if fleet is None and (args.config is not None or args.host or args.disk):
+        from .headless import load_config_file, run_headless
+
+        try:
+            options = load_config_file(args.config) if args.config is not None else {}
+        except InstallerError as e:
+            print(f"error: {e}", file=sys.stderr)
+            sys.exit(1)
+        options.update({key: value for key, value in flags.items() if value is not None})
+        sys.exit(run_headless(options, args.dry_run, args.resume, substituters, trusted_public_keys))
+
+    from .app import InstallerApp
+
+    InstallerApp(
+        dry_run=args.dry_run,
+        resume=args.resume,
+        substituters=substituters,
+        trusted_public_keys=trusted_public_keys,
+        benchmark_disks=args.benchmark_disks,
+        fleet=fleet,
+    ).run()
 
 
 if __name__ == "__main__":
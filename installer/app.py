@@ -2,51 +2,114 @@
 
 from __future__ import annotations
 
+from typing import TYPE_CHECKING
+
 from textual.app import App
 
 from .models import InstallConfig, PreflightResult
-from .screens import CompletionScreen, InstallScreen, PreflightScreen, WizardScreen
+from .nixlog import NixProgress
+
+if TYPE_CHECKING:
+    from .fleet import FleetSpec
+    from .prefetch import ClosurePrefetch
 
 
 class InstallerApp(App[None]):
+    """Pushes preflight, wizard, install and completion screens in turn.
+
+    Given a fleet spec, the fleet screen replaces everything after preflight.
+
+    Screens and the modules behind them are imported when they are first
+    needed, so the preflight screen is up before the rest has loaded.
+    """
+
     CSS_PATH = "installer.tcss"
     TITLE = "NixOS Flake Installer"
 
-    def __init__(self, dry_run: bool) -> None:
+    def __init__(
+        self,
+        dry_run: bool,
+        resume: bool = False,
+        substituters: list[str] | None = None,
+        trusted_public_keys: list[str] | None = None,
+        benchmark_disks: bool = False,
+        fleet: FleetSpec | None = None,
+    ) -> None:
         super().__init__()
         self.dry_run = dry_run
+        self.resume = resume
+        self.benchmark_disks = benchmark_disks
+        self.fleet = fleet
+        self.substituters = substituters or []
+        self.trusted_public_keys = trusted_public_keys or []
         self._has_net = False
         self._cfg: InstallConfig | None = None
+        self._progress = NixProgress()
+        self._prefetch: ClosurePrefetch | None = None
 
     def on_mount(self) -> None:
-        self.push_screen(PreflightScreen(self.dry_run), callback=self._on_preflight_done)
+        from .screens import PreflightScreen
+
+        self.push_screen(
+            PreflightScreen(self.dry_run, self.substituters),
+            callback=self._on_preflight_done,
+        )
 
     def _on_preflight_done(self, result: PreflightResult | None) -> None:
         if result is None:
             self.exit()
             return
+        from .preflight import apply_nix_settings
+
         self._has_net = result.has_net
+        apply_nix_settings(result, self.trusted_public_keys)
+        if self.fleet is not None:
+            from .screens import FleetScreen
+
+            self.push_screen(
+                FleetScreen(self.fleet, self.dry_run, self._has_net, resume=self.resume),
+                callback=self._on_completion_done,
+            )
+            return
+        from .prefetch import ClosurePrefetch
+        from .screens import WizardScreen
+
+        self._prefetch = ClosurePrefetch(self.dry_run, self._progress)
         self.push_screen(
-            WizardScreen(self.dry_run, self._has_net),
+            WizardScreen(
+                self.dry_run,
+                self._has_net,
+                self._prefetch,
+                throughput=result.throughput,
+                benchmark=self.benchmark_disks,
+            ),
             callback=self._on_wizard_done,
         )
 
     def _on_wizard_done(self, cfg: InstallConfig | None) -> None:
         if cfg is None:
+            if self._prefetch is not None:
+                self._prefetch.cancel()
             self.exit()
             return
+        from .screens import InstallScreen
+
         self._cfg = cfg
         self.push_screen(
-            InstallScreen(cfg, self.dry_run, self._has_net),
+            InstallScreen(
+                cfg, self.dry_run, self._has_net, self._prefetch, self._progress, resume=self.resume
+            ),
             callback=self._on_install_done,
         )
 
     def _on_install_done(self, success: bool) -> None:
+        from .screens import CompletionScreen
+
         assert self._cfg is not None
         self.push_screen(
             CompletionScreen(self._cfg, self.dry_run, success),
             callback=self._on_completion_done,
         )
 
-    def _on_completion_done(self, _result: None) -> None:
+    def _on_completion_done(self, _result: object) -> None:
         self.exit()
@@ -0,0 +1,108 @@
+"""Offline install bundle: host closures exported to a local binary cache."""
+
+from __future__ import annotations
+
+import os
+import subprocess
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+from . import SCRIPT_DIR
+from .exceptions import CommandError, ConfigError
+from .nixsettings import nix_settings
+from .runner import run_cmd_streaming
+from .steps import eval_flake, toplevel_attr
+
+BUNDLE_DIR = SCRIPT_DIR / "bundle"
+BUNDLE_PUBLIC_KEY = BUNDLE_DIR / "signing-key.pub"
+CONFIG_DIR = Path(os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config") / "nixos-installer"
+SIGNING_KEY = CONFIG_DIR / "bundle-signing.sec"
+KEY_NAME = "nixos-installer-bundle-1"
+
+
+@dataclass
+class Bundle:
+    url: str
+    public_key: str | None
+
+
+def require_git_checkout() -> None:
+    """Refuse a bundle inside a plain directory.
+
+    Without .git the flake is a path flake, which nix copies into the
+    store whole, bundle included, on every evaluation. A git flake only
+    takes tracked files, and /bundle/ is ignored.
+    """
+    if not (SCRIPT_DIR / ".git").is_dir():
+        raise ConfigError(
+            f"{BUNDLE_DIR} needs the installer to run from a git checkout; "
+            f"without .git nix would copy the bundle into the store on every evaluation"
+        )
+
+
+def find_bundle(root: Path = BUNDLE_DIR) -> Bundle | None:
+    """The bundle next to the installer, if one has been exported."""
+    if not (root / "nix-cache-info").is_file():
+        return None
+    require_git_checkout()
+    try:
+        key = (root / BUNDLE_PUBLIC_KEY.name).read_text().strip() or None
+    except OSError:
+        key = None
+    return Bundle(f"file://{root}", key)
+
+
+def _ensure_signing_key(dry_run: bool) -> Iterator[str]:
+    """Create the bundle signing key pair once; the secret stays off the bundle."""
+    if dry_run:
+        yield "dry-run: nix key generate-secret"
+        return
+    if not SIGNING_KEY.exists():
+        CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        secret = subprocess.run(
+            ["nix", "key", "generate-secret", "--key-name", KEY_NAME],
+            capture_output=True, text=True, env=nix_settings.env(),
+        )
+        if secret.returncode != 0:
+            raise CommandError(["nix", "key", "generate-secret"], secret.returncode, secret.stderr)
+        SIGNING_KEY.write_text(secret.stdout)
+        SIGNING_KEY.chmod(0o600)
+        yield f"Generated signing key {SIGNING_KEY}"
+    public = subprocess.run(
+        ["nix", "key", "convert-secret-to-public"],
+        input=SIGNING_KEY.read_text(), capture_output=True, text=True, env=nix_settings.env(),
+    )
+    if public.returncode != 0:
+        raise CommandError(["nix", "key", "convert-secret-to-public"], public.returncode, public.stderr)
+    BUNDLE_DIR.mkdir(parents=True, exist_ok=True)
+    BUNDLE_PUBLIC_KEY.write_text(public.stdout.strip() + "\n")
+
+
+def _store_url() -> str:
+    return f"file://{BUNDLE_DIR}?compression=zstd&parallel-compression=true&secret-key={SIGNING_KEY}"
+
+
+def export_bundle(hosts: list[str], dry_run: bool) -> Iterator[str]:
+    """Copy the flake inputs and each host's toplevel closure into BUNDLE_DIR.
+
+    Paths already in the bundle are skipped by ``nix copy``, so re-running
+    after a flake update only adds what changed.
+    """
+    require_git_checkout()
+    yield from _ensure_signing_key(dry_run)
+    url = _store_url()
+    yield from run_cmd_streaming(
+        ["nix", "flake", "archive", "--to", url, str(SCRIPT_DIR)],
+        dry_run=dry_run,
+        dry_label="nix flake archive --to bundle",
+    )
+    flake = SCRIPT_DIR if dry_run else eval_flake()
+    for host in hosts:
+        yield f"Exporting {host} closure..."
+        yield from run_cmd_streaming(
+            ["nix", "copy", "--accept-flake-config", "--to", url, toplevel_attr(host, flake)],
+            dry_run=dry_run,
+            dry_label=f"nix copy --to bundle .#{host} toplevel",
+        )
+    yield f"Bundle written to {BUNDLE_DIR}"
@@ -2,82 +2,159 @@
 
 from __future__ import annotations
 
+import hashlib
 import json
+import os
 import re
 import subprocess
 import textwrap
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict
+from pathlib import Path
 
 from . import SCRIPT_DIR
 from .exceptions import DiscoveryError
 from .models import DiskInfo, HostInfo
 from .runner import run_cmd
 
+NIX_NAMES_EXPR = "builtins.attrNames"
 NIX_EVAL_EXPR = textwrap.dedent("""\
-    configs: builtins.mapAttrs (name: cfg: {
+    cfg: {
       hostname = cfg.config.networking.hostName;
       isDesktop = cfg.config.programs.hyprland.enable or false;
       hasDocker = cfg.config.virtualisation.docker.enable or false;
       hasNvidia = builtins.elem "nvidia" (cfg.config.services.xserver.videoDrivers or []);
       hasFprintd = cfg.config.services.fprintd.enable or false;
       isIso = cfg.config.system.build ? isoImage;
-    }) configs""")
+    }""")
 
+# Each evaluation of a full NixOS config can take a GB or more of RAM
+MAX_EVAL_JOBS = 4
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "nixos-installer"
+HOSTS_CACHE = CACHE_DIR / "hosts.json"
+
+# Everything host evaluation depends on (minus flake inputs, pinned by flake.lock)
+_FINGERPRINT_FILES = ("flake.lock", "flake.nix")
+_FINGERPRINT_DIRS = ("hosts", "modules")
+
+
+def flake_fingerprint() -> str:
+    """Hash the flake files and host/module trees that feed host discovery."""
+    h = hashlib.sha256()
+    paths = [SCRIPT_DIR / name for name in _FINGERPRINT_FILES]
+    for sub in _FINGERPRINT_DIRS:
+        paths.extend(sorted(p for p in (SCRIPT_DIR / sub).rglob("*") if p.is_file()))
+    for path in paths:
+        h.update(str(path.relative_to(SCRIPT_DIR)).encode())
+        h.update(b"\0")
+        try:
+            h.update(path.read_bytes())
+        except OSError:
+            h.update(b"<missing>")
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def cached_hosts() -> list[HostInfo] | None:
+    """Return the cached host list if it matches the current flake, else None."""
+    try:
+        data = json.loads(HOSTS_CACHE.read_text())
+        if data.get("key") != flake_fingerprint():
+            return None
+        return [HostInfo(**h) for h in data["hosts"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _store_hosts(hosts: list[HostInfo]) -> None:
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = HOSTS_CACHE.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"key": flake_fingerprint(), "hosts": [asdict(h) for h in hosts]}))
+        tmp.replace(HOSTS_CACHE)
+    except OSError:
+        pass
 
-def discover_hosts(dry_run: bool) -> list[HostInfo]:
-    """Discover hosts from flake.nix via nix eval."""
-    hosts: list[HostInfo] = []
 
+def _host_names() -> list[str]:
+    """List nixosConfigurations names without evaluating any of them."""
     result = run_cmd(
         [
             "nix", "eval", "--json",
             f"{SCRIPT_DIR}#nixosConfigurations",
+            "--apply", NIX_NAMES_EXPR,
+        ],
+        capture=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return []
+    try:
+        return list(json.loads(result.stdout))
+    except json.JSONDecodeError:
+        return []
+
+
+def _eval_host(name: str) -> HostInfo | None:
+    """Evaluate one host's attributes; None for ISO configs."""
+    result = run_cmd(
+        [
+            "nix", "eval", "--json",
+            f"{SCRIPT_DIR}#nixosConfigurations.{name}",
             "--apply", NIX_EVAL_EXPR,
         ],
         capture=True,
         check=False,
-        dry_run=False,  # always try real eval
+    )
+    try:
+        props = json.loads(result.stdout) if result.returncode == 0 else None
+    except json.JSONDecodeError:
+        props = None
+    if props is None:
+        return HostInfo(name=name, eval_failed=True)
+    if props.get("isIso", False):
+        return None
+    return HostInfo(
+        name=name,
+        is_desktop=props.get("isDesktop", False),
+        has_nvidia=props.get("hasNvidia", False),
+        has_docker=props.get("hasDocker", False),
+        has_fprintd=props.get("hasFprintd", False),
+        is_iso=False,
     )
 
-    if result.returncode == 0 and result.stdout.strip():
-        try:
-            data = json.loads(result.stdout)
-            for name, props in data.items():
-                if props.get("isIso", False):
-                    continue
-                hosts.append(
-                    HostInfo(
-                        name=name,
-                        is_desktop=props.get("isDesktop", False),
-                        has_nvidia=props.get("hasNvidia", False),
-                        has_docker=props.get("hasDocker", False),
-                        has_fprintd=props.get("hasFprintd", False),
-                        is_iso=False,
-                    )
-                )
-        except json.JSONDecodeError:
-            pass
-
-    # Fallback: names only from flake show
-    if not hosts:
-        fb = run_cmd(
-            ["nix", "flake", "show", "--json", str(SCRIPT_DIR)],
-            capture=True,
-            check=False,
-        )
-        if fb.returncode == 0:
-            try:
-                show = json.loads(fb.stdout)
-                for name in show.get("nixosConfigurations", {}):
-                    if name == "iso":
-                        continue
-                    hosts.append(HostInfo(name=name))
-            except json.JSONDecodeError:
-                pass
+
+def discover_hosts(dry_run: bool, on_host: Callable[[HostInfo], None] | None = None) -> list[HostInfo]:
+    """Discover hosts from flake.nix, evaluating each host in its own nix process.
+
+    *on_host* is called (from this thread) as each host finishes evaluating,
+    so callers can show hosts before the slowest one is done. A host whose
+    evaluation fails is reported with ``eval_failed`` instead of hiding the
+    rest. The on-disk cache is only refreshed when every host evaluated.
+    """
+    names = _host_names()
+    if not names:
+        raise DiscoveryError("Could not discover any host configurations.")
+
+    hosts: list[HostInfo] = []
+    jobs = max(1, min(len(names), os.cpu_count() or 1, MAX_EVAL_JOBS))
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="eval") as pool:
+        for fut in as_completed([pool.submit(_eval_host, name) for name in names]):
+            host = fut.result()
+            if host is None:
+                continue
+            hosts.append(host)
+            if on_host:
+                on_host(host)
 
     if not hosts:
         raise DiscoveryError("Could not discover any host configurations.")
 
     hosts.sort(key=lambda h: h.name)
+    if not any(h.eval_failed for h in hosts):
+        _store_hosts(hosts)
     return hosts
 
 
@@ -125,6 +202,25 @@ def discover_disks(dry_run: bool) -> list[DiskInfo]:
     return disks
 
 
+def describe_disk(device: str, dry_run: bool) -> DiskInfo:
+    """DiskInfo for one whole disk; unlike discover_disks, loop devices qualify."""
+    if dry_run:
+        return DiskInfo(device, "500G", 500_000_000_000, "Fake Disk", False, False)
+    result = run_cmd(
+        ["lsblk", "--json", "-b", "-d", "-o", "NAME,SIZE,MODEL,RM,TYPE", device],
+        capture=True,
+        check=False,
+    )
+    devs = json.loads(result.stdout or "{}").get("blockdevices", []) if result.returncode == 0 else []
+    if not devs or devs[0].get("type") not in ("disk", "loop"):
+        raise DiscoveryError(f"{device} is not a disk")
+    dev = devs[0]
+    path = f"/dev/{dev['name']}"
+    size_bytes = int(dev.get("size", 0))
+    model = (dev.get("model") or ("Loop device" if dev["type"] == "loop" else "Unknown")).strip()
+    return DiskInfo(path, _human_size(size_bytes), size_bytes, model, bool(dev.get("rm")), path == _boot_device())
+
+
 def _human_size(n: int) -> str:
     for unit in ("B", "K", "M", "G", "T"):
         if n < 1024:
@@ -0,0 +1,116 @@
+"""Quick read-only disk benchmark and SMART health probe."""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import random
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .models import DiskBenchmark, DiskInfo
+
+BENCH_SECONDS = 1.0
+SEQ_BLOCK = 1024 * 1024
+RAND_BLOCK = 4096
+SMART_TIMEOUT = 10
+# Pairing disks whose read speed differs by more than this makes RAID0 pointless
+RAID0_MISMATCH = 2.0
+
+
+def _seq_read(fd: int, buf: mmap.mmap, size: int, seconds: float) -> float:
+    """Sequential read throughput in bytes/s from the start of the device."""
+    offset = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds and offset + SEQ_BLOCK <= size:
+        n = os.preadv(fd, [buf], offset)
+        if n <= 0:
+            break
+        offset += n
+    elapsed = time.monotonic() - start
+    return offset / elapsed if elapsed > 0 else 0.0
+
+
+def _rand_read(fd: int, buf: mmap.mmap, size: int, seconds: float) -> float:
+    """Random 4K reads per second at queue depth 1."""
+    blocks = size // RAND_BLOCK
+    if blocks == 0:
+        return 0.0
+    count = 0
+    start = time.monotonic()
+    with memoryview(buf)[:RAND_BLOCK] as view:
+        while time.monotonic() - start < seconds:
+            os.preadv(fd, [view], random.randrange(blocks) * RAND_BLOCK)
+            count += 1
+    elapsed = time.monotonic() - start
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def disk_healthy(device: str) -> bool | None:
+    """SMART overall health via smartctl, or None if unavailable."""
+    if shutil.which("smartctl") is None:
+        return None
+    try:
+        result = subprocess.run(
+            ["smartctl", "-H", "-j", device],
+            capture_output=True,
+            text=True,
+            timeout=SMART_TIMEOUT,
+        )
+        status = json.loads(result.stdout).get("smart_status", {})
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+    passed = status.get("passed")
+    return passed if isinstance(passed, bool) else None
+
+
+def benchmark_disk(disk: DiskInfo, seconds: float = BENCH_SECONDS) -> DiskBenchmark:
+    """Read-only benchmark of the raw device, bypassing the page cache.
+
+    O_DIRECT needs block-aligned buffers; an anonymous mmap is page aligned.
+    Nothing is ever written to the device.
+    """
+    bench = DiskBenchmark(healthy=disk_healthy(disk.device))
+    try:
+        fd = os.open(disk.device, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        bench.error = e.strerror
+        return bench
+    buf = mmap.mmap(-1, SEQ_BLOCK)
+    try:
+        bench.seq_read = _seq_read(fd, buf, disk.size_bytes, seconds)
+        bench.rand_read_iops = _rand_read(fd, buf, disk.size_bytes, seconds)
+    except OSError as e:
+        bench.error = e.strerror
+    finally:
+        buf.close()
+        os.close(fd)
+    return bench
+
+
+def benchmark_disks(disks: list[DiskInfo], dry_run: bool) -> None:
+    """Benchmark all *disks* in parallel, filling in DiskInfo.benchmark."""
+    if dry_run:
+        for i, disk in enumerate(disks):
+            disk.benchmark = DiskBenchmark(seq_read=(i + 1) * 500e6, rand_read_iops=(i + 1) * 8000.0)
+        return
+    if not disks:
+        return
+    with ThreadPoolExecutor(max_workers=len(disks), thread_name_prefix="diskbench") as pool:
+        for disk, bench in zip(disks, pool.map(benchmark_disk, disks)):
+            disk.benchmark = bench
+
+
+def raid0_mismatch(a: DiskInfo, b: DiskInfo) -> str | None:
+    """Warning text if RAID0 across *a* and *b* would be held back by the slower disk."""
+    if a.benchmark is None or b.benchmark is None:
+        return None
+    for attr, what in (("seq_read", "sequential"), ("rand_read_iops", "random 4K")):
+        x, y = getattr(a.benchmark, attr), getattr(b.benchmark, attr)
+        if x and y and max(x, y) / min(x, y) > RAID0_MISMATCH:
+            slow = a if x < y else b
+            return f"{slow.device} is {max(x, y) / min(x, y):.1f}x slower ({what} read); RAID0 runs at the slower disk's pace"
+    return None
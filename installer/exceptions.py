@@ -17,9 +17,17 @@ class CommandError(InstallerError):
         super().__init__(f"Command failed (rc={returncode}): {' '.join(cmd)}")
 
 
+class Cancelled(InstallerError):
+    """The install was aborted before a step or command could finish."""
+
+
 class DiscoveryError(InstallerError):
     """Host or disk discovery failed."""
 
 
 class StepError(InstallerError):
     """An installation step failed."""
+
+
+class ConfigError(InstallerError):
+    """An unattended install configuration is invalid."""
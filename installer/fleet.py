@@ -0,0 +1,272 @@
+"""Fleet installs: several (host, disk) targets installed concurrently.
+
+A fleet file is TOML with install defaults at the top level and one
+``[[target]]`` table per target:
+
+    encrypt = true
+    password_file = "/root/fleet-password"
+    update_flake = false
+
+    [[target]]
+    host = "hermes"
+    disk = "/dev/sdb"
+
+    [[target]]
+    host = "ares"
+    disk = "/dev/sdc"
+    encrypt = false
+
+Target N is mounted at /mnt-N with LUKS mappers crypted-N/crypted2-N and
+builds from its own copy of the flake; the live store, and with it every
+closure path the targets have in common, is shared.
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+import threading
+import time
+import tomllib
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any
+
+from .discovery import cached_hosts, discover_disks, discover_hosts
+from .exceptions import Cancelled, ConfigError, InstallerError
+from .headless import CONFIG_KEYS, Printer, build_config
+from .journal import FLEET_JOURNAL_FILE, StepJournal, fleet_fingerprint
+from .models import InstallConfig
+from .netprobe import closure_size
+from .nixlog import NixProgress
+from .pipeline import Pipeline, Step, StepState
+from .runner import EXIT_CANCELLED, CancelToken, cleanup, log, reset_log
+from .steps import fleet_plan, install_trace
+from .telemetry import format_duration
+
+SHARED = "shared"
+# Fleet disks carry slot-numbered partition labels, so a refresh would only
+# find its old install if the disk kept its slot: refresh disks one by one
+TARGET_KEYS = CONFIG_KEYS - {"update_flake", "refresh"}
+FLEET_KEYS = (CONFIG_KEYS - {"host", "disk", "disk2", "refresh"}) | {"target"}
+
+_TARGET_KEY = re.compile(r"(t\d+)\.")
+
+
+@dataclass
+class FleetSpec:
+    defaults: dict[str, Any]
+    targets: list[dict[str, Any]]
+    update_flake: bool = False
+
+
+def load_fleet_file(path: Path) -> FleetSpec:
+    try:
+        with path.open("rb") as f:
+            data = tomllib.load(f)
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e.strerror}") from e
+    except tomllib.TOMLDecodeError as e:
+        raise ConfigError(f"{path}: {e}") from e
+    if "refresh" in data or any("refresh" in t for t in data.get("target", []) if isinstance(t, dict)):
+        raise ConfigError(f"{path}: refresh is not supported for fleets; refresh each disk with a single install")
+    unknown = sorted(set(data) - FLEET_KEYS)
+    if unknown:
+        raise ConfigError(f"{path}: unknown keys {', '.join(unknown)}")
+    targets = data.pop("target", [])
+    if not isinstance(targets, list) or not targets:
+        raise ConfigError(f"{path}: no [[target]] entries")
+    for i, target in enumerate(targets, 1):
+        unknown = sorted(set(target) - TARGET_KEYS)
+        if unknown:
+            raise ConfigError(f"{path}: target {i}: unknown keys {', '.join(unknown)}")
+    update = bool(data.pop("update_flake", False))
+    return FleetSpec(data, targets, update)
+
+
+def build_fleet(spec: FleetSpec, dry_run: bool) -> list[InstallConfig]:
+    """Validated InstallConfigs for every target, numbered from 1."""
+    hosts = cached_hosts() or discover_hosts(dry_run)
+    disks = discover_disks(dry_run)
+    cfgs: list[InstallConfig] = []
+    claimed: dict[str, int] = {}
+    for slot, target in enumerate(spec.targets, 1):
+        try:
+            cfg = build_config({**spec.defaults, **target}, dry_run, hosts, disks)
+        except ConfigError as e:
+            raise ConfigError(f"target {slot}: {e}") from e
+        for disk in (cfg.disk, cfg.disk2):
+            if disk is None:
+                continue
+            if disk.device in claimed:
+                raise ConfigError(f"target {slot}: {disk.device} is already used by target {claimed[disk.device]}")
+            claimed[disk.device] = slot
+        cfgs.append(replace(cfg, slot=slot, update_flake=spec.update_flake))
+    return cfgs
+
+
+def estimate_closures(cfgs: list[InstallConfig], dry_run: bool) -> None:
+    """Fill in closure_bytes (which sizes swap) once per distinct host."""
+    if dry_run:
+        return
+    sizes: dict[str, int | None] = {}
+    for cfg in cfgs:
+        assert cfg.host
+        host = cfg.host.name
+        if host not in sizes:
+            size = closure_size(host)
+            sizes[host] = size[1] if size is not None else None
+        cfg.closure_bytes = sizes[host]
+
+
+@dataclass
+class TargetStatus:
+    name: str
+    disks: str
+    total: int
+    done: int = 0
+    running: list[str] = field(default_factory=list)
+    failed: str | None = None
+    started: float | None = None
+    finished: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.failed:
+            return StepState.FAILED
+        if self.done == self.total:
+            return StepState.DONE
+        if self.started is None:
+            return StepState.PENDING
+        return StepState.RUNNING
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+
+def row_key(step: Step) -> str:
+    """Fleet status row a step belongs to: its target (``t<slot>``) or SHARED."""
+    m = _TARGET_KEY.match(step.key)
+    return m.group(1) if m else SHARED
+
+
+class FleetStatus:
+    """Per-target progress of a fleet pipeline, fed by Pipeline.on_state."""
+
+    def __init__(self, cfgs: list[InstallConfig], plan: list[Step]) -> None:
+        self._lock = threading.Lock()
+        self.progress: dict[str, NixProgress] = {SHARED: NixProgress()}
+        self._rows: dict[str, TargetStatus] = {SHARED: TargetStatus("shared", "live store", 0)}
+        for cfg in cfgs:
+            key = f"t{cfg.slot}"
+            disks = " + ".join(d.device for d in (cfg.disk, cfg.disk2) if d is not None)
+            self._rows[key] = TargetStatus(cfg.name, disks, 0)
+            self.progress[key] = NixProgress()
+        for step in plan:
+            if step.enabled:
+                self._rows[row_key(step)].total += 1
+
+    def on_state(self, step: Step, state: str) -> None:
+        with self._lock:
+            row = self._rows[row_key(step)]
+            now = time.monotonic()
+            if state == StepState.RUNNING:
+                if row.started is None:
+                    row.started = now
+                row.running.append(step.label)
+                return
+            if step.label in row.running:
+                row.running.remove(step.label)
+            if state in (StepState.DONE, StepState.RESUMED) or (state == StepState.FAILED and step.optional):
+                row.done += 1
+            elif state == StepState.FAILED:
+                row.failed = step.label
+            if row.done == row.total or row.failed:
+                row.finished = now
+
+    def rows(self) -> list[tuple[str, TargetStatus]]:
+        with self._lock:
+            return [(key, replace(row, running=list(row.running))) for key, row in self._rows.items()]
+
+
+def fleet_pipeline(
+    cfgs: list[InstallConfig],
+    dry_run: bool,
+    has_net: bool,
+    update: bool,
+    resume: bool,
+    on_state: Any = None,
+    token: CancelToken | None = None,
+    strict: bool = False,
+) -> tuple[Pipeline, FleetStatus]:
+    """The shared pipeline for *cfgs*, journaled separately from single installs.
+
+    *strict* is passed on to StepJournal.for_fingerprint.
+    """
+    status = FleetStatus(cfgs, fleet_plan(cfgs, dry_run, has_net, update))
+    plan = fleet_plan(cfgs, dry_run, has_net, update, status.progress)
+
+    def state(step: Step, st: str) -> None:
+        status.on_state(step, st)
+        if on_state is not None:
+            on_state(step, st)
+
+    journal = StepJournal.for_fingerprint(fleet_fingerprint(cfgs), resume, FLEET_JOURNAL_FILE, dry_run, strict)
+    cleanup.dry_run = dry_run
+    pipeline = Pipeline(plan, max_workers=max(4, 2 * len(cfgs)), on_state=state, journal=journal, token=token)
+    return pipeline, status
+
+
+def run_fleet(
+    cfgs: list[InstallConfig],
+    dry_run: bool,
+    has_net: bool,
+    update: bool,
+    resume: bool,
+    out: Printer,
+) -> FleetStatus:
+    """Install all *cfgs* through one pipeline; raises the first target failure.
+
+    Unattended, so a resume that cannot resume is an error.
+    """
+    if not resume:
+        reset_log()
+    pipeline, status = fleet_pipeline(cfgs, dry_run, has_net, update, resume, out.state, strict=True)
+    kept = out.resume(pipeline, resume)
+    with install_trace(cfgs, dry_run):
+        pipeline.run(out.line, kept)
+    return status
+
+
+def run_fleet_plain(
+    spec: FleetSpec,
+    dry_run: bool,
+    resume: bool = False,
+    substituters: list[str] | None = None,
+    trusted_public_keys: list[str] | None = None,
+) -> int:
+    """Fleet install with line-oriented output; returns the process exit code."""
+    out = Printer(keys=True)
+    try:
+        result = out.preflight(dry_run, substituters, trusted_public_keys)
+        if result is None:
+            return 1
+        cfgs = build_fleet(spec, dry_run)
+        estimate_closures(cfgs, dry_run)
+        for cfg in cfgs:
+            assert cfg.disk
+            out.line(f"Target {cfg.name}: {cfg.disk.device}{' (LUKS)' if cfg.encrypted else ''} at {cfg.root}")
+        status = run_fleet(cfgs, dry_run, result.has_net, spec.update_flake, resume, out)
+    except InstallerError as e:
+        log(f"Error: {e}")
+        print(f"error: {e}", file=sys.stderr, flush=True)
+        return EXIT_CANCELLED if isinstance(e, Cancelled) else 1
+    finally:
+        out.summary()
+    for _key, row in status.rows():
+        out.line(f"{row.name:<16} {row.disks:<24} {row.state:<8} {format_duration(row.elapsed)}")
+    out.line("Fleet installation complete.")
+    return 0
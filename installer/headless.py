@@ -0,0 +1,341 @@
+"""Unattended install driven by a TOML file or command-line flags.
+
+Runs the same preflight checks, step graph and telemetry as the TUI, but
+prints plain lines to stdout and never imports Textual.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import threading
+import time
+import tomllib
+from pathlib import Path
+from typing import Any
+
+from .discovery import cached_hosts, check_mounted, describe_disk, discover_disks, discover_hosts
+from .exceptions import Cancelled, ConfigError, InstallerError
+from .image import ImageInfo, attach_loop, create_image, load_image, new_image_key
+from .journal import StepJournal
+from .models import DiskInfo, HostInfo, InstallConfig, PreflightResult
+from .netprobe import DownloadEstimate, closure_size
+from .nixlog import NixProgress
+from .nixsettings import TUNED, nix_settings
+from .pipeline import Pipeline, Step, StepState
+from .preflight import apply_nix_settings, preflight_checks
+from .runner import EXIT_CANCELLED, cleanup, log, reset_log
+from .steps import image_build_plan, image_write_plan, install_plan, install_trace, refresh_problem
+from .telemetry import CHROME_TRACE_FILE, TRACE_FILE, format_bytes, format_duration, trace
+
+PASSWORD_ENV = "NIXOS_INSTALL_PASSWORD"
+CONFIG_KEYS = {"host", "disk", "disk2", "encrypt", "update_flake", "refresh", "password", "password_file", "user"}
+
+# Rich markup used in step output; stripped for plain-text output
+_MARKUP = re.compile(r"\[/?(?:bold|dim|red|green|yellow|blue)(?: [a-z]+)*\]")
+
+
+def load_config_file(path: Path) -> dict[str, Any]:
+    """Read an install TOML file; see CONFIG_KEYS for the accepted keys."""
+    try:
+        with path.open("rb") as f:
+            data = tomllib.load(f)
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e.strerror}") from e
+    except tomllib.TOMLDecodeError as e:
+        raise ConfigError(f"{path}: {e}") from e
+    unknown = sorted(set(data) - CONFIG_KEYS)
+    if unknown:
+        raise ConfigError(f"{path}: unknown keys {', '.join(unknown)}")
+    return data
+
+
+def _password(options: dict[str, Any]) -> str | None:
+    if options.get("password_file"):
+        try:
+            return Path(options["password_file"]).read_text().rstrip("\n")
+        except OSError as e:
+            raise ConfigError(f"Cannot read password file: {e.strerror}") from e
+    return options.get("password") or os.environ.get(PASSWORD_ENV)
+
+
+def find_host(name: str, dry_run: bool, hosts: list[HostInfo] | None = None) -> HostInfo:
+    if hosts is None:
+        hosts = cached_hosts() or discover_hosts(dry_run)
+    host = next((h for h in hosts if h.name == name), None)
+    if host is None:
+        raise ConfigError(f"Unknown host {name!r} (known: {', '.join(h.name for h in hosts)})")
+    if host.eval_failed:
+        raise ConfigError(f"Host {host.name} failed to evaluate; check its configuration")
+    return host
+
+
+def build_config(
+    options: dict[str, Any],
+    dry_run: bool,
+    hosts: list[HostInfo] | None = None,
+    disks: list[DiskInfo] | None = None,
+) -> InstallConfig:
+    """Turn file/flag options into an InstallConfig, validated like the wizard does.
+
+    *hosts* and *disks* default to a fresh discovery.
+    """
+    for key in ("host", "disk"):
+        if not options.get(key):
+            raise ConfigError(f"No {key} given")
+
+    host = find_host(options["host"], dry_run, hosts)
+    by_device = {d.device: d for d in (disks if disks is not None else discover_disks(dry_run))}
+    cfg = InstallConfig(host=host)
+    for attr in ("disk", "disk2"):
+        device = options.get(attr)
+        if not device:
+            continue
+        disk = by_device.get(os.path.realpath(device)) or by_device.get(device)
+        if disk is None:
+            raise ConfigError(f"{device} is not a disk (found: {', '.join(by_device)})")
+        if disk.is_boot_disk:
+            raise ConfigError(f"Cannot install to the current boot disk {disk.device}")
+        mounts = [] if dry_run else check_mounted(disk.device)
+        if mounts:
+            raise ConfigError(f"{disk.device} is in use (mounted at {', '.join(mounts)})")
+        setattr(cfg, attr, disk)
+    if cfg.disk2 is not None:
+        if cfg.disk2 is cfg.disk:
+            raise ConfigError("disk and disk2 must be different disks")
+        cfg.dual_disk = True
+
+    password = _password(options)
+    if not password:
+        raise ConfigError(f"No password given (password_file, password or ${PASSWORD_ENV})")
+    cfg.user_password = password
+    cfg.encrypted = bool(options.get("encrypt", False))
+    if cfg.encrypted:
+        cfg.luks_password = password
+    cfg.update_flake = bool(options.get("update_flake", False))
+    cfg.refresh = bool(options.get("refresh", False))
+    if cfg.refresh:
+        problem = refresh_problem(cfg, dry_run)
+        if problem:
+            raise ConfigError(f"Cannot refresh: {problem}")
+    if options.get("user"):
+        cfg.user = options["user"]
+    return cfg
+
+
+class Printer:
+    """Line-oriented output shared by steps running on several threads.
+
+    With *keys*, step announcements name the step key too, which tells
+    fleet targets apart.
+    """
+
+    def __init__(self, keys: bool = False) -> None:
+        self.keys = keys
+        self._lock = threading.Lock()
+        self._started: dict[str, float] = {}
+
+    def line(self, text: str) -> None:
+        with self._lock:
+            print(_MARKUP.sub("", text), flush=True)
+
+    def state(self, step: Step, state: str) -> None:
+        label = f"{step.key}: {step.label}" if self.keys else step.label
+        if state == StepState.RUNNING:
+            self._started[step.key] = time.monotonic()
+            self.line(f"==> {label}")
+        elif state in (StepState.DONE, StepState.FAILED):
+            elapsed = time.monotonic() - self._started.get(step.key, time.monotonic())
+            self.line(f"==> {label} {state} ({format_duration(elapsed)})")
+        elif state == StepState.RESUMED:
+            self.line(f"==> {label} kept from previous run")
+
+    def resume(self, pipeline: Pipeline, resume: bool) -> set[str]:
+        """Steps a resume keeps; a resume that would keep nothing is an error.
+
+        Unattended, falling back to a full install would wipe the disk the
+        caller asked to pick up again.
+        """
+        kept = pipeline.resumable()
+        if resume:
+            if not kept:
+                raise ConfigError(
+                    "--resume: nothing from the interrupted install still verifies; run without --resume to start over"
+                )
+            self.line(f"Resuming: keeping {', '.join(sorted(kept))}")
+        return kept
+
+    def preflight(
+        self,
+        dry_run: bool,
+        substituters: list[str] | None,
+        trusted_public_keys: list[str] | None,
+    ) -> PreflightResult | None:
+        """Run and print the preflight checks; None if a fatal one failed."""
+        result = preflight_checks(dry_run, substituters)
+        for label, passed, fatal in result.checks:
+            mark = "ok" if passed else ("FAIL" if fatal else "warn")
+            self.line(f"[{mark:>4}] {label}")
+        if result.any_fatal:
+            self.line("Fatal pre-flight check failed; not installing.")
+            return None
+        apply_nix_settings(result, trusted_public_keys or [])
+        return result
+
+    def summary(self) -> None:
+        for line in trace.summary_lines():
+            self.line(line)
+        if trace.spans:
+            self.line(f"Trace: {TRACE_FILE}, {CHROME_TRACE_FILE}")
+
+
+def run_headless(
+    options: dict[str, Any],
+    dry_run: bool,
+    resume: bool = False,
+    substituters: list[str] | None = None,
+    trusted_public_keys: list[str] | None = None,
+) -> int:
+    """Install without the TUI; returns the process exit code."""
+    out = Printer()
+    try:
+        result = out.preflight(dry_run, substituters, trusted_public_keys)
+        if result is None:
+            return 1
+
+        cfg = build_config(options, dry_run)
+        assert cfg.host and cfg.disk
+        disks = " + ".join(d.device for d in (cfg.disk, cfg.disk2) if d is not None)
+        action = f"Refreshing {cfg.host.name} on" if cfg.refresh else f"Installing {cfg.host.name} to"
+        out.line(f"{action} {disks}{' (LUKS)' if cfg.encrypted else ''}")
+        if not dry_run:
+            size = closure_size(cfg.host.name)
+            if size is not None:
+                download, cfg.closure_bytes = size
+                out.line(f"Download: {DownloadEstimate(download, result.throughput, cfg.closure_bytes).describe()}")
+
+        if not resume:
+            reset_log()
+        journal = StepJournal.start(cfg, resume, dry_run=dry_run, strict=True)
+        cleanup.dry_run = dry_run
+        plan = install_plan(cfg, dry_run, result.has_net, None, NixProgress())
+        pipeline = Pipeline(plan, on_state=out.state, journal=journal)
+        kept = out.resume(pipeline, resume)
+        out.line(f"Nix settings: {nix_settings.describe(TUNED)}")
+        with install_trace([cfg], dry_run):
+            pipeline.run(out.line, kept)
+    except InstallerError as e:
+        log(f"Error: {e}")
+        print(f"error: {e}", file=sys.stderr, flush=True)
+        return EXIT_CANCELLED if isinstance(e, Cancelled) else 1
+    finally:
+        out.summary()
+    out.line("Installation complete.")
+    return 0
+
+
+def image_targets(info: ImageInfo, devices: list[str], password: str | None, dry_run: bool) -> list[InstallConfig]:
+    """One InstallConfig per disk the image is written to, numbered from 1."""
+    if not password:
+        raise ConfigError(f"No password given (password_file or ${PASSWORD_ENV})")
+    cfgs: list[InstallConfig] = []
+    seen: set[str] = set()
+    for slot, device in enumerate(devices, 1):
+        disk = describe_disk(device, dry_run)
+        if disk.is_boot_disk:
+            raise ConfigError(f"Cannot write to the current boot disk {disk.device}")
+        if disk.device in seen:
+            raise ConfigError(f"{disk.device} is given twice")
+        seen.add(disk.device)
+        mounts = [] if dry_run else check_mounted(disk.device)
+        if mounts:
+            raise ConfigError(f"{disk.device} is in use (mounted at {', '.join(mounts)})")
+        if disk.size_bytes < info.size:
+            raise ConfigError(f"{disk.device} ({disk.size_human}) is smaller than the image ({format_bytes(info.size)})")
+        cfg = InstallConfig(
+            host=HostInfo(info.host),
+            disk=disk,
+            encrypted=info.encrypted,
+            luks_password=password if info.encrypted else None,
+            user_password=password,
+            user=info.user,
+            slot=slot,
+        )
+        cfgs.append(cfg)
+    return cfgs
+
+
+def run_image_build(
+    host: str,
+    image: Path,
+    size: int,
+    encrypt: bool,
+    compress: bool,
+    dry_run: bool,
+    substituters: list[str] | None = None,
+    trusted_public_keys: list[str] | None = None,
+) -> int:
+    """Install *host* into a new golden image file; returns the process exit code."""
+    out = Printer()
+    try:
+        result = out.preflight(dry_run, substituters, trusted_public_keys)
+        if result is None:
+            return 1
+        # Unlocks the image until each written disk gets its own password
+        key = new_image_key()
+        cfg = InstallConfig(
+            host=find_host(host, dry_run),
+            encrypted=encrypt,
+            luks_password=key if encrypt else None,
+            user_password=key,
+        )
+        out.line(f"Building {host} image {image} ({format_bytes(size)}{', LUKS' if encrypt else ''})")
+        reset_log()
+        cleanup.dry_run = dry_run
+        create_image(image, size, dry_run, out.line)
+        cfg.disk = attach_loop(image, size, dry_run, out.line)
+        plan = image_build_plan(cfg, image, compress, dry_run, result.has_net, NixProgress())
+        with install_trace([cfg], dry_run):
+            Pipeline(plan, on_state=out.state).run(out.line)
+    except InstallerError as e:
+        log(f"Error: {e}")
+        print(f"error: {e}", file=sys.stderr, flush=True)
+        return EXIT_CANCELLED if isinstance(e, Cancelled) else 1
+    finally:
+        out.summary()
+    out.line("Image complete.")
+    return 0
+
+
+def run_image_write(
+    image: Path,
+    devices: list[str],
+    options: dict[str, Any],
+    reencrypt: bool,
+    dry_run: bool,
+    substituters: list[str] | None = None,
+    trusted_public_keys: list[str] | None = None,
+) -> int:
+    """Write a golden image to *devices* and personalize each; returns the process exit code."""
+    out = Printer(keys=len(devices) > 1)
+    try:
+        info = load_image(image)
+        out.line(f"Image: {info.describe()}")
+        result = out.preflight(dry_run, substituters, trusted_public_keys)
+        if result is None:
+            return 1
+        cfgs = image_targets(info, devices, _password(options), dry_run)
+        reset_log()
+        cleanup.dry_run = dry_run
+        plan = image_write_plan(info, cfgs, dry_run, reencrypt)
+        with install_trace(cfgs, dry_run):
+            Pipeline(plan, max_workers=max(4, 2 * len(cfgs)), on_state=out.state).run(out.line)
+    except InstallerError as e:
+        log(f"Error: {e}")
+        print(f"error: {e}", file=sys.stderr, flush=True)
+        return EXIT_CANCELLED if isinstance(e, Cancelled) else 1
+    finally:
+        out.summary()
+    out.line("Image written.")
+    return 0
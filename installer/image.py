@@ -0,0 +1,408 @@
+"""Golden images: an installed system captured once and written to many disks.
+
+An image is a sparse raw disk file (optionally zstd-compressed) plus a
+JSON sidecar recording the host, the layout and the image's data extents.
+Writing copies only those extents, in large aligned O_DIRECT writes, so
+a mostly empty image goes down at close to the disk's sequential speed.
+Encrypted images are unlocked by a random key kept next to the image,
+which every written disk swaps for its own password.
+"""
+
+from __future__ import annotations
+
+import errno
+import json
+import mmap
+import os
+import secrets
+import stat
+import subprocess
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from .exceptions import ConfigError, StepError
+from .models import DiskInfo, InstallConfig
+from .runner import LogFn, cleanup, current_token, log, run_cmd
+from .teardown import CleanupAction
+from .telemetry import GIB, MIB, format_bytes, trace
+
+# Default image size: the disko layouts need 2G ESP + 32G swap + root.
+# The file is sparse, so unused space costs nothing.
+DEFAULT_IMAGE_SIZE = 48 * GIB
+WRITE_BLOCK = 4 * MIB
+# O_DIRECT needs offsets, lengths and buffers aligned to the logical
+# block size; 4 KiB covers every disk we write to
+ALIGN = 4096
+PROGRESS_INTERVAL = 2.0
+ESP_TYPE = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+
+
+@dataclass
+class ImageInfo:
+    path: Path
+    host: str
+    user: str
+    encrypted: bool
+    size: int
+    # (offset, length) runs of the raw image that hold data; the rest is holes
+    extents: list[tuple[int, int]] = field(default_factory=list)
+    # hardware-configuration.nix the image's system was built with
+    hardware_config: str = ""
+    created: str = ""
+
+    @property
+    def compressed(self) -> bool:
+        return self.path.suffix == ".zst"
+
+    @property
+    def data_bytes(self) -> int:
+        return sum(length for _offset, length in self.extents)
+
+    @property
+    def meta_path(self) -> Path:
+        return meta_path(self.path)
+
+    @property
+    def key_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".key")
+
+    def save(self) -> None:
+        data = asdict(self)
+        data["path"] = self.path.name
+        self.meta_path.write_text(json.dumps(data, indent=1))
+
+    def describe(self) -> str:
+        kind = "LUKS " if self.encrypted else ""
+        return (
+            f"{self.host} {kind}image, {format_bytes(self.size)} "
+            f"({format_bytes(self.data_bytes)} data{', zstd' if self.compressed else ''})"
+        )
+
+
+def meta_path(image: Path) -> Path:
+    return image.with_name(image.name + ".json")
+
+
+def load_image(path: Path) -> ImageInfo:
+    """Read the sidecar of the image at *path*."""
+    try:
+        data = json.loads(meta_path(path).read_text())
+    except OSError as e:
+        raise ConfigError(f"{path} has no readable image metadata ({meta_path(path)}): {e.strerror}") from e
+    except json.JSONDecodeError as e:
+        raise ConfigError(f"{meta_path(path)}: {e}") from e
+    try:
+        info = ImageInfo(
+            path=path,
+            host=data["host"],
+            user=data["user"],
+            encrypted=bool(data["encrypted"]),
+            size=int(data["size"]),
+            extents=[(int(o), int(n)) for o, n in data["extents"]],
+            hardware_config=data.get("hardware_config", ""),
+            created=data.get("created", ""),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ConfigError(f"{meta_path(path)}: invalid image metadata ({e})") from e
+    if not path.exists():
+        raise ConfigError(f"Image {path} not found")
+    if info.encrypted and not info.key_path.exists():
+        raise ConfigError(f"Encrypted image key {info.key_path} not found")
+    return info
+
+
+def parse_size(text: str) -> int:
+    """Bytes in a size like "48G", "512M" or "1000", rounded up to whole MiB."""
+    units = {"K": 1024, "M": MIB, "G": GIB, "T": 1024 * GIB}
+    text = text.strip().upper().removesuffix("IB").removesuffix("B")
+    try:
+        n = float(text[:-1]) * units[text[-1]] if text[-1:] in units else float(text)
+    except (ValueError, IndexError) as e:
+        raise ConfigError(f"Invalid size {text!r}") from e
+    return -(-int(n) // MIB) * MIB
+
+
+def new_image_key() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def data_extents(fd: int, size: int, align: int = ALIGN) -> list[tuple[int, int]]:
+    """Data runs of a sparse file from SEEK_DATA/SEEK_HOLE, widened to *align*."""
+    runs: list[tuple[int, int]] = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole is left
+                break
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        start = start // align * align
+        end = min(-(-end // align) * align, size)
+        if runs and start <= runs[-1][0] + runs[-1][1]:
+            prev_start, _ = runs.pop()
+            start = prev_start
+        runs.append((start, end - start))
+        offset = end
+    return runs
+
+
+def create_image(path: Path, size: int, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Create an empty sparse image file of *size* bytes."""
+    if dry_run:
+        if log_fn:
+            log_fn(f"dry-run: create {format_bytes(size)} sparse image {path}")
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as f:
+        f.truncate(size)
+    if log_fn:
+        log_fn(f"Created {format_bytes(size)} sparse image {path}")
+
+
+def attach_loop(path: Path, size: int, dry_run: bool, log_fn: LogFn | None = None) -> DiskInfo:
+    """Attach *path* to a loop device with partition scanning."""
+    result = run_cmd(
+        ["losetup", "--find", "--show", "--partscan", str(path)],
+        dry_run=dry_run,
+        dry_label=f"losetup {path}",
+        log_fn=log_fn,
+    )
+    device = result.stdout.strip() or "/dev/loop0"
+    cleanup.register(CleanupAction.detach_loop(device))
+    return DiskInfo(device, format_bytes(size), size, "Golden image", False, False)
+
+
+def seal_image(
+    cfg: InstallConfig,
+    path: Path,
+    compress: bool,
+    hardware_config: str,
+    dry_run: bool,
+    log_fn: LogFn | None = None,
+) -> ImageInfo:
+    """Detach the built image, map its data extents, compress it and write the sidecar."""
+    assert cfg.host and cfg.disk
+    for mapper in (cfg.mapper, cfg.mapper2):
+        run_cmd(["cryptsetup", "close", mapper], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+    run_cmd(
+        ["losetup", "--detach", cfg.disk.device],
+        check=False, dry_run=dry_run, dry_label=f"losetup --detach {cfg.disk.device}", log_fn=log_fn,
+    )
+    cleanup.clear()
+    size = cfg.disk.size_bytes
+    extents: list[tuple[int, int]] = []
+    if not dry_run:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            extents = data_extents(fd, size)
+        finally:
+            os.close(fd)
+    info = ImageInfo(
+        path, cfg.host.name, cfg.user, cfg.encrypted, size, extents, hardware_config,
+        datetime.now().isoformat(timespec="seconds"),
+    )
+    if compress:
+        info.path = path.with_name(path.name + ".zst")
+        run_cmd(
+            ["zstd", "-T0", "-q", "-f", "--rm", str(path), "-o", str(info.path)],
+            dry_run=dry_run, dry_label=f"zstd {path}", log_fn=log_fn,
+        )
+    if dry_run:
+        if log_fn:
+            log_fn(f"dry-run: write {info.meta_path}")
+        return info
+    if cfg.encrypted and cfg.luks_password:
+        info.key_path.write_text(cfg.luks_password)
+        info.key_path.chmod(0o600)
+    info.save()
+    if log_fn:
+        log_fn(f"Image ready: {info.describe()}")
+    return info
+
+
+@contextmanager
+def _image_reader(info: ImageInfo) -> Iterator[Callable[[memoryview, int], None]]:
+    """Yield read(buf, offset), filling *buf* from the raw image at *offset*.
+
+    Offsets must not go backwards; compressed images are read as a stream.
+    """
+    if not info.compressed:
+        fd = os.open(info.path, os.O_RDONLY)
+
+        def pread(buf: memoryview, offset: int) -> None:
+            got = 0
+            while got < len(buf):
+                n = os.preadv(fd, [buf[got:]], offset + got)
+                if n == 0:
+                    raise StepError(f"{info.path} is shorter than its metadata says")
+                got += n
+
+        try:
+            yield pread
+        finally:
+            os.close(fd)
+        return
+
+    proc = subprocess.Popen(["zstd", "-dcq", str(info.path)], stdout=subprocess.PIPE)
+    assert proc.stdout is not None
+    stream = proc.stdout
+    pos = 0
+    scratch = bytearray(WRITE_BLOCK)
+
+    def read_exact(buf: memoryview) -> None:
+        got = 0
+        while got < len(buf):
+            n = stream.readinto(buf[got:])
+            if not n:
+                raise StepError(f"{info.path} ended early")
+            got += n
+
+    def sread(buf: memoryview, offset: int) -> None:
+        nonlocal pos
+        # Holes decompress to zeros; read past them
+        while pos < offset:
+            n = min(len(scratch), offset - pos)
+            read_exact(memoryview(scratch)[:n])
+            pos += n
+        read_exact(buf)
+        pos += len(buf)
+
+    try:
+        yield sread
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def _open_target(device: str) -> tuple[int, bool]:
+    """Open *device* for writing, with O_DIRECT where the filesystem allows it."""
+    flags = os.O_WRONLY | os.O_CLOEXEC
+    if not stat.S_ISBLK(os.stat(device).st_mode):
+        flags |= os.O_CREAT
+    try:
+        return os.open(device, flags | os.O_DIRECT), True
+    except OSError as e:
+        # tmpfs and some overlay filesystems reject O_DIRECT
+        if e.errno != errno.EINVAL:
+            raise
+        return os.open(device, flags), False
+
+
+def write_image(info: ImageInfo, device: str, dry_run: bool, block: int = WRITE_BLOCK) -> Iterator[str]:
+    """Copy the image's data extents to *device*, yielding progress lines.
+
+    Holes are skipped rather than written as zeros: nothing on the image
+    ever wrote there, so their contents on the target do not matter.
+    """
+    total = info.data_bytes
+    if dry_run:
+        yield f"dry-run: write {format_bytes(total)} of {info.path.name} to {device}"
+        return
+    log(f"$ write {info.path} -> {device}")
+    token = current_token()
+    fd, direct = _open_target(device)
+    # Anonymous mmaps are page-aligned, as O_DIRECT requires
+    buf = mmap.mmap(-1, block)
+    view = memoryview(buf)
+    done = 0
+    started = last = time.monotonic()
+    try:
+        with trace.span(f"write {device}", "cmd", bytes=total, direct=direct), _image_reader(info) as read:
+            for offset, length in info.extents:
+                end = offset + length
+                while offset < end:
+                    token.check()
+                    n = min(block, end - offset)
+                    chunk = view[:n]
+                    read(chunk, offset)
+                    # Runs of zeros inside a data extent are still written:
+                    # unlike holes, something on the image put them there
+                    written = 0
+                    while written < n:
+                        written += os.pwrite(fd, chunk[written:], offset + written)
+                    offset += n
+                    done += n
+                    now = time.monotonic()
+                    if now - last >= PROGRESS_INTERVAL:
+                        last = now
+                        rate = done / (now - started)
+                        yield f"Wrote {format_bytes(done)}/{format_bytes(total)} ({rate / MIB:.0f} MiB/s)"
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    yield f"Wrote {format_bytes(done)} to {device} in {elapsed:.0f}s ({done / elapsed / MIB:.0f} MiB/s)"
+
+
+def partitions(device: str, dry_run: bool) -> list[dict]:
+    """sfdisk's view of the partitions on *device* (node, start, size, type)."""
+    if dry_run:
+        # /dev/sda1, but /dev/nvme0n1p1 and /dev/loop0p1
+        prefix = f"{device}p" if device[-1:].isdigit() else device
+        return [
+            {"node": f"{prefix}1", "type": ESP_TYPE.upper()},
+            {"node": f"{prefix}2", "type": "0FC63DAF-8483-4772-8E79-3D69D8477DE4"},
+        ]
+    result = run_cmd(["sfdisk", "--json", device], capture=True)
+    return json.loads(result.stdout).get("partitiontable", {}).get("partitions", [])
+
+
+def grow_last_partition(device: str, dry_run: bool, log_fn: LogFn | None = None) -> str:
+    """Move the backup GPT to the end of *device* and grow the last partition into it.
+
+    Returns the grown partition's node.
+    """
+    run_cmd(
+        ["sfdisk", "--relocate", "gpt-bak-std", device],
+        dry_run=dry_run, dry_label=f"relocate backup GPT on {device}", log_fn=log_fn,
+    )
+    parts = partitions(device, dry_run)
+    if not parts:
+        raise StepError(f"No partitions on {device}")
+    last = parts[-1]["node"]
+    number = len(parts)
+    if dry_run:
+        if log_fn:
+            log_fn(f"dry-run: grow {last} to the end of {device}")
+    else:
+        proc = subprocess.run(
+            ["sfdisk", "--no-reread", "--no-tell-kernel", "-N", str(number), device],
+            input=", +\n", text=True, capture_output=True,
+        )
+        log(proc.stdout + proc.stderr)
+        if proc.returncode != 0:
+            raise StepError(f"Failed to grow {last}: {proc.stderr.strip()}")
+        run_cmd(["partx", "--update", device], log_fn=log_fn)
+        if log_fn:
+            log_fn(f"Grew {last} to the end of {device}")
+    return last
+
+
+def rekey_luks(
+    partition: str,
+    image_key: Path,
+    new_key: Path,
+    reencrypt: bool,
+    dry_run: bool,
+    log_fn: LogFn | None = None,
+) -> None:
+    """Replace the image's LUKS passphrase, and with *reencrypt* its volume key.
+
+    Every copy of an image shares its volume key; re-encryption gives each
+    disk its own, at the cost of rewriting the encrypted partition.
+    """
+    if reencrypt:
+        run_cmd(
+            ["cryptsetup", "reencrypt", "--batch-mode", "--key-file", str(image_key), partition],
+            dry_run=dry_run, dry_label=f"cryptsetup reencrypt {partition}", log_fn=log_fn,
+        )
+    run_cmd(
+        ["cryptsetup", "luksChangeKey", "--batch-mode", "--key-file", str(image_key), partition, str(new_key)],
+        dry_run=dry_run, dry_label=f"cryptsetup luksChangeKey {partition}", log_fn=log_fn,
+    )
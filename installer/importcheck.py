@@ -0,0 +1,127 @@
+"""Import-time regression check: ``python3 -m installer.importcheck``.
+
+Runs each entry path in a fresh interpreter under ``-X importtime`` and
+fails if it loads a module it must not (Textual on the --help and
+unattended paths, screens before they are pushed) or if its imports take
+longer than the budget. Budgets are for a warm page cache; scale them
+with --budget-scale on slow media.
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+
+from . import SCRIPT_DIR
+
+_LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+@dataclass
+class _Case:
+    name: str
+    args: list[str]
+    forbidden: tuple[str, ...]
+    budget_ms: float
+    # Skip the case when this module is not installed
+    needs: str | None = None
+
+
+CASES = [
+    _Case(
+        "--help",
+        ["-m", "installer", "--help"],
+        ("textual", "rich", "installer.runner", "installer.steps", "installer.discovery"),
+        budget_ms=80,
+    ),
+    _Case(
+        "unattended",
+        ["-c", "import installer.headless"],
+        ("textual", "rich", "installer.app", "installer.screens"),
+        budget_ms=250,
+    ),
+    _Case(
+        "app",
+        ["-c", "import installer.app"],
+        (
+            "installer.screens.preflight",
+            "installer.screens.wizard",
+            "installer.screens.install",
+            "installer.screens.completion",
+            "installer.steps",
+        ),
+        budget_ms=1000,
+        needs="textual",
+    ),
+]
+
+
+@dataclass
+class ImportTimes:
+    self_us: dict[str, int]
+
+    @property
+    def total_ms(self) -> float:
+        return sum(self.self_us.values()) / 1000
+
+    def loaded(self, name: str) -> bool:
+        """True if *name* or any of its submodules was imported."""
+        return any(m == name or m.startswith(name + ".") for m in self.self_us)
+
+    def slowest(self, n: int) -> list[tuple[str, int]]:
+        return sorted(self.self_us.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def parse_importtime(output: str) -> ImportTimes:
+    """Per-module self time (µs) from ``-X importtime`` stderr."""
+    times: dict[str, int] = {}
+    for line in output.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            times[m.group(4)] = int(m.group(1))
+    return ImportTimes(times)
+
+
+def measure(args: list[str]) -> ImportTimes:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=SCRIPT_DIR,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return parse_importtime(result.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check installer import time and lazy loading")
+    parser.add_argument("--budget-scale", type=float, default=1.0, metavar="FACTOR")
+    parser.add_argument("-v", "--verbose", action="store_true", help="List the slowest imports of each path")
+    args = parser.parse_args()
+
+    failed = False
+    for case in CASES:
+        if case.needs and importlib.util.find_spec(case.needs) is None:
+            print(f"skip {case.name}: {case.needs} not installed")
+            continue
+        times = measure(case.args)
+        budget = case.budget_ms * args.budget_scale
+        problems = [f"imports {name}" for name in case.forbidden if times.loaded(name)]
+        if times.total_ms > budget:
+            problems.append(f"over budget ({budget:.0f} ms)")
+        status = "FAIL" if problems else "ok"
+        detail = f" -- {'; '.join(problems)}" if problems else ""
+        print(f"{status:<4} {case.name}: {times.total_ms:.0f} ms{detail}")
+        if args.verbose or problems:
+            for name, us in times.slowest(5):
+                print(f"       {us / 1000:7.1f} ms  {name}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
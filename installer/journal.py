@@ -0,0 +1,110 @@
+"""Persisted record of completed install steps, used by --resume."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from .exceptions import ConfigError
+from .models import InstallConfig
+from .runner import LOG_FILE
+
+JOURNAL_FILE = LOG_FILE.with_suffix(".journal.json")
+FLEET_JOURNAL_FILE = LOG_FILE.with_suffix(".fleet-journal.json")
+
+
+def config_fingerprint(cfg: InstallConfig) -> str:
+    """Hash of the choices that shape the target (passwords excluded)."""
+    data = {
+        "host": cfg.host.name if cfg.host else None,
+        "disk": cfg.disk.device if cfg.disk else None,
+        "disk2": cfg.disk2.device if cfg.disk2 else None,
+        "dual_disk": cfg.dual_disk,
+        "encrypted": cfg.encrypted,
+        "update_flake": cfg.update_flake,
+        "user": cfg.user,
+    }
+    if cfg.refresh:
+        data["refresh"] = True
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def fleet_fingerprint(cfgs: list[InstallConfig]) -> str:
+    data = [[cfg.slot, config_fingerprint(cfg)] for cfg in cfgs]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()[:16]
+
+
+class StepJournal:
+    """Completed step keys for one InstallConfig, rewritten after every step.
+
+    A journal that does not *persist* (a dry run's) is kept in memory only:
+    a dry run must never leave a record a real --resume would trust.
+    """
+
+    def __init__(
+        self,
+        fingerprint: str,
+        completed: list[str] | None = None,
+        path: Path = JOURNAL_FILE,
+        persist: bool = True,
+    ) -> None:
+        self.fingerprint = fingerprint
+        self.completed = completed or []
+        self.path = path
+        self.persist = persist
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path = JOURNAL_FILE) -> StepJournal | None:
+        try:
+            data = json.loads(path.read_text())
+            return cls(data["fingerprint"], list(data["completed"]), path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def start(
+        cls, cfg: InstallConfig, resume: bool, path: Path = JOURNAL_FILE, dry_run: bool = False, strict: bool = False
+    ) -> StepJournal:
+        """Return the journal to continue (if *resume* and it matches *cfg*) or a fresh one.
+
+        A dry run may read the journal, to show what a resume would keep,
+        but never writes it. With *strict*, a resume that finds no matching
+        journal raises ConfigError instead of starting over (and leaves the
+        journal that is there alone).
+        """
+        return cls.for_fingerprint(config_fingerprint(cfg), resume, path, dry_run, strict)
+
+    @classmethod
+    def for_fingerprint(
+        cls, fingerprint: str, resume: bool, path: Path = JOURNAL_FILE, dry_run: bool = False, strict: bool = False
+    ) -> StepJournal:
+        if resume:
+            journal = cls.load(path)
+            if journal is not None and journal.fingerprint == fingerprint:
+                journal.persist = not dry_run
+                return journal
+            if strict:
+                raise ConfigError(
+                    f"--resume: {path} does not record an interrupted install of this configuration; "
+                    "run without --resume to start over"
+                )
+        journal = cls(fingerprint, path=path, persist=not dry_run)
+        journal.save()
+        return journal
+
+    def save(self) -> None:
+        if not self.persist:
+            return
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"fingerprint": self.fingerprint, "completed": self.completed}))
+        os.replace(tmp, self.path)
+
+    def mark_done(self, key: str) -> None:
+        with self._lock:
+            if key not in self.completed:
+                self.completed.append(key)
+            self.save()
@@ -0,0 +1,199 @@
+"""Memory governor: live-store sizing and memory-pressure response."""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from .models import InstallConfig
+from .nixsettings import nix_settings
+from .runner import LogFn, log, run_cmd
+from .swap import GIB, grow_swap, meminfo
+
+RW_STORE = Path("/nix/.rw-store")
+PSI_FILE = Path("/proc/pressure/memory")
+# Left to the kernel, the nix daemon and the UI when sizing the tmpfs
+STORE_RESERVE = 2 * GIB
+MIN_STORE = 4 * GIB
+SAMPLE_INTERVAL = 2.0
+# Time to let an action take effect before acting again
+COOLDOWN = 30.0
+# avg10 share of time in which *all* tasks stalled on memory
+PSI_FULL_LIMIT = 10.0
+LOW_AVAILABLE = 512 * 1024 * 1024
+STORE_FULL = 0.9
+SWAP_STEP = 4 * GIB
+MAX_EXTRA_SWAP = 16 * GIB
+
+_PSI_RE = re.compile(r"(some|full) avg10=([\d.]+)")
+
+
+@dataclass
+class MemorySample:
+    available: int
+    some_avg10: float | None
+    full_avg10: float | None
+    store_used: int
+    store_size: int
+
+
+def read_psi(path: Path = PSI_FILE) -> dict[str, float]:
+    """avg10 of the "some" and "full" lines of a PSI file (empty without PSI)."""
+    try:
+        return {kind: float(value) for kind, value in _PSI_RE.findall(path.read_text())}
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_usage(path: Path = RW_STORE) -> tuple[int, int]:
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0, 0
+    size = st.f_blocks * st.f_frsize
+    return size - st.f_bfree * st.f_frsize, size
+
+
+def sample_memory() -> MemorySample:
+    psi = read_psi()
+    used, size = _store_usage()
+    return MemorySample(
+        available=meminfo().get("MemAvailable", 0),
+        some_avg10=psi.get("some"),
+        full_avg10=psi.get("full"),
+        store_used=used,
+        store_size=size,
+    )
+
+
+def rw_store_size(mem: dict[str, int] | None = None) -> int:
+    """tmpfs limit for the live store: RAM plus swap, minus a reserve.
+
+    A bigger limit only turns ENOSPC into an OOM kill, and a smaller one
+    needlessly fails closures that would fit, so track what can back it.
+    """
+    mem = mem if mem is not None else meminfo()
+    budget = mem.get("MemTotal", 0) + mem.get("SwapTotal", 0) - STORE_RESERVE
+    return max(MIN_STORE, budget // GIB * GIB)
+
+
+def resize_store(size: int, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    gib = size // GIB
+    run_cmd(
+        ["mount", "-o", f"remount,size={gib}G", str(RW_STORE)],
+        dry_run=dry_run,
+        dry_label=f"resize {RW_STORE} to {gib}G",
+        log_fn=log_fn,
+    )
+
+
+class MemoryGovernor:
+    """Watches memory pressure while nix builds and backs off before an OOM.
+
+    In order of preference it grows the live store when it fills up, adds
+    swap when memory runs short, and finally lowers max-jobs/cores in
+    nix_settings and sets ``throttle`` so the build loop restarts nix with
+    them. Nix settings cannot change on a running build, but realised
+    paths survive the restart.
+    """
+
+    def __init__(self, cfg: InstallConfig, dry_run: bool, interval: float = SAMPLE_INTERVAL) -> None:
+        self.cfg = cfg
+        self.dry_run = dry_run
+        self.interval = interval
+        self.throttle = threading.Event()
+        self._extra_swap = 0
+        self._last_action = 0.0
+        self._users = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._log_fn: LogFn | None = None
+
+    @contextmanager
+    def watch(self, log_fn: LogFn) -> Iterator[None]:
+        """Monitor while the block runs; nested/concurrent users share one thread."""
+        with self._lock:
+            self._users += 1
+            self._log_fn = log_fn
+            if self._thread is None and not self.dry_run:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="memgov", daemon=True)
+                self._thread.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._users -= 1
+                thread = self._thread if self._users == 0 else None
+                if thread is not None:
+                    self._thread = None
+                    self._stop.set()
+            if thread is not None:
+                thread.join()
+
+    def _say(self, msg: str) -> None:
+        log(msg)
+        if self._log_fn:
+            self._log_fn(f"[yellow]{msg}[/yellow]")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick(sample_memory())
+            except Exception as e:
+                log(f"memory governor: {e}")
+
+    def tick(self, s: MemorySample) -> None:
+        """React to one sample; at most one action per COOLDOWN."""
+        now = time.monotonic()
+        if now - self._last_action < COOLDOWN:
+            return
+        if s.store_size and s.store_used > s.store_size * STORE_FULL:
+            limit = rw_store_size()
+            if limit > s.store_size:
+                self._say(f"Live store {s.store_used / GIB:.1f}/{s.store_size / GIB:.0f}G full, growing it")
+                resize_store(limit, self.dry_run)
+                self._last_action = now
+                return
+        pressured = (s.full_avg10 is not None and s.full_avg10 >= PSI_FULL_LIMIT) or s.available < LOW_AVAILABLE
+        if not pressured:
+            return
+        self._last_action = now
+        if self._extra_swap < MAX_EXTRA_SWAP and grow_swap(self.cfg, SWAP_STEP, self.dry_run, self._log_fn):
+            self._extra_swap += SWAP_STEP
+            # The new swap can back a larger live store too
+            resize_store(rw_store_size(), self.dry_run)
+            return
+        self._reduce_parallelism()
+
+    def _reduce_parallelism(self) -> None:
+        ncpu = os.cpu_count() or 1
+        jobs = _int_setting("max-jobs", ncpu)
+        cores = _int_setting("cores", ncpu)
+        if jobs > 1 and not nix_settings.overridden("max-jobs"):
+            nix_settings.set("max-jobs", str(jobs // 2))
+        elif cores > 1 and not nix_settings.overridden("cores"):
+            nix_settings.set("cores", str(cores // 2))
+        else:
+            self._say("Memory pressure persists; build parallelism cannot be reduced further")
+            return
+        self._say(f"Memory pressure: restarting build with {nix_settings.describe(('max-jobs', 'cores'))}")
+        self.throttle.set()
+
+
+def _int_setting(name: str, ncpu: int) -> int:
+    """Numeric value of a parallelism setting ("auto" and 0 mean all CPUs)."""
+    value = nix_settings.get(name)
+    if value is None or value == "auto":
+        return ncpu
+    try:
+        return int(value) or ncpu
+    except ValueError:
+        return ncpu
@@ -13,9 +13,12 @@ class HostInfo:
     has_docker: bool = False
     has_fprintd: bool = False
     is_iso: bool = False
+    eval_failed: bool = False
 
     @property
     def description(self) -> str:
+        if self.eval_failed:
+            return "[red]evaluation failed[/red]"
         role = "Desktop" if self.is_desktop else "Server"
         tags: list[str] = []
         if self.has_nvidia:
@@ -28,6 +31,14 @@ class HostInfo:
         return f"{role}{suffix}"
 
 
+@dataclass
+class DiskBenchmark:
+    seq_read: float | None = None
+    rand_read_iops: float | None = None
+    healthy: bool | None = None
+    error: str | None = None
+
+
 @dataclass
 class DiskInfo:
     device: str
@@ -36,6 +47,7 @@ class DiskInfo:
     model: str
     is_removable: bool
     is_boot_disk: bool
+    benchmark: DiskBenchmark | None = None
 
 
 @dataclass
@@ -49,6 +61,29 @@ class InstallConfig:
     user_password: str | None = None
     update_flake: bool = False
     user: str = "fobos"
+    closure_bytes: int | None = None
+    # Reuse the existing layout, /nix and /home; only the root subvolume is reset
+    refresh: bool = False
+    # Position in a fleet install; None for a single-target install
+    slot: int | None = None
+
+    @property
+    def root(self) -> str:
+        """Mount point of the target; fleet targets each get their own."""
+        return "/mnt" if self.slot is None else f"/mnt-{self.slot}"
+
+    @property
+    def mapper(self) -> str:
+        return "crypted" if self.slot is None else f"crypted-{self.slot}"
+
+    @property
+    def mapper2(self) -> str:
+        return "crypted2" if self.slot is None else f"crypted2-{self.slot}"
+
+    @property
+    def name(self) -> str:
+        host = self.host.name if self.host else "?"
+        return host if self.slot is None else f"{self.slot}:{host}"
 
 
 @dataclass
@@ -56,3 +91,5 @@ class PreflightResult:
     checks: list[tuple[str, bool, bool]] = field(default_factory=list)
     has_net: bool = False
     any_fatal: bool = False
+    substituters: list[str] = field(default_factory=list)
+    throughput: float | None = None
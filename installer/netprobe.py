@@ -0,0 +1,217 @@
+"""Network throughput probe and closure download estimate."""
+
+from __future__ import annotations
+
+import re
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from .exceptions import CommandError
+from .nixsettings import nix_settings
+from .steps import eval_flake, toplevel_attr
+from .substituters import DEFAULT_SUBSTITUTER
+
+PROBE_TIMEOUT = 3.0
+DOWNLOAD_BUDGET = 3.0
+MAX_SAMPLE_BYTES = 8 * 1024 * 1024
+NARINFO_CANDIDATES = 8
+# Below this the install will be slow enough to be worth a warning
+SLOW_THROUGHPUT = 1024 * 1024
+DRY_RUN_TIMEOUT = 300
+
+MIB = 1024 * 1024
+_UNITS = {"B": 1, "KiB": 1024, "MiB": MIB, "GiB": 1024 * MIB, "TiB": 1024 * 1024 * MIB}
+_SIZE_RE = re.compile(r"\(([\d.]+) ([KMGT]?i?B) download, ([\d.]+) ([KMGT]?i?B) unpacked")
+
+
+@dataclass
+class NetworkProbe:
+    endpoint: str
+    dns: float | None = None
+    connect: float | None = None
+    throughput: float | None = None
+    sampled_bytes: int = 0
+    error: str | None = None
+
+    @property
+    def reachable(self) -> bool:
+        return self.connect is not None
+
+    @property
+    def slow(self) -> bool:
+        return self.throughput is not None and self.throughput < SLOW_THROUGHPUT
+
+
+@dataclass
+class DownloadEstimate:
+    download_bytes: int
+    throughput: float | None
+    unpacked_bytes: int = 0
+
+    @property
+    def seconds(self) -> float | None:
+        if not self.throughput:
+            return None
+        return self.download_bytes / self.throughput
+
+    def describe(self) -> str:
+        if self.download_bytes == 0:
+            return "nothing to fetch"
+        size = f"{self.download_bytes / MIB:.0f} MiB"
+        if self.download_bytes >= 1024 * MIB:
+            size = f"{self.download_bytes / (1024 * MIB):.1f} GiB"
+        if self.seconds is None:
+            return f"~{size}"
+        minutes, secs = divmod(int(self.seconds), 60)
+        eta = f"{minutes}m{secs:02d}s" if minutes else f"{secs}s"
+        return f"~{size}, ~{eta} at {self.throughput / MIB:.1f} MiB/s"
+
+
+def _fetch_narinfo(base: str, path: str, timeout: float) -> tuple[str, int] | None:
+    """(NAR url, compressed size) from *path*'s narinfo, or None if absent."""
+    name = path.rsplit("/", 1)[-1].split("-", 1)[0]
+    try:
+        with urllib.request.urlopen(f"{base}/{name}.narinfo", timeout=timeout) as resp:
+            text = resp.read().decode(errors="replace")
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+    fields = dict(line.split(": ", 1) for line in text.splitlines() if ": " in line)
+    try:
+        return f"{base}/{fields['URL']}", int(fields.get("FileSize", "0"))
+    except (KeyError, ValueError):
+        return None
+
+
+def _measure_download(url: str, timeout: float, budget: float, max_bytes: int) -> tuple[int, float]:
+    """Download up to *max_bytes* of *url* within *budget* seconds; (bytes, seconds)."""
+    received = 0
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        # Time from the first body byte: latency is measured separately
+        start = time.monotonic()
+        while received < max_bytes and time.monotonic() - start < budget:
+            chunk = resp.read(64 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+        return received, time.monotonic() - start
+
+
+def probe_reachability(endpoint: str = DEFAULT_SUBSTITUTER, timeout: float = PROBE_TIMEOUT) -> NetworkProbe:
+    """Measure DNS and TCP connect latency to a binary cache.
+
+    Cheap and bounded by *timeout* per stage, so reachability is known
+    before (and independently of) any throughput measurement.
+    """
+    probe = NetworkProbe(endpoint)
+    parsed = urlparse(endpoint)
+    host = parsed.hostname or ""
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+
+    start = time.monotonic()
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        probe.error = f"DNS: {e}"
+        return probe
+    probe.dns = time.monotonic() - start
+
+    family, kind, proto, _, addr = infos[0]
+    start = time.monotonic()
+    try:
+        with socket.socket(family, kind, proto) as sock:
+            sock.settimeout(timeout)
+            sock.connect(addr)
+    except OSError as e:
+        probe.error = f"connect: {e}"
+        return probe
+    probe.connect = time.monotonic() - start
+    return probe
+
+
+def measure_throughput(
+    probe: NetworkProbe,
+    paths: list[str] | None,
+    timeout: float = PROBE_TIMEOUT,
+    budget: float = DOWNLOAD_BUDGET,
+    max_bytes: int = MAX_SAMPLE_BYTES,
+) -> NetworkProbe:
+    """Fill in *probe*'s download throughput against its endpoint.
+
+    Throughput comes from fetching the largest NAR among the narinfos of
+    *paths* (store paths the cache is expected to have), capped at
+    *max_bytes* or *budget* seconds. A failure sets ``error`` but leaves
+    reachability alone.
+    """
+    base = probe.endpoint.split("?", 1)[0].rstrip("/")
+    candidates = (paths or [])[:NARINFO_CANDIDATES]
+    with ThreadPoolExecutor(max_workers=max(1, len(candidates))) as pool:
+        nars = [n for n in pool.map(lambda p: _fetch_narinfo(base, p, timeout), candidates) if n]
+    if not nars:
+        probe.error = "no sample NAR found"
+        return probe
+    url, _ = max(nars, key=lambda n: n[1])
+    try:
+        received, elapsed = _measure_download(url, timeout, budget, max_bytes)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        probe.error = f"download: {e}"
+        return probe
+    probe.sampled_bytes = received
+    if elapsed > 0 and received:
+        probe.throughput = received / elapsed
+    return probe
+
+
+def probe_network(
+    endpoint: str = DEFAULT_SUBSTITUTER,
+    paths: list[str] | None = None,
+    timeout: float = PROBE_TIMEOUT,
+    budget: float = DOWNLOAD_BUDGET,
+    max_bytes: int = MAX_SAMPLE_BYTES,
+) -> NetworkProbe:
+    """Measure DNS, TCP connect and download throughput against a binary cache."""
+    probe = probe_reachability(endpoint, timeout)
+    if not probe.reachable:
+        return probe
+    return measure_throughput(probe, paths, timeout, budget, max_bytes)
+
+
+def _to_bytes(value: str, unit: str) -> int:
+    return int(float(value) * _UNITS.get(unit, 1))
+
+
+def parse_closure_size(output: str) -> tuple[int, int] | None:
+    """(download, unpacked) bytes according to ``nix build --dry-run`` output."""
+    m = _SIZE_RE.search(output)
+    if not m:
+        return None
+    return _to_bytes(m.group(1), m.group(2)), _to_bytes(m.group(3), m.group(4))
+
+
+def closure_size(host: str) -> tuple[int, int] | None:
+    """(download, unpacked) bytes nix still needs to fetch for *host*'s toplevel.
+
+    Returns (0, 0) if everything is already in the store, None if unknown,
+    including when the closure has to be built locally rather than fetched.
+    """
+    try:
+        result = subprocess.run(
+            ["nix", "build", "--dry-run", "--accept-flake-config", toplevel_attr(host, eval_flake())],
+            capture_output=True,
+            text=True,
+            env=nix_settings.env(),
+            timeout=DRY_RUN_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired, CommandError):
+        return None
+    if result.returncode != 0:
+        return None
+    size = parse_closure_size(result.stderr)
+    if size is None and "will be fetched" not in result.stderr and "will be built" not in result.stderr:
+        return 0, 0
+    return size
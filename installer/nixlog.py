@@ -0,0 +1,199 @@
+"""Parser for nix's ``--log-format internal-json`` output."""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+NIX_JSON_LOG = ["--log-format", "internal-json"]
+
+# Activity and result types from nix's libutil/logging.hh
+ACT_FILE_TRANSFER = 101
+ACT_BUILDS = 104
+
+RES_BUILD_LOG_LINE = 101
+RES_PROGRESS = 105
+RES_SET_EXPECTED = 106
+
+LVL_ERROR = 0
+LVL_WARN = 1
+LVL_INFO = 3
+
+RATE_WINDOW = 10.0
+
+_ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+
+@dataclass
+class _Activity:
+    type: int
+    done: int = 0
+    expected: int = 0
+    running: int = 0
+    expected_by_type: dict[int, int] = field(default_factory=dict)
+
+
+@dataclass
+class ProgressSnapshot:
+    label: str = ""
+    builds_done: int = 0
+    builds_expected: int = 0
+    builds_running: int = 0
+    bytes_done: int = 0
+    bytes_expected: int = 0
+    rate: float = 0.0
+    idle: float = 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds until the expected download completes at the current rate."""
+        if self.rate <= 0 or self.bytes_expected <= self.bytes_done:
+            return None
+        return (self.bytes_expected - self.bytes_done) / self.rate
+
+
+class NixProgress:
+    """Aggregated build/download progress of the current nix command.
+
+    Updated by the thread parsing nix output, read by the UI via snapshot().
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset("")
+
+    def reset(self, label: str) -> None:
+        with self._lock:
+            self._label = label
+            self._acts: dict[int, _Activity] = {}
+            self._finished_done: dict[int, int] = {}
+            self._expected: dict[int, int] = {}
+            self._samples: deque[tuple[float, int]] = deque()
+            self._last_change = time.monotonic()
+            self._active = bool(label)
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def finish(self) -> None:
+        with self._lock:
+            self._active = False
+
+    def _done(self, act_type: int) -> int:
+        running = sum(a.done for a in self._acts.values() if a.type == act_type)
+        return self._finished_done.get(act_type, 0) + running
+
+    def _total(self, act_type: int) -> int:
+        pending = sum(max(0, a.expected - a.done) for a in self._acts.values() if a.type == act_type)
+        return max(self._expected.get(act_type, 0), self._done(act_type) + pending)
+
+    def _touch(self) -> None:
+        now = time.monotonic()
+        self._last_change = now
+        self._samples.append((now, self._done(ACT_FILE_TRANSFER)))
+        while self._samples and now - self._samples[0][0] > RATE_WINDOW:
+            self._samples.popleft()
+
+    def start(self, act_id: int, act_type: int) -> None:
+        with self._lock:
+            self._acts[act_id] = _Activity(act_type)
+            self._touch()
+
+    def stop(self, act_id: int) -> None:
+        with self._lock:
+            act = self._acts.pop(act_id, None)
+            if act is None:
+                return
+            self._finished_done[act.type] = self._finished_done.get(act.type, 0) + act.done
+            for t, n in act.expected_by_type.items():
+                self._expected[t] = self._expected.get(t, 0) - n
+            self._touch()
+
+    def progress(self, act_id: int, done: int, expected: int, running: int) -> None:
+        with self._lock:
+            act = self._acts.get(act_id)
+            if act is None:
+                return
+            act.done, act.expected, act.running = done, expected, running
+            self._touch()
+
+    def set_expected(self, act_id: int, act_type: int, expected: int) -> None:
+        with self._lock:
+            act = self._acts.get(act_id)
+            if act is None:
+                return
+            previous = act.expected_by_type.get(act_type, 0)
+            act.expected_by_type[act_type] = expected
+            self._expected[act_type] = self._expected.get(act_type, 0) + expected - previous
+            self._touch()
+
+    def snapshot(self) -> ProgressSnapshot:
+        with self._lock:
+            rate = 0.0
+            if len(self._samples) >= 2:
+                (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+                if t1 > t0:
+                    rate = (b1 - b0) / (t1 - t0)
+            return ProgressSnapshot(
+                label=self._label,
+                builds_done=self._done(ACT_BUILDS),
+                builds_expected=self._total(ACT_BUILDS),
+                builds_running=sum(a.running for a in self._acts.values() if a.type == ACT_BUILDS),
+                bytes_done=self._done(ACT_FILE_TRANSFER),
+                bytes_expected=self._total(ACT_FILE_TRANSFER),
+                rate=rate,
+                idle=time.monotonic() - self._last_change,
+            )
+
+
+class NixLogParser:
+    """Turns internal-json lines into progress updates and readable log lines.
+
+    feed() returns the text to log for a line, or None for pure progress
+    events. Lines that are not nix JSON (e.g. from nixos-install's own
+    shell code) pass through unchanged.
+    """
+
+    def __init__(self, progress: NixProgress, label: str) -> None:
+        self.progress = progress
+        progress.reset(label)
+
+    def feed(self, line: str) -> str | None:
+        if not line.startswith("@nix "):
+            return line
+        try:
+            event = json.loads(line[5:])
+        except json.JSONDecodeError:
+            return line
+        action = event.get("action")
+        if action == "start":
+            self.progress.start(event["id"], event.get("type", 0))
+            text = _ANSI.sub("", event.get("text", ""))
+            if text and event.get("level", LVL_INFO) <= LVL_INFO:
+                return text
+        elif action == "stop":
+            self.progress.stop(event["id"])
+        elif action == "result":
+            fields = event.get("fields", [])
+            rtype = event.get("type")
+            if rtype == RES_PROGRESS and len(fields) >= 4:
+                self.progress.progress(event["id"], fields[0], fields[1], fields[2])
+            elif rtype == RES_SET_EXPECTED and len(fields) >= 2:
+                self.progress.set_expected(event["id"], fields[0], fields[1])
+            elif rtype == RES_BUILD_LOG_LINE and fields:
+                return _ANSI.sub("", str(fields[0]))
+        elif action == "msg":
+            msg = _ANSI.sub("", event.get("msg", ""))
+            level = event.get("level", LVL_INFO)
+            if level == LVL_ERROR:
+                return f"[red]{msg}[/red]"
+            if level == LVL_WARN:
+                return f"[yellow]{msg}[/yellow]"
+            if level <= LVL_INFO:
+                return msg
+        return None
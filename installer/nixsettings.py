@@ -0,0 +1,113 @@
+"""Nix settings shared by every nix invocation of the installer."""
+
+from __future__ import annotations
+
+import math
+import os
+import threading
+
+GIB = 1024 ** 3
+MIB = 1024 * 1024
+
+BASE_SETTINGS = {
+    "experimental-features": "nix-command flakes",
+    "download-buffer-size": "1073741824",
+}
+# Rough peak memory of one build job; bounds max-jobs on small machines
+MEM_PER_JOB = 2 * GIB
+MEM_RESERVE = 2 * GIB
+
+
+class NixSettings:
+    """nix.conf settings passed to child processes through NIX_CONFIG.
+
+    Values set with override() (the --nix-option passthrough) win over
+    anything the installer derives or changes later.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: dict[str, str] = dict(BASE_SETTINGS)
+        self._overrides: dict[str, str] = {}
+
+    def set(self, name: str, value: str) -> bool:
+        """Set *name* unless the user overrode it; returns whether it took effect."""
+        with self._lock:
+            self._values[name] = value
+            return name not in self._overrides
+
+    def update(self, values: dict[str, str]) -> None:
+        for name, value in values.items():
+            self.set(name, value)
+
+    def override(self, name: str, value: str) -> None:
+        with self._lock:
+            self._overrides[name] = value
+
+    def overridden(self, name: str) -> bool:
+        with self._lock:
+            return name in self._overrides
+
+    def get(self, name: str) -> str | None:
+        with self._lock:
+            return self._overrides.get(name, self._values.get(name))
+
+    def items(self) -> dict[str, str]:
+        with self._lock:
+            return {**self._values, **self._overrides}
+
+    def env(self) -> dict[str, str]:
+        config = "\n".join(f"{name} = {value}" for name, value in self.items().items())
+        return {**os.environ, "NIX_CONFIG": config}
+
+    def describe(self, names: tuple[str, ...]) -> str:
+        values = self.items()
+        return ", ".join(f"{name}={values[name]}" for name in names if name in values)
+
+
+nix_settings = NixSettings()
+
+TUNED = ("max-jobs", "cores", "http-connections", "max-substitution-jobs")
+
+
+def autotune(ncpu: int, mem_total: int, throughput: float | None) -> dict[str, str]:
+    """Derive build and download parallelism from the machine.
+
+    A few jobs with several cores each suit an install (mostly
+    substitution, plus a handful of large builds like the kernel) better
+    than one job per core. Memory caps the job count. Fast links gain
+    from more parallel connections, slow ones only thrash.
+    """
+    ncpu = max(1, ncpu)
+    mem_jobs = max(1, (mem_total - MEM_RESERVE) // MEM_PER_JOB)
+    max_jobs = max(1, min(round(math.sqrt(ncpu)), mem_jobs))
+    cores = max(1, ncpu // max_jobs)
+
+    if throughput is None:
+        connections = 25
+    elif throughput < 2 * MIB:
+        connections = 8
+    elif throughput < 50 * MIB:
+        connections = 25
+    elif throughput < 100 * MIB:
+        connections = 64
+    else:
+        connections = 128
+    substitution_jobs = 4 if connections <= 8 else min(64, max(16, ncpu * 2))
+
+    return {
+        "max-jobs": str(max_jobs),
+        "cores": str(cores),
+        "http-connections": str(connections),
+        "max-substitution-jobs": str(substitution_jobs),
+    }
+
+
+def substituter_settings(substituters: list[str], trusted_public_keys: list[str]) -> dict[str, str]:
+    """Settings for the substituters chosen in preflight."""
+    values: dict[str, str] = {}
+    if substituters:
+        values["substituters"] = " ".join(substituters)
+    if trusted_public_keys:
+        values["extra-trusted-public-keys"] = " ".join(trusted_public_keys)
+    return values
@@ -0,0 +1,204 @@
+"""Dependency-graph scheduler for installation steps."""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from .exceptions import Cancelled, StepError
+from .journal import StepJournal
+from .runner import CancelToken, LogFn, bind_token, flush_log, log, root_token
+from .telemetry import trace
+
+
+class StepState:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    RESUMED = "resumed"
+
+
+@dataclass
+class Step:
+    """A unit of install work.
+
+    A step becomes runnable once every resource in *needs* has been produced
+    by the steps that declare it in *provides*. Resources whose providers are
+    all disabled count as available. A failing *optional* step still releases
+    its resources so the steps after it can do the work themselves.
+
+    *verify* checks that the step's effect is still in place; only steps
+    that have one can be skipped when resuming from a journal.
+    """
+
+    key: str
+    label: str
+    run: Callable[[LogFn], None]
+    needs: tuple[str, ...] = ()
+    provides: tuple[str, ...] = ()
+    enabled: bool = True
+    optional: bool = False
+    verify: Callable[[], bool] | None = None
+
+
+StateFn = Callable[[Step, str], None]
+
+
+class Pipeline:
+    """Runs steps on a thread pool as soon as their inputs are ready.
+
+    Every step runs under the pipeline's cancel token (a child of the
+    process-wide root token that Ctrl-C cancels). cancel() stops scheduling,
+    terminates the commands of running steps and makes run() raise Cancelled
+    once they have wound down.
+    """
+
+    def __init__(
+        self,
+        steps: list[Step],
+        *,
+        max_workers: int = 4,
+        on_state: StateFn | None = None,
+        journal: StepJournal | None = None,
+        token: CancelToken | None = None,
+    ) -> None:
+        self.steps = steps
+        self.max_workers = max_workers
+        self.on_state = on_state
+        self.journal = journal
+        self.token = token or CancelToken(parent=root_token)
+        self._lock = threading.Lock()
+        self._running: set[str] = set()
+        self._providers: dict[str, list[Step]] = {}
+        for step in steps:
+            for res in step.provides:
+                self._providers.setdefault(res, []).append(step)
+        for step in steps:
+            for res in step.needs:
+                if res not in self._providers:
+                    raise ValueError(f"Step {step.key!r} needs {res!r}, which no step provides")
+
+    def resumable(self) -> set[str]:
+        """Journaled steps whose effect still verifies and whose inputs are kept too."""
+        if self.journal is None:
+            return set()
+        candidates = [
+            s for s in self.steps
+            if s.enabled and s.verify is not None and s.key in self.journal.completed
+        ]
+        kept: set[str] = set()
+        changed = True
+        while changed:
+            changed = False
+            for step in candidates:
+                if step.key in kept:
+                    continue
+                inputs_kept = all(
+                    p.key in kept or not p.enabled
+                    for res in step.needs
+                    for p in self._providers[res]
+                )
+                if inputs_kept and step.verify():
+                    kept.add(step.key)
+                    changed = True
+        return kept
+
+    def cancel(self) -> None:
+        """Abort the run; safe to call from any thread."""
+        self.token.cancel()
+
+    def _emit(self, step: Step, state: str) -> None:
+        if self.on_state:
+            self.on_state(step, state)
+
+    def _step_log(self, step: Step, log_fn: LogFn) -> LogFn:
+        """Prefix lines with the step key while other steps run alongside it."""
+
+        def write(line: str) -> None:
+            with self._lock:
+                concurrent = len(self._running) > 1
+            log_fn(f"[dim]{step.key}:[/dim] {line}" if concurrent else line)
+
+        return write
+
+    def _execute(self, step: Step, log_fn: LogFn) -> None:
+        with self._lock:
+            self._running.add(step.key)
+        log(f"== {step.label}")
+        try:
+            with bind_token(self.token), trace.span(step.label, "step", key=step.key):
+                self.token.check()
+                step.run(self._step_log(step, log_fn))
+                # A step that returns after an abort may have stopped short
+                self.token.check()
+        finally:
+            with self._lock:
+                self._running.discard(step.key)
+            flush_log(fsync=True)
+
+    def run(self, log_fn: LogFn, resumed: set[str] | None = None) -> None:
+        """Run all enabled steps, raising the first non-optional failure.
+
+        *resumed* is a resumable() result the caller already has; the verify
+        probes are not free, so they are not run a second time.
+        """
+        finished: set[str] = set()
+        pending: list[Step] = []
+        if resumed is None:
+            resumed = self.resumable()
+        for step in self.steps:
+            if not step.enabled:
+                finished.add(step.key)
+                self._emit(step, StepState.SKIPPED)
+            elif step.key in resumed:
+                finished.add(step.key)
+                self._emit(step, StepState.RESUMED)
+            else:
+                pending.append(step)
+
+        def ready(step: Step) -> bool:
+            return all(
+                p.key in finished
+                for res in step.needs
+                for p in self._providers[res]
+            )
+
+        error: BaseException | None = None
+        futures: dict[Future[None], Step] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="step") as pool:
+            while pending or futures:
+                if error is None and not self.token.cancelled:
+                    for step in [s for s in pending if ready(s)]:
+                        pending.remove(step)
+                        self._emit(step, StepState.RUNNING)
+                        futures[pool.submit(self._execute, step, log_fn)] = step
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    step = futures.pop(fut)
+                    exc = fut.exception()
+                    if exc is None:
+                        finished.add(step.key)
+                        if self.journal is not None:
+                            self.journal.mark_done(step.key)
+                        self._emit(step, StepState.DONE)
+                    elif step.optional and not isinstance(exc, Cancelled):
+                        log_fn(f"[yellow]{step.label} failed ({exc}); continuing without it[/yellow]")
+                        finished.add(step.key)
+                        self._emit(step, StepState.FAILED)
+                    else:
+                        self._emit(step, StepState.FAILED)
+                        if error is None:
+                            error = exc
+
+        # After an abort, failures of the steps it cut short are just noise
+        self.token.check()
+        if error is not None:
+            raise error
+        if pending:
+            raise StepError(f"Unsatisfiable step dependencies: {', '.join(s.key for s in pending)}")
@@ -0,0 +1,95 @@
+"""Background prefetch of a host's system closure during the wizard."""
+
+from __future__ import annotations
+
+import queue
+import threading
+
+from .exceptions import Cancelled
+from .nixlog import NixProgress
+from .runner import CancelToken, LogFn, bind_token, log, root_token
+from .steps import expand_store, prebuild_closure
+
+_DONE = object()
+
+
+class ClosurePrefetch:
+    """Builds the selected host's toplevel while the user answers the wizard.
+
+    Nothing here touches the target disks: the closure is realised in the
+    live store only, so the later install step finds most paths present.
+    """
+
+    def __init__(self, dry_run: bool, progress: NixProgress | None = None) -> None:
+        self.dry_run = dry_run
+        self.progress = progress
+        self.host: str | None = None
+        self.error: BaseException | None = None
+        self._thread: threading.Thread | None = None
+        self._token = CancelToken(parent=root_token)
+        self._lines: queue.Queue[object] = queue.Queue()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, host: str) -> None:
+        """Start prefetching *host*, replacing any prefetch for another host."""
+        if host == self.host:
+            return
+        self.cancel()
+        self.host = host
+        self.error = None
+        self._token = CancelToken(parent=root_token)
+        self._lines = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(host, self._token, self._lines),
+            name=f"prefetch-{host}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def cancel(self, timeout: float = 5.0) -> None:
+        """Stop the current prefetch and terminate its nix process group."""
+        self._token.cancel()
+        if self._thread is not None and timeout > 0:
+            self._thread.join(timeout)
+        self._thread = None
+        self.host = None
+
+    def _run(self, host: str, token: CancelToken, lines: queue.Queue[object]) -> None:
+        log(f"Prefetching closure for {host}")
+        try:
+            with bind_token(token):
+                expand_store(self.dry_run, log_fn=lines.put)
+                gen = prebuild_closure(host, self.dry_run, self.progress)
+                try:
+                    for line in gen:
+                        if token.cancelled:
+                            break
+                        lines.put(line)
+                finally:
+                    gen.close()
+            if token.cancelled:
+                log(f"Prefetch for {host} cancelled")
+        except Cancelled:
+            log(f"Prefetch for {host} cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            lines.put(_DONE)
+
+    def wait(self, log_fn: LogFn) -> None:
+        """Forward prefetch output to *log_fn* until it finishes; re-raise its error."""
+        thread, lines = self._thread, self._lines
+        if thread is None:
+            return
+        while True:
+            item = lines.get()
+            if item is _DONE:
+                break
+            log_fn(str(item))
+        thread.join()
+        if self.error is not None:
+            raise self.error
@@ -3,12 +3,58 @@
 from __future__ import annotations
 
 import os
+import queue
 import re
 import subprocess
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from typing import TypeVar
+from urllib.parse import urlparse
 
 from .models import PreflightResult
-from .runner import NIX_ENV
+from .netprobe import MIB, NetworkProbe, measure_throughput, probe_reachability
+from .nixsettings import TUNED, autotune, nix_settings, substituter_settings
+from .runner import log
+from .swap import meminfo
+from .substituters import (
+    DEFAULT_SUBSTITUTER,
+    SubstituterProbe,
+    probe_substituter,
+    rank_substituters,
+    sample_store_paths,
+)
+
+CHECK_TIMEOUT = 2.0
+NETWORK_TIMEOUT = 10.0
+# Store path sampling plus narinfo fetches plus the download budget
+THROUGHPUT_TIMEOUT = 25.0
+FLAKES_TIMEOUT = 10.0
+CACHE_TIMEOUT = 20.0
+
+# (label, passed, fatal); passed is None while the check is still running
+CheckRow = tuple[str, bool | None, bool]
+UpdateFn = Callable[[list[CheckRow]], None]
+
+
+@dataclass
+class _Check:
+    key: str
+    label: str
+    run: Callable[[], tuple[str, bool]]
+    fatal: bool = False
+    timeout: float = CHECK_TIMEOUT
+
+
+@dataclass
+class _Probes:
+    """Probe results that shape the PreflightResult beyond pass/fail."""
+
+    network: NetworkProbe | None = None
+    throughput: float | None = None
+    caches: dict[str, SubstituterProbe] = field(default_factory=dict)
 
 
 def _check_root(dry_run: bool) -> tuple[str, bool]:
@@ -29,17 +75,41 @@ def _check_efi(dry_run: bool) -> tuple[str, bool]:
     return "EFI boot mode", passed
 
 
-def _check_network(dry_run: bool) -> tuple[str, bool]:
+def _network_label(probe: NetworkProbe) -> str:
+    if not probe.reachable:
+        return f"Network unreachable ({probe.error})"
+    return f"Network connectivity (DNS {(probe.dns or 0) * 1000:.0f} ms, connect {(probe.connect or 0) * 1000:.0f} ms)"
+
+
+def _throughput_label(probe: NetworkProbe) -> str:
+    if probe.throughput is None:
+        return f"Download speed (not measured: {probe.error})"
+    slow = ", slow link" if probe.slow else ""
+    return f"Download speed {probe.throughput / MIB:.1f} MiB/s{slow}"
+
+
+def _check_network(dry_run: bool, reach: Callable[[], NetworkProbe], probes: _Probes) -> tuple[str, bool]:
     if dry_run:
         return "Network connectivity", True
-    passed = (
-        subprocess.run(
-            ["ping", "-c1", "-W2", "cache.nixos.org"],
-            capture_output=True,
-        ).returncode
-        == 0
-    )
-    return "Network connectivity", passed
+    probe = reach()
+    probes.network = probe
+    return _network_label(probe), probe.reachable
+
+
+def _check_throughput(
+    dry_run: bool, reach: Callable[[], NetworkProbe], sample: Callable[[], list[str]], probes: _Probes
+) -> tuple[str, bool]:
+    """Measured separately from reachability: a slow or timed-out
+    measurement must not make the network look down."""
+    if dry_run:
+        return "Download speed", True
+    probe = reach()
+    if not probe.reachable:
+        return "Download speed (no network)", False
+    # A copy, so the connectivity row keeps its own error text
+    probe = measure_throughput(replace(probe, error=None), sample())
+    probes.throughput = probe.throughput
+    return _throughput_label(probe), not probe.slow
 
 
 def _check_ram(dry_run: bool) -> tuple[str, bool]:
@@ -57,40 +127,168 @@ def _check_ram(dry_run: bool) -> tuple[str, bool]:
 def _check_flakes(dry_run: bool) -> tuple[str, bool]:
     if dry_run:
         return "Nix flakes enabled", True
-    passed = (
-        subprocess.run(
-            ["nix", "flake", "--help"],
-            capture_output=True,
-            env=NIX_ENV,
-        ).returncode
-        == 0
-    )
+    try:
+        passed = (
+            subprocess.run(
+                ["nix", "flake", "--help"],
+                capture_output=True,
+                env=nix_settings.env(),
+                timeout=FLAKES_TIMEOUT,
+            ).returncode
+            == 0
+        )
+    except subprocess.TimeoutExpired:
+        passed = False
     return "Nix flakes enabled", passed
 
 
-def preflight_checks(dry_run: bool) -> PreflightResult:
-    """Run safety checks and return structured results."""
-    checks: list[tuple[str, bool, bool]] = []
+def _substituter_label(probe: SubstituterProbe) -> str:
+    parsed = urlparse(probe.url)
+    name = parsed.netloc or parsed.path
+    if not probe.reachable:
+        return f"Cache {name} (unreachable)"
+    ms = (probe.latency or 0.0) * 1000
+    hits = f", {probe.hit_rate:.0%} hits" if probe.sampled else ""
+    return f"Cache {name} ({ms:.0f} ms{hits})"
+
 
-    label, passed = _check_root(dry_run)
-    checks.append((label, passed, True))
+T = TypeVar("T")
 
-    label, passed = _check_nixos(dry_run)
-    checks.append((label, passed, True))
 
-    label, passed = _check_efi(dry_run)
-    checks.append((label, passed, False))
+def _shared(fn: Callable[[], T]) -> Callable[[], T]:
+    """Call *fn* at most once, however many checks ask for its result."""
+    lock = threading.Lock()
+    value: list[T] = []
 
-    label, passed = _check_network(dry_run)
-    has_net = passed
-    checks.append((label, passed, False))
+    def get() -> T:
+        with lock:
+            if not value:
+                value.append(fn())
+            return value[0]
 
-    label, passed = _check_ram(dry_run)
-    checks.append((label, passed, False))
+    return get
 
-    label, passed = _check_flakes(dry_run)
-    checks.append((label, passed, True))
 
-    any_fatal = any(not passed and fatal for _, passed, fatal in checks)
+def _plan(dry_run: bool, substituters: list[str], probes: _Probes) -> list[_Check]:
+    sample = _shared(sample_store_paths)
+    endpoint = next((u for u in substituters if u.startswith(("http://", "https://"))), DEFAULT_SUBSTITUTER)
+    reach = _shared(lambda: probe_reachability(endpoint))
+    checks = [
+        _Check("root", "Running as root", lambda: _check_root(dry_run), fatal=True),
+        _Check("nixos", "Running on NixOS", lambda: _check_nixos(dry_run), fatal=True),
+        _Check("efi", "EFI boot mode", lambda: _check_efi(dry_run)),
+        _Check(
+            "network",
+            "Network connectivity",
+            lambda: _check_network(dry_run, reach, probes),
+            timeout=NETWORK_TIMEOUT,
+        ),
+        _Check(
+            "throughput",
+            "Download speed",
+            lambda: _check_throughput(dry_run, reach, sample, probes),
+            timeout=THROUGHPUT_TIMEOUT,
+        ),
+        _Check("ram", "RAM >= 4 GB", lambda: _check_ram(dry_run)),
+        _Check("flakes", "Nix flakes enabled", lambda: _check_flakes(dry_run), fatal=True, timeout=FLAKES_TIMEOUT),
+    ]
+
+    def cache_check(url: str) -> Callable[[], tuple[str, bool]]:
+        def run() -> tuple[str, bool]:
+            probe = probe_substituter(url, sample())
+            probes.caches[url] = probe
+            return _substituter_label(probe), probe.reachable
+
+        return run
+
+    for url in substituters:
+        name = urlparse(url).netloc or urlparse(url).path
+        checks.append(_Check(f"cache:{url}", f"Cache {name}", cache_check(url), timeout=CACHE_TIMEOUT))
+    return checks
+
+
+def _run_checks(checks: list[_Check], on_update: UpdateFn | None) -> list[CheckRow]:
+    """Run *checks* concurrently, each bounded by its own timeout.
+
+    Every check runs on its own daemon thread. One that overruns is
+    reported as failed and abandoned rather than joined, so a hung DNS
+    lookup cannot hold up the screen (or interpreter exit).
+    """
+    rows: list[CheckRow] = [(c.label, None, c.fatal) for c in checks]
+    if on_update:
+        on_update(list(rows))
+    results: queue.SimpleQueue[tuple[int, str, bool]] = queue.SimpleQueue()
+
+    def run(i: int, check: _Check) -> None:
+        try:
+            label, passed = check.run()
+        except Exception as e:
+            label, passed = f"{check.label} (error: {e})", False
+        results.put((i, label, passed))
+
+    started = time.monotonic()
+    for i, check in enumerate(checks):
+        threading.Thread(target=run, args=(i, check), name=f"preflight-{check.key}", daemon=True).start()
+
+    pending = set(range(len(checks)))
+    while pending:
+        deadline = min(started + checks[i].timeout for i in pending)
+        try:
+            i, label, passed = results.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            now = time.monotonic()
+            for i in [i for i in pending if started + checks[i].timeout <= now]:
+                pending.discard(i)
+                check = checks[i]
+                rows[i] = (f"{check.label} (timed out after {check.timeout:.0f}s)", False, check.fatal)
+        else:
+            if i not in pending:
+                continue
+            pending.discard(i)
+            rows[i] = (label, passed, checks[i].fatal)
+        if on_update:
+            on_update(list(rows))
+    return rows
+
+
+def preflight_checks(
+    dry_run: bool,
+    substituters: list[str] | None = None,
+    on_update: UpdateFn | None = None,
+) -> PreflightResult:
+    """Run safety checks concurrently and return structured results.
+
+    *on_update* receives the full check list (pending checks have passed
+    set to None) once up front and again after every check completes.
+    """
+    probes = _Probes()
+    checks = _plan(dry_run, substituters or [], probes)
+    rows = _run_checks(checks, on_update)
+
+    if dry_run:
+        has_net = True
+    else:
+        has_net = probes.network is not None and probes.network.reachable
+    ranked: list[str] = []
+    if substituters:
+        ranked = rank_substituters(
+            [probes.caches[url] for url in substituters if url in probes.caches],
+            include_default=has_net,
+        )
+
+    final = [(label, bool(passed), fatal) for label, passed, fatal in rows]
+    any_fatal = any(not passed and fatal for _, passed, fatal in final)
+    return PreflightResult(
+        checks=final,
+        has_net=has_net,
+        any_fatal=any_fatal,
+        substituters=ranked,
+        throughput=probes.throughput,
+    )
+
 
-    return PreflightResult(checks=checks, has_net=has_net, any_fatal=any_fatal)
+def apply_nix_settings(result: PreflightResult, trusted_public_keys: list[str]) -> None:
+    """Point nix at the ranked substituters and tune its parallelism to this machine."""
+    nix_settings.update(substituter_settings(result.substituters, trusted_public_keys))
+    nix_settings.update(autotune(os.cpu_count() or 1, meminfo().get("MemTotal", 0), result.throughput))
+    log(f"Nix settings: {nix_settings.describe(TUNED)}")
@@ -4,29 +4,300 @@ from __future__ import annotations
 
 import atexit
 import os
+import queue
+import re
+import selectors
 import signal
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
 from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import TextIO
 
-from .exceptions import CommandError
+from .exceptions import Cancelled, CommandError
+from .nixsettings import nix_settings
+from .telemetry import trace
+from .teardown import CleanupAction, CleanupReport, teardown
 
 LogFn = Callable[[str], None]
 
 LOG_FILE = Path("/tmp/nixos-install.log")
-NIX_ENV = {
-    **os.environ,
-    "NIX_CONFIG": "experimental-features = nix-command flakes\ndownload-buffer-size = 1073741824",
-}
+LOG_FLUSH_INTERVAL = 0.5
+STDERR_TAIL_LINES = 40
+SPAN_NAME_MAX = 120
+TERM_GRACE = 5.0
+EXIT_CANCELLED = 130
+_LINE_SEP = re.compile(rb"\r\n|\r|\n")
+
+
+class _LogRequest:
+    def __init__(self, fsync: bool = False, truncate: bool = False) -> None:
+        self.fsync = fsync
+        self.truncate = truncate
+        self.done = threading.Event()
+
+
+class _LogSink:
+    """Single long-lived writer for LOG_FILE.
+
+    Lines are queued by any thread and written in batches by a background
+    thread that flushes at most every *interval* seconds. flush() blocks
+    until everything queued before it is on disk.
+    """
+
+    def __init__(self, path: Path, interval: float) -> None:
+        self.path = path
+        self.interval = interval
+        self._queue: queue.SimpleQueue[str | _LogRequest] = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, line: str) -> None:
+        self._ensure_thread()
+        self._queue.put(line)
+
+    def request(self, fsync: bool = False, truncate: bool = False, timeout: float = 5.0) -> None:
+        req = _LogRequest(fsync=fsync, truncate=truncate)
+        self._ensure_thread()
+        self._queue.put(req)
+        req.done.wait(timeout)
+
+    def _run(self) -> None:
+        f: TextIO | None = None
+        dropped = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item: str | _LogRequest | None = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                item = None
+            while item is not None:
+                try:
+                    if f is None:
+                        f = self.path.open("a")
+                        if dropped:
+                            f.write(f"[log] {dropped} write error(s) before this line; some lines are missing\n")
+                            dropped = 0
+                    if isinstance(item, _LogRequest):
+                        f.flush()
+                        if item.truncate:
+                            f.truncate(0)
+                        if item.fsync:
+                            os.fsync(f.fileno())
+                        last_flush = time.monotonic()
+                    else:
+                        f.write(item)
+                except OSError:
+                    # E.g. ENOSPC on the RAM-backed /tmp: drop what is
+                    # buffered and reopen on the next line
+                    f = _close_quietly(f)
+                    dropped += 1
+                finally:
+                    if isinstance(item, _LogRequest):
+                        item.done.set()
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if f is not None and time.monotonic() - last_flush >= self.interval:
+                try:
+                    f.flush()
+                except OSError:
+                    f = _close_quietly(f)
+                    dropped += 1
+                last_flush = time.monotonic()
+
+
+def _close_quietly(f: TextIO | None) -> None:
+    if f is not None:
+        try:
+            f.close()
+        except OSError:
+            pass  # Closed anyway; its buffer is what failed to write
+    return None
+
+
+_sink = _LogSink(LOG_FILE, LOG_FLUSH_INTERVAL)
 
 
 def log(msg: str) -> None:
-    """Append a timestamped message to the log file."""
+    """Queue a timestamped message for the log file."""
     ts = datetime.now().strftime("[%H:%M:%S]")
-    with LOG_FILE.open("a") as f:
-        f.write(f"{ts} {msg}\n")
+    _sink.write(f"{ts} {msg}\n")
+
+
+def flush_log(fsync: bool = False) -> None:
+    """Block until queued log lines are written (and synced, if *fsync*)."""
+    _sink.request(fsync=fsync)
+
+
+def reset_log() -> None:
+    """Truncate the log file, e.g. at the start of an install."""
+    _sink.request(truncate=True)
+
+
+class CancelToken:
+    """Cancellation flag for a run and the commands started under it.
+
+    A token counts as cancelled once it or any of its parents is. Cancelling
+    terminates the process groups of the commands running under it, and
+    kills whatever is left of them after TERM_GRACE seconds.
+    """
+
+    def __init__(self, parent: CancelToken | None = None) -> None:
+        self.parent = parent
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        token: CancelToken | None = self
+        while token is not None:
+            if token._event.is_set():
+                return True
+            token = token.parent
+        return False
+
+    def covers(self, other: CancelToken) -> bool:
+        """Whether cancelling this token cancels *other*."""
+        token: CancelToken | None = other
+        while token is not None:
+            if token is self:
+                return True
+            token = token.parent
+        return False
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise Cancelled("Installation aborted")
+
+    def cancel(self, grace: float = TERM_GRACE) -> None:
+        if self._event.is_set():
+            return
+        self._event.set()
+        log("Cancelling running commands")
+        _children.terminate(self, grace)
+
+
+root_token = CancelToken()
+_bound = threading.local()
+
+
+def current_token() -> CancelToken:
+    """The token bound to this thread, or the process-wide root token."""
+    return getattr(_bound, "token", None) or root_token
+
+
+@contextmanager
+def bind_token(token: CancelToken) -> Iterator[None]:
+    """Run commands started in this thread under *token*."""
+    previous = getattr(_bound, "token", None)
+    _bound.token = token
+    try:
+        yield
+    finally:
+        _bound.token = previous
+
+
+def _signal_group(proc: subprocess.Popen, sig: int) -> None:
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class _ChildProcesses:
+    """Running commands, each the leader of its own process group."""
+
+    def __init__(self) -> None:
+        self._procs: dict[subprocess.Popen, CancelToken] = {}
+        self._lock = threading.Lock()
+
+    def add(self, proc: subprocess.Popen, token: CancelToken) -> None:
+        with self._lock:
+            self._procs[proc] = token
+        # Cancelled between the token check and the spawn
+        if token.cancelled:
+            _signal_group(proc, signal.SIGKILL)
+
+    def discard(self, proc: subprocess.Popen) -> None:
+        with self._lock:
+            self._procs.pop(proc, None)
+
+    def terminate(self, token: CancelToken, grace: float) -> None:
+        with self._lock:
+            procs = [p for p, t in self._procs.items() if token.covers(t)]
+        if not procs:
+            return
+        for proc in procs:
+            _signal_group(proc, signal.SIGTERM)
+        threading.Thread(target=self._reap, args=(procs, grace), name="reaper", daemon=True).start()
+
+    @staticmethod
+    def _reap(procs: list[subprocess.Popen], grace: float) -> None:
+        deadline = time.monotonic() + grace
+        for proc in procs:
+            try:
+                proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+        # The leader may be gone while its children still hold the group
+        for proc in procs:
+            _signal_group(proc, signal.SIGKILL)
+
+
+_children = _ChildProcesses()
+
+
+def _pump(proc: subprocess.Popen[bytes], on_line: Callable[[bytes, bool], None]) -> bytes:
+    """Read the child's stdout and stderr as data arrives.
+
+    Complete lines (split on newlines and carriage returns, so progress
+    meters show up too) are passed to *on_line* with a flag telling whether they came from stderr.
+    Returns the raw stdout bytes.
+    """
+    sel = selectors.DefaultSelector()
+    partial: dict[bool, bytes] = {}
+    for stream, is_err in ((proc.stdout, False), (proc.stderr, True)):
+        if stream is not None:
+            sel.register(stream, selectors.EVENT_READ, is_err)
+            partial[is_err] = b""
+    stdout = bytearray()
+    while sel.get_map():
+        for key, _ in sel.select():
+            is_err = key.data
+            chunk = os.read(key.fd, 65536)
+            if not chunk:
+                sel.unregister(key.fileobj)
+                if partial[is_err]:
+                    on_line(partial[is_err], is_err)
+                continue
+            if not is_err:
+                stdout += chunk
+            *lines, partial[is_err] = _LINE_SEP.split(partial[is_err] + chunk)
+            for line in lines:
+                if line:
+                    on_line(line, is_err)
+    sel.close()
+    for stream in (proc.stdout, proc.stderr):
+        if stream is not None:
+            stream.close()
+    return bytes(stdout)
+
+
+def _span_name(cmd: list[str]) -> str:
+    name = " ".join(cmd)
+    return name if len(name) <= SPAN_NAME_MAX else name[: SPAN_NAME_MAX - 3] + "..."
 
 
 def run_cmd(
@@ -39,32 +310,55 @@ def run_cmd(
     dry_label: str | None = None,
     log_fn: LogFn | None = None,
 ) -> subprocess.CompletedProcess[str]:
-    """Run a command, log it, and raise on failure."""
+    """Run a command, log its output as it arrives, and raise on failure.
+
+    stdout is returned in full; of stderr only the last STDERR_TAIL_LINES
+    lines are kept (the full stream is in the log file).
+
+    Once the thread's token is cancelled, checked commands raise Cancelled
+    instead of starting. Unchecked ones still run, as they are mostly
+    teardown (umount, cryptsetup close) that should happen regardless.
+    """
+    token = current_token()
+    if check:
+        token.check()
     log(f"$ {' '.join(cmd)}")
     if dry_run:
         msg = f"dry-run: {dry_label or ' '.join(cmd)}"
         if log_fn:
             log_fn(msg)
         return subprocess.CompletedProcess(cmd, 0, stdout="", stderr="")
-    result = subprocess.run(
-        cmd,
-        capture_output=capture,
-        text=True,
-        env=env or NIX_ENV,
-    )
-    if result.stdout:
-        log(result.stdout)
-        if log_fn:
-            for line in result.stdout.strip().splitlines():
-                log_fn(line)
-    if result.stderr:
-        log(result.stderr)
+    pipe = subprocess.PIPE if capture else None
+    stderr_tail: deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+
+    def on_line(raw: bytes, is_err: bool) -> None:
+        line = raw.decode(errors="replace")
+        log(line)
+        if is_err:
+            stderr_tail.append(line)
         if log_fn:
-            for line in result.stderr.strip().splitlines():
-                log_fn(f"[red]{line}[/red]")
-    if check and result.returncode != 0:
-        raise CommandError(cmd, result.returncode, (result.stderr or "").strip()[:500])
-    return result
+            log_fn(f"[red]{line}[/red]" if is_err else line)
+
+    with trace.span(_span_name(cmd), "cmd") as args:
+        proc = subprocess.Popen(
+            cmd, stdout=pipe, stderr=pipe, env=env or nix_settings.env(), start_new_session=True
+        )
+        # Teardown started after a cancel is left to finish
+        if check or not token.cancelled:
+            _children.add(proc, token)
+        try:
+            stdout = _pump(proc, on_line) if capture else b""
+            args["rc"] = proc.wait()
+        finally:
+            _children.discard(proc)
+    stderr = "\n".join(stderr_tail)
+    if check and token.cancelled:
+        raise Cancelled(f"Cancelled: {' '.join(cmd)}")
+    if check and proc.returncode != 0:
+        raise CommandError(cmd, proc.returncode, stderr.strip()[-500:])
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, stdout=stdout.decode(errors="replace"), stderr=stderr
+    )
 
 
 def run_cmd_streaming(
@@ -73,61 +367,120 @@ def run_cmd_streaming(
     env: dict | None = None,
     dry_run: bool = False,
     dry_label: str | None = None,
+    parse: Callable[[str], str | None] | None = None,
 ) -> Iterator[str]:
-    """Run a command and yield stdout+stderr lines as they arrive."""
+    """Run a command and yield stdout+stderr lines as they arrive.
+
+    *parse* maps each raw line to the text to log and yield; lines it maps
+    to None are consumed silently (e.g. nix JSON progress events).
+    """
+    token = current_token()
+    token.check()
     log(f"$ {' '.join(cmd)}")
     if dry_run:
         yield f"dry-run: {dry_label or ' '.join(cmd)}"
         return
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        env=env or NIX_ENV,
-    )
-    assert proc.stdout is not None
-    for line in proc.stdout:
-        stripped = line.rstrip("\n")
-        log(stripped)
-        yield stripped
-    proc.wait()
+    with trace.span(_span_name(cmd), "cmd") as args:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env=env or nix_settings.env(),
+            start_new_session=True,
+        )
+        _children.add(proc, token)
+        assert proc.stdout is not None
+        finished = False
+        try:
+            for line in proc.stdout:
+                stripped = line.rstrip("\n")
+                if parse is not None:
+                    parsed = parse(stripped)
+                    if parsed is None:
+                        continue
+                    stripped = parsed
+                log(stripped)
+                yield stripped
+            finished = True
+        finally:
+            # Consumer stopped early (generator closed): don't leave the child running
+            if not finished:
+                _signal_group(proc, signal.SIGTERM)
+                try:
+                    proc.wait(TERM_GRACE)
+                except subprocess.TimeoutExpired:
+                    _signal_group(proc, signal.SIGKILL)
+            args["rc"] = proc.wait()
+            _children.discard(proc)
+    if token.cancelled:
+        raise Cancelled(f"Cancelled: {' '.join(cmd)}")
     if proc.returncode != 0:
         raise CommandError(cmd, proc.returncode)
 
 
+def log_report(report: CleanupReport, log_fn: LogFn | None = None) -> None:
+    """Write what a teardown did to the log file and *log_fn*."""
+    for line in report.lines():
+        log(line)
+        if log_fn:
+            log_fn(line)
+
+
 class CleanupManager:
+    """Teardown actions undoing install side effects, run on abort or exit.
+
+    Actions carry a *scope* (the target root for fleet installs) so one
+    target can drop its own actions when it finishes without touching the
+    others'. run_all hands them to teardown(), which orders them by stage
+    and skips whatever is already undone.
+    """
+
     def __init__(self, dry_run: bool = False) -> None:
-        self._actions: list[tuple[str, list[str]]] = []
+        self._actions: list[tuple[CleanupAction, str]] = []
+        self._lock = threading.Lock()
         self.dry_run = dry_run
 
-    def register(self, label: str, cmd: list[str]) -> None:
-        self._actions.append((label, cmd))
+    def register(self, action: CleanupAction, scope: str = "") -> None:
+        with self._lock:
+            self._actions.append((action, scope))
 
-    def clear(self) -> None:
-        """Remove all registered cleanup actions."""
-        self._actions.clear()
+    def clear(self, scope: str | None = None) -> None:
+        """Remove registered cleanup actions: all of them, or only *scope*'s."""
+        with self._lock:
+            if scope is None:
+                self._actions.clear()
+            else:
+                self._actions = [a for a in self._actions if a[1] != scope]
 
-    def run_all(self, log_fn: LogFn | None = None) -> None:
-        for label, cmd in reversed(self._actions):
-            try:
-                if self.dry_run:
-                    if log_fn:
-                        log_fn(f"dry-run cleanup: {label}")
-                else:
-                    subprocess.run(cmd, capture_output=True, timeout=30)
-            except Exception:
-                pass
-        self._actions.clear()
+    def run_all(self, log_fn: LogFn | None = None) -> CleanupReport:
+        # Take the actions in one go so concurrent callers never run one twice
+        with self._lock:
+            actions, self._actions = self._actions, []
+        report = teardown([action for action, _scope in actions], self.dry_run, log_fn)
+        log_report(report, log_fn)
+        return report
 
 
 cleanup = CleanupManager()
 
 
 def _signal_handler(_sig: int, _frame: object) -> None:
-    cleanup.run_all()
-    raise SystemExit(130)
+    if root_token.cancelled:
+        # Second Ctrl-C: stop waiting for the steps to wind down
+        cleanup.run_all()
+        raise SystemExit(EXIT_CANCELLED)
+    # Steps fail with Cancelled as their commands die; cleanup runs at exit
+    root_token.cancel()
+
 
+def install_handlers() -> None:
+    """Cancel running commands on Ctrl-C and run cleanup at exit.
 
-signal.signal(signal.SIGINT, _signal_handler)
-atexit.register(cleanup.run_all)
+    Called by the entry point rather than at import, so importing the
+    package (tools, --help) has no process-wide side effects.
+    """
+    signal.signal(signal.SIGINT, _signal_handler)
+    # atexit runs in reverse: cleanup first, then the final log sync
+    atexit.register(flush_log, fsync=True)
+    atexit.register(cleanup.run_all)
@@ -1,8 +1,34 @@
-"""Installer TUI screens."""
+"""Installer TUI screens.
 
-from .preflight import PreflightScreen
-from .wizard import WizardScreen
-from .install import InstallScreen
-from .completion import CompletionScreen
+Each screen module is imported the first time its class is looked up, so
+the app only loads the screens it actually pushes.
+"""
 
-__all__ = ["PreflightScreen", "WizardScreen", "InstallScreen", "CompletionScreen"]
+from __future__ import annotations
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .completion import CompletionScreen
+    from .fleet import FleetScreen
+    from .install import InstallScreen
+    from .preflight import PreflightScreen
+    from .wizard import WizardScreen
+
+_MODULES = {
+    "PreflightScreen": "preflight",
+    "WizardScreen": "wizard",
+    "InstallScreen": "install",
+    "CompletionScreen": "completion",
+    "FleetScreen": "fleet",
+}
+
+__all__ = ["PreflightScreen", "WizardScreen", "InstallScreen", "CompletionScreen", "FleetScreen"]
+
+
+def __getattr__(name: str) -> Any:
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{module}", __name__), name)
@@ -9,7 +9,8 @@ from textual.screen import Screen
 from textual.widgets import Static
 
 from ..models import InstallConfig
-from ..runner import LOG_FILE, run_cmd
+from ..runner import LOG_FILE, flush_log, run_cmd
+from ..telemetry import CHROME_TRACE_FILE, TRACE_FILE, trace
 
 
 class CompletionScreen(Screen[None]):
@@ -48,6 +49,7 @@ class CompletionScreen(Screen[None]):
         else:
             tail = ""
             try:
+                flush_log()
                 all_lines = LOG_FILE.read_text().splitlines()
                 tail = "\n".join(all_lines[-30:])
             except Exception:
@@ -56,6 +58,13 @@ class CompletionScreen(Screen[None]):
             if tail:
                 lines += f"\n\n[red]Last log lines:[/red]\n[dim]{tail}[/dim]"
 
+        summary = trace.summary_lines()
+        if summary:
+            header, *rest = summary
+            body = "\n".join(rest)
+            lines += f"\n\n[bold]{header}[/bold]\n{body}"
+            lines += f"\n[dim]Trace: {TRACE_FILE}, {CHROME_TRACE_FILE}[/dim]"
+
         self.query_one("#completion-steps", Static).update(lines)
 
     def action_reboot(self) -> None:
@@ -0,0 +1,156 @@
+"""Fleet installation progress screen: one row per target."""
+
+from __future__ import annotations
+
+from collections import deque
+
+from rich.errors import MarkupError
+from rich.text import Text
+from textual import work
+from textual.app import ComposeResult
+from textual.binding import Binding
+from textual.containers import Vertical
+from textual.screen import Screen
+from textual.widgets import DataTable, RichLog, Static
+
+from ..exceptions import Cancelled, InstallerError
+from ..fleet import FleetSpec, FleetStatus, build_fleet, estimate_closures, fleet_pipeline
+from ..runner import CancelToken, cleanup, reset_log, root_token
+from ..steps import install_trace
+from ..telemetry import CHROME_TRACE_FILE, TRACE_FILE, format_duration, trace
+from .install import _ICONS, LOG_DRAIN_INTERVAL, LOG_MAX_LINES, MIB
+
+COLUMNS = ("Target", "Disks", "Step", "Done", "Nix", "Elapsed")
+
+
+class FleetScreen(Screen[bool]):
+    """Installs every fleet target through one pipeline with a row per target."""
+
+    BINDINGS = [
+        Binding("q", "quit_when_done", "Quit", show=False),
+        Binding("a", "abort", "Abort", show=False),
+    ]
+
+    def __init__(self, spec: FleetSpec, dry_run: bool, has_net: bool, resume: bool = False) -> None:
+        super().__init__()
+        self.spec = spec
+        self.dry_run = dry_run
+        self.has_net = has_net
+        self.resume = resume
+        self._status: FleetStatus | None = None
+        self._success: bool | None = None
+        self._token = CancelToken(parent=root_token)
+        self._pending_lines: deque[str] = deque()
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="install-log-container"):
+            title = f"Fleet: {len(self.spec.targets)} targets"
+            if self.dry_run:
+                title += " [yellow](DRY RUN)[/yellow]"
+            yield Static(title, id="log-title")
+            yield DataTable(id="fleet-table", cursor_type="none")
+            yield RichLog(highlight=True, markup=True, wrap=True, max_lines=LOG_MAX_LINES, id="install-log")
+            yield Static("", id="fleet-hint")
+
+    def on_mount(self) -> None:
+        self.query_one("#fleet-table", DataTable).add_columns(*COLUMNS)
+        if not self.resume:
+            reset_log()
+        self.set_interval(1.0, self._update_table)
+        self.set_interval(LOG_DRAIN_INTERVAL, self._drain_log)
+        self.query_one("#fleet-hint", Static).update("Press [bold]a[/bold] to abort.")
+        self._run_fleet()
+
+    def _update_table(self) -> None:
+        if self._status is None:
+            return
+        table = self.query_one("#fleet-table", DataTable)
+        for key, row in self._status.rows():
+            icon, style = _ICONS[row.state]
+            nix = ""
+            progress = self._status.progress.get(key)
+            if progress is not None and progress.active:
+                snap = progress.snapshot()
+                if snap.bytes_expected:
+                    nix = f"{snap.bytes_done / MIB:.0f}/{snap.bytes_expected / MIB:.0f} MiB"
+                elif snap.builds_expected:
+                    nix = f"built {snap.builds_done}/{snap.builds_expected}"
+            step = ", ".join(row.running) or (row.failed or "")
+            cells = (
+                f"[{style}]{icon}[/{style}] {row.name}",
+                row.disks,
+                step,
+                f"{row.done}/{row.total}",
+                nix,
+                format_duration(row.elapsed),
+            )
+            if key in table.rows:
+                for column, value in zip(table.columns, cells):
+                    table.update_cell(key, column, value)
+            else:
+                table.add_row(*cells, key=key)
+
+    def _log_write(self, text: str) -> None:
+        """Thread-safe log writer; lines are picked up by _drain_log."""
+        self._pending_lines.append(text)
+
+    def _drain_log(self) -> None:
+        if not self._pending_lines:
+            return
+        batch: list[Text] = []
+        while self._pending_lines:
+            line = self._pending_lines.popleft()
+            try:
+                batch.append(Text.from_markup(line))
+            except MarkupError:
+                batch.append(Text(line))
+        rich_log = self.query_one("#install-log", RichLog)
+        rich_log.write(Text("\n").join(batch))
+
+    def _finished(self, success: bool) -> None:
+        self._success = success
+        self._update_table()
+        for line in trace.summary_lines():
+            self._log_write(line)
+        if trace.spans:
+            self._log_write(f"[dim]Trace: {TRACE_FILE}, {CHROME_TRACE_FILE}[/dim]")
+        verdict = "[green]Fleet installation complete.[/green]" if success else "[red]Fleet installation failed.[/red]"
+        self.query_one("#fleet-hint", Static).update(f"{verdict}  Press [bold]q[/bold] to exit.")
+
+    def action_quit_when_done(self) -> None:
+        if self._success is not None:
+            self.dismiss(self._success)
+
+    def action_abort(self) -> None:
+        if self._success is not None or self._token.cancelled:
+            return
+        self._log_write("[yellow]Aborting: stopping running commands...[/yellow]")
+        self._token.cancel()
+
+    @work(thread=True)
+    def _run_fleet(self) -> None:
+        success = False
+        try:
+            self._log_write("Discovering hosts and disks...")
+            cfgs = build_fleet(self.spec, self.dry_run)
+            estimate_closures(cfgs, self.dry_run)
+            pipeline, self._status = fleet_pipeline(
+                cfgs, self.dry_run, self.has_net, self.spec.update_flake, self.resume, token=self._token
+            )
+            self.app.call_from_thread(self._update_table)
+            with install_trace(cfgs, self.dry_run):
+                pipeline.run(self._log_write)
+            success = True
+
+        except Cancelled:
+            cleanup.run_all(self._log_write)
+            self._log_write("[yellow]Fleet installation aborted.[/yellow]")
+
+        except InstallerError as e:
+            self._log_write(f"[red]Error: {e}[/red]")
+
+        except Exception as e:
+            self._log_write(f"[red]Unexpected error: {e}[/red]")
+
+        finally:
+            self.app.call_from_thread(self._finished, success)
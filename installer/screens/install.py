@@ -3,96 +3,109 @@
 from __future__ import annotations
 
 import time
+from collections import deque
 
+from rich.errors import MarkupError
+from rich.text import Text
 from textual import work
 from textual.app import ComposeResult
+from textual.binding import Binding
 from textual.containers import Horizontal, Vertical
 from textual.screen import Screen
 from textual.timer import Timer
 from textual.widgets import RichLog, Static
 
-from ..exceptions import InstallerError
+from ..exceptions import Cancelled, InstallerError
+from ..journal import StepJournal
 from ..models import InstallConfig
-from ..runner import LOG_FILE, cleanup
-from ..steps import (
-    cleanup_previous,
-    finish,
-    generate_hardware_config,
-    install_nixos,
-    run_disko,
-    set_user_password,
-    setup_user_environment,
-    update_flake,
-)
-
-
-class _StepState:
-    PENDING = "pending"
-    RUNNING = "running"
-    DONE = "done"
-    SKIPPED = "skipped"
-    FAILED = "failed"
+from ..nixlog import NixProgress
+from ..nixsettings import TUNED, nix_settings
+from ..pipeline import Pipeline, Step, StepState
+from ..prefetch import ClosurePrefetch
+from ..runner import CancelToken, cleanup, reset_log, root_token
+from ..steps import install_plan, install_trace
+from ..telemetry import format_duration
+
+LOG_DRAIN_INTERVAL = 0.05
+LOG_MAX_LINES = 5000
+STALL_AFTER = 60.0
+MIB = 1024 * 1024
 
 
 class _StepInfo:
     def __init__(self, label: str) -> None:
         self.label = label
-        self.state = _StepState.PENDING
+        self.state = StepState.PENDING
         self.elapsed: float | None = None
         self._start: float | None = None
 
     def start(self) -> None:
-        self.state = _StepState.RUNNING
+        self.state = StepState.RUNNING
         self._start = time.monotonic()
 
     def done(self) -> None:
-        self.state = _StepState.DONE
+        self.state = StepState.DONE
         if self._start is not None:
             self.elapsed = time.monotonic() - self._start
 
     def skip(self) -> None:
-        self.state = _StepState.SKIPPED
+        self.state = StepState.SKIPPED
+
+    def resume(self) -> None:
+        self.state = StepState.RESUMED
 
     def fail(self) -> None:
-        self.state = _StepState.FAILED
+        self.state = StepState.FAILED
         if self._start is not None:
             self.elapsed = time.monotonic() - self._start
 
     @property
     def running_elapsed(self) -> float:
-        if self._start is not None and self.state == _StepState.RUNNING:
+        if self._start is not None and self.state == StepState.RUNNING:
             return time.monotonic() - self._start
         return 0.0
 
 
 _ICONS = {
-    _StepState.PENDING: ("\u25cb", "dim"),
-    _StepState.RUNNING: ("\u25d0", "blue"),
-    _StepState.DONE: ("\u25cf", "green"),
-    _StepState.SKIPPED: ("\u25cb", "yellow"),
-    _StepState.FAILED: ("\u2717", "red"),
+    StepState.PENDING: ("\u25cb", "dim"),
+    StepState.RUNNING: ("\u25d0", "blue"),
+    StepState.DONE: ("\u25cf", "green"),
+    StepState.SKIPPED: ("\u25cb", "yellow"),
+    StepState.FAILED: ("\u2717", "red"),
+    StepState.RESUMED: ("\u25cf", "dim green"),
 }
 
 
 class InstallScreen(Screen[bool]):
     """Runs installation steps with live log output."""
 
-    def __init__(self, cfg: InstallConfig, dry_run: bool, has_net: bool) -> None:
+    BINDINGS = [Binding("a", "abort", "Abort")]
+
+    def __init__(
+        self,
+        cfg: InstallConfig,
+        dry_run: bool,
+        has_net: bool,
+        prefetch: ClosurePrefetch | None = None,
+        progress: NixProgress | None = None,
+        max_log_lines: int = LOG_MAX_LINES,
+        resume: bool = False,
+    ) -> None:
         super().__init__()
         self.cfg = cfg
         self.dry_run = dry_run
         self.has_net = has_net
+        self.resume = resume
+        self._journal: StepJournal | None = None
+        self._prefetch = prefetch
+        self._token = CancelToken(parent=root_token)
+        self.max_log_lines = max_log_lines
         self._timer: Timer | None = None
-        self._step_infos: list[_StepInfo] = [
-            _StepInfo("Cleanup previous"),
-            _StepInfo("Update flake"),
-            _StepInfo("Partition disk"),
-            _StepInfo("Hardware config"),
-            _StepInfo("Install NixOS"),
-            _StepInfo("Set password"),
-            _StepInfo("Setup environment"),
-            _StepInfo("Finalize"),
-        ]
+        self._pending_lines: deque[str] = deque()
+        self._progress = progress or NixProgress()
+        self._plan = install_plan(cfg, dry_run, has_net, prefetch, self._progress)
+        self._step_infos: list[_StepInfo] = [_StepInfo(step.label) for step in self._plan]
+        self._step_index = {step.key: i for i, step in enumerate(self._plan)}
 
     def compose(self) -> ComposeResult:
         with Horizontal():
@@ -103,122 +116,128 @@ class InstallScreen(Screen[bool]):
                 title = "Output"
                 if self.dry_run:
                     title += " [yellow](DRY RUN)[/yellow]"
+                title += "  [dim]a: abort[/dim]"
                 yield Static(title, id="log-title")
-                yield RichLog(highlight=True, markup=True, wrap=True, id="install-log")
+                yield RichLog(
+                    highlight=True, markup=True, wrap=True, max_lines=self.max_log_lines, id="install-log"
+                )
 
     def on_mount(self) -> None:
-        LOG_FILE.write_text("")
+        if not self.resume:
+            reset_log()
+        self._journal = StepJournal.start(self.cfg, self.resume, dry_run=self.dry_run)
         cleanup.dry_run = self.dry_run
         self._update_checklist()
         self._timer = self.set_interval(1.0, self._update_checklist)
+        self.set_interval(LOG_DRAIN_INTERVAL, self._drain_log)
         self._run_installation()
 
     def _update_checklist(self) -> None:
         lines: list[str] = []
         for info in self._step_infos:
             icon, style = _ICONS[info.state]
-            if info.state == _StepState.RUNNING:
+            if info.state == StepState.RUNNING:
                 elapsed_str = f"{info.running_elapsed:.0f}s"
             elif info.elapsed is not None:
                 elapsed_str = f"{info.elapsed:.0f}s"
             else:
                 elapsed_str = ""
             lines.append(f"  [{style}]{icon} {info.label:<18} {elapsed_str}[/{style}]")
+        if self._progress.active:
+            lines.extend(self._progress_lines())
         self.query_one("#install-steps", Static).update("\n".join(lines))
 
-    def _log_write(self, text: str) -> None:
-        """Thread-safe log writer."""
-        self.app.call_from_thread(self._write_to_log, text)
+    def _progress_lines(self) -> list[str]:
+        snap = self._progress.snapshot()
+        lines = ["", f"  [bold]{snap.label}[/bold]"]
+        if snap.builds_expected:
+            running = f" ({snap.builds_running} running)" if snap.builds_running else ""
+            lines.append(f"  built    {snap.builds_done}/{snap.builds_expected}{running}")
+        if snap.bytes_expected:
+            lines.append(f"  download {snap.bytes_done / MIB:.0f}/{snap.bytes_expected / MIB:.0f} MiB")
+        if snap.rate > 0:
+            eta = f"  eta {format_duration(snap.eta)}" if snap.eta is not None else ""
+            lines.append(f"  rate     {snap.rate / MIB:.1f} MiB/s{eta}")
+        if snap.idle >= STALL_AFTER:
+            lines.append(f"  [yellow]no progress for {snap.idle:.0f}s[/yellow]")
+        return lines
 
-    def _write_to_log(self, text: str) -> None:
+    def _log_write(self, text: str) -> None:
+        """Thread-safe log writer; lines are picked up by _drain_log."""
+        self._pending_lines.append(text)
+
+    def _drain_log(self) -> None:
+        """Write everything queued since the last tick as a single RichLog entry."""
+        if not self._pending_lines:
+            return
+        batch: list[Text] = []
+        while self._pending_lines:
+            line = self._pending_lines.popleft()
+            try:
+                batch.append(Text.from_markup(line))
+            except MarkupError:
+                batch.append(Text(line))
         try:
-            self.query_one("#install-log", RichLog).write(text)
+            rich_log = self.query_one("#install-log", RichLog)
+            text = Text("\n").join(batch)
+            rich_log.write(rich_log.highlighter(text) if rich_log.highlight else text)
         except Exception:
             pass
 
+    def _on_step_state(self, step: Step, state: str) -> None:
+        """Pipeline callback -- runs on the scheduler or a step thread."""
+        info = self._step_infos[self._step_index[step.key]]
+        if state == StepState.RUNNING:
+            info.start()
+        elif state == StepState.DONE:
+            info.done()
+        elif state == StepState.SKIPPED:
+            info.skip()
+        elif state == StepState.FAILED:
+            info.fail()
+        elif state == StepState.RESUMED:
+            info.resume()
+        self.app.call_from_thread(self._update_checklist)
+
+    def action_abort(self) -> None:
+        """Stop the install: kill running commands, then undo what was set up."""
+        if self._token.cancelled:
+            return
+        self._log_write("[yellow]Aborting: stopping running commands...[/yellow]")
+        self._token.cancel()
+        if self._prefetch is not None:
+            self._prefetch.cancel(timeout=0)
+
     @work(thread=True)
     def _run_installation(self) -> None:
         assert self.cfg.host and self.cfg.disk
         success = False
 
         try:
-            # Step 0: Cleanup previous
-            self._step_infos[0].start()
-            self.app.call_from_thread(self._update_checklist)
-            cleanup_previous(self.dry_run, log_fn=self._log_write)
-            self._step_infos[0].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 1: Update flake
-            if self.cfg.update_flake:
-                self._step_infos[1].start()
-                self.app.call_from_thread(self._update_checklist)
-                for line in update_flake(self.dry_run):
-                    self._log_write(line)
-                self._step_infos[1].done()
-            else:
-                self._step_infos[1].skip()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 2: Partition disk
-            self._step_infos[2].start()
-            self.app.call_from_thread(self._update_checklist)
-            for line in run_disko(self.cfg, self.dry_run, log_fn=self._log_write):
-                self._log_write(line)
-            self._step_infos[2].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 3: Generate hardware config
-            self._step_infos[3].start()
-            self.app.call_from_thread(self._update_checklist)
-            generate_hardware_config(self.cfg.host.name, self.dry_run, log_fn=self._log_write)
-            self._step_infos[3].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 4: Install NixOS
-            self._step_infos[4].start()
-            self.app.call_from_thread(self._update_checklist)
-            for line in install_nixos(self.cfg.host.name, self.dry_run):
-                self._log_write(line)
-            self._step_infos[4].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 5: Set user password
-            self._step_infos[5].start()
-            self.app.call_from_thread(self._update_checklist)
-            set_user_password(self.cfg, self.dry_run, log_fn=self._log_write)
-            self._step_infos[5].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 6: Setup user environment
-            self._step_infos[6].start()
-            self.app.call_from_thread(self._update_checklist)
-            setup_user_environment(self.cfg, self.dry_run, self.has_net, log_fn=self._log_write)
-            self._step_infos[6].done()
-            self.app.call_from_thread(self._update_checklist)
-
-            # Step 7: Finalize
-            self._step_infos[7].start()
-            self.app.call_from_thread(self._update_checklist)
-            finish(self.cfg, self.dry_run, log_fn=self._log_write)
-            self._step_infos[7].done()
-            self.app.call_from_thread(self._update_checklist)
-
+            pipeline = Pipeline(
+                self._plan, on_state=self._on_step_state, journal=self._journal, token=self._token
+            )
+            self._log_write(f"[dim]Nix settings: {nix_settings.describe(TUNED)}[/dim]")
+            kept = pipeline.resumable()
+            if self.resume:
+                if kept:
+                    self._log_write(f"Resuming: keeping {', '.join(sorted(kept))}")
+                else:
+                    self._log_write("[yellow]Nothing to resume for this configuration; running all steps.[/yellow]")
+            with install_trace([self.cfg], self.dry_run):
+                pipeline.run(self._log_write, kept)
             success = True
 
+        except Cancelled:
+            # The pipeline has wound down, so nothing races the cleanup
+            cleanup.run_all(self._log_write)
+            self._log_write("[yellow]Installation aborted.[/yellow]")
+
         except InstallerError as e:
             self._log_write(f"[red]Error: {e}[/red]")
-            for info in self._step_infos:
-                if info.state == _StepState.RUNNING:
-                    info.fail()
-            self.app.call_from_thread(self._update_checklist)
 
         except Exception as e:
             self._log_write(f"[red]Unexpected error: {e}[/red]")
-            for info in self._step_infos:
-                if info.state == _StepState.RUNNING:
-                    info.fail()
-            self.app.call_from_thread(self._update_checklist)
 
         finally:
             if self._timer:
@@ -7,11 +7,11 @@ from textual.app import ComposeResult
 from textual.binding import Binding
 from textual.containers import Vertical
 from textual.screen import Screen
-from textual.widgets import LoadingIndicator, Static
+from textual.widgets import Static
 from textual.worker import Worker, WorkerState
 
 from ..models import PreflightResult
-from ..preflight import preflight_checks
+from ..preflight import CheckRow, preflight_checks
 
 
 class PreflightScreen(Screen[PreflightResult | None]):
@@ -22,27 +22,30 @@ class PreflightScreen(Screen[PreflightResult | None]):
         Binding("escape,q", "quit_screen", "Quit", show=True),
     ]
 
-    def __init__(self, dry_run: bool) -> None:
+    def __init__(self, dry_run: bool, substituters: list[str] | None = None) -> None:
         super().__init__()
         self.dry_run = dry_run
+        self.substituters = substituters or []
         self._result: PreflightResult | None = None
         self._ready = False
 
     def compose(self) -> ComposeResult:
         with Vertical(id="preflight-panel"):
             yield Static("Pre-flight Checks", id="title")
-            yield LoadingIndicator(id="preflight-loading")
             yield Static("", id="preflight-checks")
             yield Static("[dim]enter[/dim] continue  [dim]q[/dim] quit", id="preflight-hint")
 
     def on_mount(self) -> None:
-        self.query_one("#preflight-checks").display = False
         self.query_one("#preflight-hint").display = False
         self._run_checks()
 
     @work(thread=True)
     def _run_checks(self) -> PreflightResult:
-        return preflight_checks(self.dry_run)
+        return preflight_checks(
+            self.dry_run,
+            self.substituters,
+            on_update=lambda rows: self.app.call_from_thread(self._show_rows, rows),
+        )
 
     def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
         if event.worker.name == "_run_checks" and event.state == WorkerState.SUCCESS:
@@ -51,14 +54,14 @@ class PreflightScreen(Screen[PreflightResult | None]):
             self._result = result
             self._show_results(result)
 
-    def _show_results(self, result: PreflightResult) -> None:
-        self.query_one("#preflight-loading").display = False
-        checks_widget = self.query_one("#preflight-checks", Static)
-        checks_widget.display = True
-
+    @staticmethod
+    def _check_lines(rows: list[CheckRow]) -> list[str]:
         lines: list[str] = []
-        for label, passed, fatal in result.checks:
-            if passed:
+        for label, passed, fatal in rows:
+            if passed is None:
+                icon = "[dim]\u2026[/dim]"
+                suffix = ""
+            elif passed:
                 icon = "[green]\u2713[/green]"
                 suffix = ""
             elif fatal:
@@ -68,14 +71,21 @@ class PreflightScreen(Screen[PreflightResult | None]):
                 icon = "[yellow]![/yellow]"
                 suffix = " [yellow](warning)[/yellow]"
             lines.append(f"  {icon}  {label}{suffix}")
+        return lines
 
+    def _show_rows(self, rows: list[CheckRow]) -> None:
+        if self._result is None:
+            self.query_one("#preflight-checks", Static).update("\n".join(self._check_lines(rows)))
+
+    def _show_results(self, result: PreflightResult) -> None:
+        lines = self._check_lines(list(result.checks))
         if result.any_fatal:
             lines.append("")
             lines.append("[red]Fatal check(s) failed. Press q to quit.[/red]")
         else:
             self._ready = True
 
-        checks_widget.update("\n".join(lines))
+        self.query_one("#preflight-checks", Static).update("\n".join(lines))
         self.query_one("#preflight-hint").display = True
 
     def action_continue(self) -> None:
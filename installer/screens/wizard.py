@@ -14,8 +14,12 @@ from textual.widgets import DataTable, Input, OptionList, Static
 from textual.widgets.option_list import Option
 from textual.worker import Worker, WorkerState
 
-from ..discovery import discover_disks, discover_hosts
-from ..models import DiskInfo, HostInfo, InstallConfig
+from ..diskbench import benchmark_disks, raid0_mismatch
+from ..discovery import cached_hosts, discover_disks, discover_hosts
+from ..models import DiskBenchmark, DiskInfo, HostInfo, InstallConfig
+from ..netprobe import DownloadEstimate, closure_size
+from ..prefetch import ClosurePrefetch
+from ..steps import refresh_problem
 
 
 @dataclass
@@ -35,11 +39,28 @@ class WizardScreen(Screen[InstallConfig | None]):
         Binding("q", "quit_screen", "Quit", show=True),
     ]
 
-    def __init__(self, dry_run: bool, has_net: bool) -> None:
+    def __init__(
+        self,
+        dry_run: bool,
+        has_net: bool,
+        prefetch: ClosurePrefetch | None = None,
+        throughput: float | None = None,
+        benchmark: bool = False,
+    ) -> None:
         super().__init__()
         self.dry_run = dry_run
         self.has_net = has_net
+        self.prefetch = prefetch
+        self.throughput = throughput
+        self.benchmark = benchmark
+        self._benchmarking = False
+        self._estimate: DownloadEstimate | None = None
+        self._estimate_host: str | None = None
+        self._refresh_ok: dict[tuple[str | None, str | None, bool, bool], bool] = {}
+        self._refresh_pending: tuple[str | None, str | None, bool, bool] | None = None
+        self._estimating = False
         self._hosts: list[HostInfo] = []
+        self._hosts_loading = False
         self._disks: list[DiskInfo] = []
         self._current_step = 0
         self._steps: list[WizardStep] = [
@@ -48,6 +69,8 @@ class WizardScreen(Screen[InstallConfig | None]):
             WizardStep(key="layout", label="Layout"),
             WizardStep(key="disk1", label="Disk"),
             WizardStep(key="disk2", label="Disk 2", enabled=False),
+            # Offered when the chosen disks already hold this layout
+            WizardStep(key="mode", label="Reinstall", enabled=False),
             WizardStep(key="password", label="Password"),
             WizardStep(key="flake", label="Flake update", enabled=self.has_net),
             WizardStep(key="confirm", label="Confirm"),
@@ -64,21 +87,114 @@ class WizardScreen(Screen[InstallConfig | None]):
     def on_mount(self) -> None:
         self._discover()
 
-    @work(thread=True)
-    def _discover(self) -> tuple[list[HostInfo], list[DiskInfo]]:
-        hosts = discover_hosts(self.dry_run)
-        disks = discover_disks(self.dry_run)
-        return hosts, disks
+    @work(thread=True, exit_on_error=False)
+    def _discover(self) -> bool:
+        """Load disks, then hosts; returns True if hosts came from the cache."""
+        self._disks = discover_disks(self.dry_run)
+        if self.benchmark:
+            self._benchmarking = True
+            self.app.call_from_thread(self._benchmark_disks)
+        hosts = cached_hosts()
+        if hosts is not None:
+            self.app.call_from_thread(self._set_hosts, hosts)
+            return True
+        self._hosts_loading = True
+        self.app.call_from_thread(self._show_step)
+        hosts = discover_hosts(
+            self.dry_run,
+            on_host=lambda host: self.app.call_from_thread(self._add_host, host),
+        )
+        self.app.call_from_thread(self._set_hosts, hosts)
+        return False
+
+    @work(thread=True, exit_on_error=False)
+    def _revalidate(self) -> list[HostInfo]:
+        return discover_hosts(self.dry_run)
+
+    @work(thread=True, exit_on_error=False)
+    def _benchmark_disks(self) -> None:
+        benchmark_disks(self._disks, self.dry_run)
+
+    @work(thread=True, exclusive=True, group="estimate", exit_on_error=False)
+    def _estimate_download(self, host: str) -> tuple[str, DownloadEstimate | None]:
+        size = closure_size(host)
+        if size is None:
+            return host, None
+        download, unpacked = size
+        return host, DownloadEstimate(download, self.throughput, unpacked)
 
     def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
         if event.worker.name == "_discover" and event.state == WorkerState.SUCCESS:
-            hosts, disks = event.worker.result
-            self._hosts = hosts
-            self._disks = disks
-            self._show_step()
+            if event.worker.result:
+                self._revalidate()
         elif event.worker.name == "_discover" and event.state == WorkerState.ERROR:
+            self._hosts_loading = False
             title = self.query_one("#content-title", Static)
             title.update("[red]Discovery failed. Check your flake configuration.[/red]")
+        elif event.worker.name == "_revalidate" and event.state == WorkerState.SUCCESS:
+            hosts = event.worker.result
+            if hosts != self._hosts:
+                self._set_hosts(hosts)
+        elif event.worker.name == "_benchmark_disks" and event.state in (WorkerState.SUCCESS, WorkerState.ERROR):
+            self._benchmarking = False
+            self._refresh_disk_tables()
+        elif event.worker.name == "_probe_refresh" and event.state in (WorkerState.SUCCESS, WorkerState.ERROR):
+            key, self._refresh_pending = self._refresh_pending, None
+            if key is None:
+                return
+            # A disk that can't be probed is simply not offered a refresh
+            self._refresh_ok[key] = event.state == WorkerState.SUCCESS and bool(event.worker.result)
+            # Carry on from the disk step that started the probe, if still there
+            if key == self._refresh_key(self._build_config()) and self._current().key in ("disk1", "disk2"):
+                self._advance()
+        elif event.worker.name == "_estimate_download" and event.state in (WorkerState.SUCCESS, WorkerState.ERROR):
+            host, estimate = event.worker.result or (self._estimate_host, None)
+            if host != self._estimate_host:
+                return
+            self._estimating = False
+            self._estimate = estimate
+            if self._current().key == "confirm":
+                self.query_one("#confirm-summary", Static).update(self._build_summary())
+
+    def _add_host(self, host: HostInfo) -> None:
+        """Insert a freshly evaluated host into the (sorted) list."""
+        self._hosts = sorted([*self._hosts, host], key=lambda h: h.name)
+        self._refresh_host_list()
+
+    def _set_hosts(self, hosts: list[HostInfo]) -> None:
+        first = not self._hosts and not self._hosts_loading
+        self._hosts = hosts
+        self._hosts_loading = False
+        if first:
+            self._show_step()
+        else:
+            self._refresh_host_list()
+
+    def _refresh_host_list(self) -> None:
+        """Re-render the host list in place, keeping the highlighted host."""
+        try:
+            ol = self.query_one("#host-list", OptionList)
+        except Exception:
+            return
+        current = None
+        if ol.highlighted is not None:
+            current = ol.get_option_at_index(ol.highlighted).id
+        ol.clear_options()
+        ol.add_options(Option(f"{h.name:<12} {h.description}", id=h.name) for h in self._hosts)
+        for i, h in enumerate(self._hosts):
+            if h.name == current:
+                ol.highlighted = i
+                break
+        else:
+            if self._hosts:
+                ol.highlighted = 0
+        if self._current().key == "host":
+            self.query_one("#content-title", Static).update(self._host_title())
+
+    def _host_title(self) -> str:
+        if self._hosts_loading:
+            return "Select Host [dim](evaluating hosts...)[/dim]"
+        return "Select Host"
 
     def _enabled_steps(self) -> list[WizardStep]:
         return [s for s in self._steps if s.enabled]
@@ -102,6 +218,8 @@ class WizardScreen(Screen[InstallConfig | None]):
             lines.append(f"  {icon} {step.label}{val}")
 
         hint = "\n\n[dim]enter[/dim] select  [dim]esc[/dim] back  [dim]q[/dim] quit"
+        if self.prefetch is not None and self.prefetch.running:
+            hint += f"\n\n[dim]Prefetching {self.prefetch.host} closure...[/dim]"
         self.query_one("#sidebar-steps", Static).update("\n".join(lines) + hint)
 
     def _show_step(self) -> None:
@@ -117,7 +235,7 @@ class WizardScreen(Screen[InstallConfig | None]):
         title = self.query_one("#content-title", Static)
 
         if step.key == "host":
-            title.update("Select Host")
+            title.update(self._host_title())
             options = [Option(f"{h.name:<12} {h.description}", id=h.name) for h in self._hosts]
             ol = OptionList(*options, id="host-list")
             content.mount(ol)
@@ -166,6 +284,18 @@ class WizardScreen(Screen[InstallConfig | None]):
             content.mount(dt)
             self.call_later(dt.focus)
 
+        elif step.key == "mode":
+            title.update("Existing Install Found")
+            options = [
+                Option("Refresh \u2014 keep /nix and /home, reset the root filesystem", id="refresh"),
+                Option("Wipe \u2014 repartition and format", id="wipe"),
+            ]
+            ol = OptionList(*options, id="mode-list")
+            content.mount(ol)
+            if step.data is not None:
+                ol.highlighted = 0 if step.data else 1
+            self.call_later(ol.focus)
+
         elif step.key == "password":
             title.update("Set User Password [dim](tab to switch, enter to confirm)[/dim]")
             container = Vertical(id="password-container")
@@ -206,6 +336,10 @@ class WizardScreen(Screen[InstallConfig | None]):
     def _make_disk_table(self, table_id: str, exclude: str | None) -> DataTable:
         dt = DataTable(id=table_id, cursor_type="row")
         dt.add_columns("Device", "Size", "Model", "Notes")
+        if self.benchmark:
+            dt.add_column("Seq read", key="seq")
+            dt.add_column("4K read", key="rand")
+            dt.add_column("SMART", key="smart")
         disks = [d for d in self._disks if d.device != exclude] if exclude else self._disks
         for d in disks:
             notes_parts: list[str] = []
@@ -213,18 +347,53 @@ class WizardScreen(Screen[InstallConfig | None]):
                 notes_parts.append("boot disk")
             if d.is_removable:
                 notes_parts.append("removable")
-            dt.add_row(d.device, d.size_human, d.model, " ".join(notes_parts), key=d.device)
+            bench = self._bench_cells(d.benchmark) if self.benchmark else ()
+            dt.add_row(d.device, d.size_human, d.model, " ".join(notes_parts), *bench, key=d.device)
         return dt
 
+    def _bench_cells(self, bench: DiskBenchmark | None) -> tuple[str, str, str]:
+        if bench is None:
+            pending = "[dim]\u2026[/dim]" if self._benchmarking else "[dim]-[/dim]"
+            return pending, pending, pending
+        smart = {True: "[green]ok[/green]", False: "[red]FAILING[/red]", None: "[dim]-[/dim]"}[bench.healthy]
+        if bench.error:
+            return "[dim]n/a[/dim]", "[dim]n/a[/dim]", smart
+        seq = bench.seq_read or 0.0
+        seq_str = f"{seq / 1e9:.1f} GB/s" if seq >= 1e9 else f"{seq / 1e6:.0f} MB/s"
+        iops = bench.rand_read_iops or 0.0
+        return seq_str, f"{iops / 1000:.1f}k IOPS", smart
+
+    def _refresh_disk_tables(self) -> None:
+        """Fill in benchmark columns of any disk table on screen."""
+        for dt in self.query(DataTable):
+            for d in self._disks:
+                if d.device not in dt.rows:
+                    continue
+                for key, value in zip(("seq", "rand", "smart"), self._bench_cells(d.benchmark)):
+                    dt.update_cell(d.device, key, value)
+
     def _build_summary(self) -> str:
         lines: list[str] = []
         for step in self._enabled_steps():
             if step.key == "confirm":
                 continue
             lines.append(f"  {step.label:<14} {step.value}")
+        if self._estimating:
+            lines.append(f"  {'Download':<14} [dim]estimating...[/dim]")
+        elif self._estimate is not None:
+            stale = " [dim](before flake update)[/dim]" if next(s for s in self._steps if s.key == "flake").data else ""
+            lines.append(f"  {'Download':<14} {self._estimate.describe()}{stale}")
 
         text = "\n".join(lines)
-        if not self.dry_run:
+        disk1 = next(s for s in self._steps if s.key == "disk1").data
+        disk2 = next(s for s in self._steps if s.key == "disk2")
+        if disk2.enabled and disk1 is not None and disk2.data is not None:
+            mismatch = raid0_mismatch(disk1, disk2.data)
+            if mismatch:
+                text += f"\n\n[yellow]{mismatch}[/yellow]"
+        if next(s for s in self._steps if s.key == "mode").data:
+            text += "\n\n[bold yellow]The root filesystem will be reset; /nix, /home and the other subvolumes are kept.[/bold yellow]"
+        elif not self.dry_run:
             text += "\n\n[bold red]WARNING: This will destroy all data on the selected disk(s)![/bold red]"
         return text
 
@@ -248,9 +417,24 @@ class WizardScreen(Screen[InstallConfig | None]):
                 return False
             if ol.highlighted is None:
                 return False
-            host = self._hosts[ol.highlighted]
+            name = ol.get_option_at_index(ol.highlighted).id
+            host = next((h for h in self._hosts if h.name == name), None)
+            if host is None:
+                return False
+            if host.eval_failed:
+                title = self.query_one("#content-title", Static)
+                title.update(f"[red]Host {host.name} failed to evaluate; check its configuration.[/red]")
+                return False
             step.data = host
             step.value = host.name
+            if not self.dry_run and host.name != self._estimate_host:
+                self._estimate = None
+                self._estimate_host = host.name
+                self._estimating = True
+                self._estimate_download(host.name)
+            # Start fetching the closure while the remaining steps are answered
+            if self.prefetch is not None:
+                self.prefetch.start(host.name)
 
         elif step.key == "encrypt":
             try:
@@ -288,6 +472,8 @@ class WizardScreen(Screen[InstallConfig | None]):
                 return False
             step.data = disk
             step.value = f"{disk.device} ({disk.size_human})"
+            if not self._check_refresh():
+                return False
 
         elif step.key == "disk2":
             disk1 = next(s for s in self._steps if s.key == "disk1").data
@@ -300,6 +486,22 @@ class WizardScreen(Screen[InstallConfig | None]):
                 return False
             step.data = disk
             step.value = f"{disk.device} ({disk.size_human})"
+            if not self._check_refresh():
+                return False
+
+        elif step.key == "mode":
+            try:
+                ol = self.query_one("#mode-list", OptionList)
+            except Exception:
+                return False
+            if ol.highlighted is None:
+                return False
+            refresh = ol.highlighted == 0
+            step.data = refresh
+            step.value = "Refresh" if refresh else "Wipe"
+            # A refresh substitutes from the target's store; prefetching would download it all again
+            if refresh and self.prefetch is not None:
+                self.prefetch.cancel()
 
         elif step.key == "password":
             try:
@@ -326,6 +528,14 @@ class WizardScreen(Screen[InstallConfig | None]):
             update = ol.highlighted == 0
             step.data = update
             step.value = "Yes" if update else "No"
+            # A prefetch against the old lockfile would only fill the store with stale paths
+            if self.prefetch is not None:
+                host = next(s for s in self._steps if s.key == "host").data
+                refresh = next(s for s in self._steps if s.key == "mode").data
+                if update or refresh:
+                    self.prefetch.cancel()
+                elif host is not None:
+                    self.prefetch.start(host.name)
 
         elif step.key == "confirm":
             cfg = self._build_config()
@@ -334,6 +544,45 @@ class WizardScreen(Screen[InstallConfig | None]):
 
         return True
 
+    def _check_refresh(self) -> bool:
+        """Offer a refresh once all disks are chosen and they hold the chosen layout.
+
+        The disks are probed on a worker; returns False while that is
+        pending, and the disk step advances itself when the answer is in.
+        """
+        cfg = self._build_config()
+        if cfg.disk is None or (cfg.dual_disk and cfg.disk2 is None):
+            self._set_refresh_available(False)
+            return True
+        key = self._refresh_key(cfg)
+        if key in self._refresh_ok:
+            self._set_refresh_available(self._refresh_ok[key])
+            return True
+        self.query_one("#content-title", Static).update(f"Checking {cfg.disk.device} for an existing install...")
+        self._refresh_pending = key
+        self._probe_refresh(cfg)
+        return False
+
+    @staticmethod
+    def _refresh_key(cfg: InstallConfig) -> tuple[str | None, str | None, bool, bool]:
+        return (
+            cfg.disk.device if cfg.disk else None,
+            cfg.disk2.device if cfg.disk2 else None,
+            cfg.encrypted,
+            cfg.dual_disk,
+        )
+
+    @work(thread=True, exclusive=True, group="refresh", exit_on_error=False)
+    def _probe_refresh(self, cfg: InstallConfig) -> bool:
+        return refresh_problem(cfg, self.dry_run) is None
+
+    def _set_refresh_available(self, available: bool) -> None:
+        mode = next(s for s in self._steps if s.key == "mode")
+        mode.enabled = available
+        if not available:
+            mode.data = None
+            mode.value = ""
+
     def _get_selected_disk(self, table_id: str, exclude: str | None) -> DiskInfo | None:
         try:
             dt = self.query_one(f"#{table_id}", DataTable)
@@ -369,6 +618,9 @@ class WizardScreen(Screen[InstallConfig | None]):
         if cfg.encrypted:
             cfg.luks_password = steps["password"].data
         cfg.update_flake = steps["flake"].data if steps["flake"].enabled else False
+        cfg.refresh = bool(steps["mode"].data) if steps["mode"].enabled else False
+        if self._estimate is not None:
+            cfg.closure_bytes = self._estimate.unpacked_bytes
         return cfg
 
     def action_go_back(self) -> None:
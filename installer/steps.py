@@ -2,16 +2,35 @@
 
 from __future__ import annotations
 
+import hashlib
+import json
+import os
 import shutil
 import subprocess
 import textwrap
-from collections.abc import Iterator
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from . import SCRIPT_DIR
 from .exceptions import StepError
+from .image import ESP_TYPE, ImageInfo, grow_last_partition, partitions, rekey_luks, seal_image, write_image
+from .memgov import RW_STORE, MemoryGovernor, resize_store, rw_store_size
 from .models import InstallConfig
-from .runner import LogFn, cleanup, run_cmd, run_cmd_streaming
+from .nixlog import NIX_JSON_LOG, NixLogParser, NixProgress
+from .nixsettings import TUNED, nix_settings
+from .pipeline import Step
+from .runner import LOG_FILE, LogFn, cleanup, log, log_report, run_cmd, run_cmd_streaming
+from .swap import GIB, meminfo, provision_swap, release_swap
+from .teardown import CleanupAction, active_swaps, teardown
+from .telemetry import trace
+
+if TYPE_CHECKING:
+    from .prefetch import ClosurePrefetch
 
 REPO_HTTPS = "https://github.com/yofsh/nix.git"
 REPO_SSH = "git@github.com:yofsh/nix.git"
@@ -20,60 +39,290 @@ DISKO_DIR = SCRIPT_DIR / "disko"
 DISKO_PLACEHOLDER = "REPLACE_ME"
 DISKO_PLACEHOLDER_1 = "REPLACE_ME_1"
 DISKO_PLACEHOLDER_2 = "REPLACE_ME_2"
+# disko labels GPT partitions disk-<disk>-<partition>; the disk name and
+# partitions of each layout, with the filesystem each partition holds
+DISKO_LAYOUTS = {
+    "default.nix": ("my-disk", {"ESP": "vfat", "swap": "swap", "root": "btrfs"}),
+    "luks.nix": ("vdb", {"ESP": "vfat", "luks": "crypto_LUKS"}),
+    "dual.nix": ("main", {"ESP": "vfat", "swap": "swap", "root": "btrfs"}),
+    "dual_luks.nix": ("main", {"ESP": "vfat", "luks": "crypto_LUKS"}),
+}
+# Store paths already on a refreshed target are substituted from it
+# ahead of any binary cache (which has priority 40)
+TARGET_STORE_PRIORITY = 10
+
+SYSTEM_LINK = Path("/tmp/nixos-install-system")
+# Per-target scratch space of fleet installs: FLEET_DIR/<slot>/...
+FLEET_DIR = Path("/tmp/nixos-fleet")
+
+# Copy of the flake that host closures are evaluated from while some
+# host has no hardware-configuration.nix yet
+EVAL_FLAKE = Path("/tmp/nixos-eval-flake")
+HARDWARE_STUB = textwrap.dedent("""\
+    # Placeholder written by the installer so this host's closure can be
+    # evaluated before nixos-generate-config has run on its disk.
+    { modulesPath, ... }:
+    {
+      imports = [ (modulesPath + "/installer/scan/not-detected.nix") ];
+      fileSystems."/" = { device = "/dev/disk/by-label/nixos"; fsType = "btrfs"; options = [ "subvol=@" ]; };
+      fileSystems."/boot" = { device = "/dev/disk/by-label/boot"; fsType = "vfat"; };
+    }
+""")
+
+# Fleet targets get unique disko disk names: disko labels partitions
+# disk-<name>-<part>, and identical labels on disks attached side by side
+# would make /dev/disk/by-partlabel point at the wrong one.
+FLEET_DISKO_WRAPPER = textwrap.dedent("""\
+    let
+      devices = (import ./target.nix).disko.devices;
+    in
+    {
+      disko.devices = devices // {
+        disk = builtins.listToAttrs (map (name: {
+          name = "${name}-SLOT";
+          value = devices.disk.${name};
+        }) (builtins.attrNames devices.disk));
+      };
+    }
+""")
+
+# Hash of the flake.lock the last flake update produced, so a resume can
+# tell the lock is still the updated one
+FLAKE_STAMP = LOG_FILE.with_suffix(".flake-lock")
+
+# Copies of an image share their btrfs UUID, and the kernel refuses to
+# mount a filesystem whose UUID is already mounted from another device:
+# image targets are personalized one at a time
+_IMAGE_MOUNT_LOCK = threading.Lock()
+IMAGE_SUBVOLUMES = (("@", ""), ("@nix", "/nix"), ("@home", "/home"), ("@log", "/var/log"))
+# Per-machine identity that services regenerate on first boot
+MACHINE_STATE = ("etc/machine-id", "var/lib/systemd/random-seed", "etc/ssh/ssh_host_*")
+
+
+@dataclass
+class TargetPaths:
+    secret_key: Path
+    disko_dir: Path
+    system_link: Path
+    hardware_tmp: Path
+    # Flake the target is built from; fleet targets each get a copy
+    flake: Path
+    # Where a refresh mounts the top level of the target's btrfs
+    btrfs_top: Path
+
+
+def target_paths(cfg: InstallConfig) -> TargetPaths:
+    if cfg.slot is None:
+        return TargetPaths(
+            Path("/tmp/secret.key"),
+            Path("/tmp/disko-install"),
+            SYSTEM_LINK,
+            Path("/tmp/nixos-config"),
+            SCRIPT_DIR,
+            Path("/tmp/nixos-btrfs-top"),
+        )
+    base = FLEET_DIR / str(cfg.slot)
+    return TargetPaths(
+        base / "secret.key", base / "disko", base / "system", base / "hardware", base / "nix", base / "btrfs-top"
+    )
 
 
-def cleanup_previous(dry_run: bool, log_fn: LogFn | None = None) -> None:
+def cleanup_previous(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
     """Clean up mounts/swap from a previous failed run."""
     if log_fn:
         log_fn("Cleaning up from previous run...")
-    for cmd in (
-        ["swapoff", "/mnt/swapfile"],
-        ["rm", "-f", "/mnt/swapfile"],
-        ["umount", "-R", "/mnt"],
-        ["cryptsetup", "close", "crypted"],
-        ["cryptsetup", "close", "crypted2"],
-    ):
-        run_cmd(cmd, check=False, capture=True, dry_run=dry_run, dry_label=" ".join(cmd), log_fn=log_fn)
+    swapfile = f"{cfg.root}/swapfile"
+    swaps = [] if dry_run else [s for s in active_swaps() if s.startswith(swapfile)]
+    report = teardown(
+        [
+            *(CleanupAction.swapoff(s) for s in swaps or [swapfile]),
+            *(CleanupAction.remove(s) for s in swaps or [swapfile]),
+            CleanupAction.unmount(cfg.root),
+            CleanupAction.close_mapper(cfg.mapper),
+            CleanupAction.close_mapper(cfg.mapper2),
+        ],
+        dry_run,
+        log_fn,
+    )
+    if not dry_run:
+        log_report(report, log_fn)
     if log_fn:
         log_fn("Cleanup done.")
 
 
-def update_flake(dry_run: bool) -> Iterator[str]:
+def _nix_streaming(
+    cmd: list[str],
+    *,
+    label: str,
+    progress: NixProgress | None,
+    dry_run: bool,
+    dry_label: str,
+) -> Iterator[str]:
+    """Run a nix command with JSON logging, feeding *progress* as it goes."""
+    parser = NixLogParser(progress or NixProgress(), label)
+    with trace.span(label, "nix") as args:
+        try:
+            yield from run_cmd_streaming(
+                [*cmd, *NIX_JSON_LOG],
+                dry_run=dry_run,
+                dry_label=dry_label,
+                parse=parser.feed,
+            )
+        finally:
+            snap = parser.progress.snapshot()
+            args.update(downloaded=snap.bytes_done, built=snap.builds_done)
+            parser.progress.finish()
+
+
+def update_flake(dry_run: bool, progress: NixProgress | None = None) -> Iterator[str]:
     """Update flake.lock to latest packages."""
-    yield from run_cmd_streaming(
+    yield from _nix_streaming(
         ["nix", "flake", "update", "--flake", str(SCRIPT_DIR)],
+        label="Update flake",
+        progress=progress,
         dry_run=dry_run,
         dry_label="nix flake update",
     )
 
 
+def _flake_lock_hash() -> str | None:
+    try:
+        return hashlib.sha256((SCRIPT_DIR / "flake.lock").read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def run_flake_update(dry_run: bool, progress: NixProgress | None, log_fn: LogFn) -> None:
+    """Update flake.lock and stamp the result for flake_updated()."""
+    _drain(update_flake(dry_run, progress), log_fn)
+    digest = None if dry_run else _flake_lock_hash()
+    if digest is not None:
+        FLAKE_STAMP.write_text(digest)
+
+
+def flake_updated() -> bool:
+    """True if flake.lock is still what the last flake update left."""
+    try:
+        return FLAKE_STAMP.read_text() == _flake_lock_hash()
+    except OSError:
+        return False
+
+
+def closure_link(host: str) -> Path:
+    """Out-link of *host*'s prebuilt closure; a GC root, and the prebuild's resume probe."""
+    return Path(f"/tmp/nixos-closure-{host}")
+
+
+def _skip_bundle(directory: str, names: list[str]) -> list[str]:
+    """copytree ignore: the offline bundle can be gigabytes and is not part of the flake."""
+    return ["bundle"] if Path(directory) == SCRIPT_DIR and "bundle" in names else []
+
+
+def copy_flake(dest: Path) -> None:
+    """Copy the installer's flake checkout to *dest*, without the bundle."""
+    shutil.copytree(SCRIPT_DIR, dest, symlinks=True, ignore=_skip_bundle)
+
+
+def prepare_flake(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Give a fleet target its own copy of the flake.
+
+    The hardware step writes the target's hardware-configuration.nix into
+    the flake and git-adds it, so targets sharing one checkout would
+    overwrite each other's config and race on the git index.
+    """
+    dest = target_paths(cfg).flake
+    if dry_run:
+        if log_fn:
+            log_fn(f"dry-run: copy flake to {dest}")
+        return
+    if log_fn:
+        log_fn(f"Copying flake to {dest}...")
+    shutil.rmtree(dest, ignore_errors=True)
+    copy_flake(dest)
+
+
+def disko_source(cfg: InstallConfig) -> Path:
+    """The disko layout in DISKO_DIR that *cfg* installs."""
+    if cfg.dual_disk and cfg.disk2:
+        return DISKO_DIR / ("dual_luks.nix" if cfg.encrypted else "dual.nix")
+    return DISKO_DIR / ("luks.nix" if cfg.encrypted else "default.nix")
+
+
+def partition_labels(cfg: InstallConfig) -> dict[str, str]:
+    """GPT label disko gives each partition of *cfg*'s layout."""
+    disk, parts = DISKO_LAYOUTS[disko_source(cfg).name]
+    if cfg.slot is not None:
+        disk = f"{disk}-{cfg.slot}"
+    return {part: f"disk-{disk}-{part}" for part in parts}
+
+
+def _block_devices(device: str) -> list[dict]:
+    """*device* and its partitions as lsblk sees them (path, partlabel, fstype)."""
+    result = run_cmd(["lsblk", "--json", "-o", "PATH,PARTLABEL,FSTYPE", device], capture=True, check=False)
+    if result.returncode != 0:
+        return []
+    found: list[dict] = []
+    pending = json.loads(result.stdout or "{}").get("blockdevices", [])
+    while pending:
+        dev = pending.pop(0)
+        found.append(dev)
+        pending.extend(dev.get("children", []))
+    return found
+
+
+def refresh_problem(cfg: InstallConfig, dry_run: bool) -> str | None:
+    """Why *cfg*'s disks cannot be refreshed in place, or None if they can.
+
+    They can if they hold the partitions and filesystems of the layout
+    *cfg* would install; the subvolumes are checked once mounted.
+    """
+    assert cfg.disk
+    if dry_run:
+        return None
+    disk, parts = DISKO_LAYOUTS[disko_source(cfg).name]
+    by_label = {d["partlabel"]: d for d in _block_devices(cfg.disk.device) if d.get("partlabel")}
+    for part, label in partition_labels(cfg).items():
+        dev = by_label.get(label)
+        if dev is None:
+            return f"{cfg.disk.device} has no {label} partition"
+        if dev.get("fstype") != parts[part]:
+            return f"{dev['path']} holds {dev.get('fstype') or 'no filesystem'}, not {parts[part]}"
+    if cfg.dual_disk and cfg.disk2:
+        want = "crypto_LUKS" if cfg.encrypted else "btrfs"
+        devs = _block_devices(cfg.disk2.device)
+        if not devs or devs[0].get("fstype") != want:
+            return f"{cfg.disk2.device} is not the {want} second disk of a previous install"
+    return None
+
+
 def prepare_disko_config(cfg: InstallConfig) -> Path:
     """Copy the appropriate disko config to /tmp and substitute the device(s)."""
     assert cfg.disk
-    tmp_dir = Path("/tmp/disko-install")
-    tmp_dir.mkdir(exist_ok=True)
+    paths = target_paths(cfg)
+    tmp_dir = paths.disko_dir
+    tmp_dir.mkdir(parents=True, exist_ok=True)
 
     # Copy common.nix alongside the config so the import works
     shutil.copy2(DISKO_DIR / "common.nix", tmp_dir / "common.nix")
 
-    if cfg.dual_disk and cfg.disk2:
-        if cfg.encrypted:
-            source = DISKO_DIR / "dual_luks.nix"
-            content = source.read_text()
-            content = content.replace(DISKO_PLACEHOLDER, cfg.disk.device)
-        else:
-            source = DISKO_DIR / "dual.nix"
-            content = source.read_text()
-            content = content.replace(DISKO_PLACEHOLDER_1, cfg.disk.device)
-            content = content.replace(DISKO_PLACEHOLDER_2, cfg.disk2.device)
+    content = disko_source(cfg).read_text()
+    if cfg.dual_disk and cfg.disk2 and not cfg.encrypted:
+        content = content.replace(DISKO_PLACEHOLDER_1, cfg.disk.device)
+        content = content.replace(DISKO_PLACEHOLDER_2, cfg.disk2.device)
     else:
-        source = DISKO_DIR / ("luks.nix" if cfg.encrypted else "default.nix")
-        content = source.read_text()
         content = content.replace(DISKO_PLACEHOLDER, cfg.disk.device)
 
-    dest = tmp_dir / "config.nix"
-    dest.write_text(content)
+    if cfg.slot is None:
+        dest = tmp_dir / "config.nix"
+        dest.write_text(content)
+        return dest
 
+    content = content.replace("/tmp/secret.key", str(paths.secret_key))
+    content = content.replace('name = "crypted";', f'name = "{cfg.mapper}";')
+    content = content.replace("/dev/mapper/crypted2", f"/dev/mapper/{cfg.mapper2}")
+    (tmp_dir / "target.nix").write_text(content)
+    dest = tmp_dir / "config.nix"
+    dest.write_text(FLEET_DISKO_WRAPPER.replace("SLOT", str(cfg.slot)))
     return dest
 
 
@@ -81,13 +330,15 @@ def run_disko(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) ->
     """Partition and format the target disk."""
     assert cfg.disk
     disk = cfg.disk.device
+    paths = target_paths(cfg)
+    secret = str(paths.secret_key)
 
     # Write LUKS key if encrypted
     if cfg.encrypted and cfg.luks_password:
-        secret = Path("/tmp/secret.key")
-        secret.write_text(cfg.luks_password)
-        secret.chmod(0o600)
-        cleanup.register("remove secret key", ["rm", "-f", "/tmp/secret.key"])
+        paths.secret_key.parent.mkdir(parents=True, exist_ok=True)
+        paths.secret_key.write_text(cfg.luks_password)
+        paths.secret_key.chmod(0o600)
+        cleanup.register(CleanupAction.remove(secret, "remove secret key"), scope=cfg.root)
 
     # For dual-disk LUKS: set up LUKS on the second disk before disko runs
     if cfg.dual_disk and cfg.encrypted and cfg.disk2:
@@ -96,88 +347,322 @@ def run_disko(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) ->
             log_fn(f"Setting up LUKS on second disk {disk2}...")
         run_cmd(["wipefs", "-a", disk2], dry_run=dry_run, dry_label=f"wipefs {disk2}", log_fn=log_fn)
         run_cmd(
-            ["cryptsetup", "luksFormat", "--batch-mode", "--key-file", "/tmp/secret.key", disk2],
+            ["cryptsetup", "luksFormat", "--batch-mode", "--key-file", secret, disk2],
             dry_run=dry_run, dry_label=f"cryptsetup luksFormat {disk2}", log_fn=log_fn,
         )
         run_cmd(
-            ["cryptsetup", "open", "--type", "luks", "--key-file", "/tmp/secret.key", disk2, "crypted2"],
-            dry_run=dry_run, dry_label=f"cryptsetup open {disk2} crypted2", log_fn=log_fn,
+            ["cryptsetup", "open", "--type", "luks", "--key-file", secret, disk2, cfg.mapper2],
+            dry_run=dry_run, dry_label=f"cryptsetup open {disk2} {cfg.mapper2}", log_fn=log_fn,
         )
-        cleanup.register("close crypted2", ["cryptsetup", "close", "crypted2"])
+        cleanup.register(CleanupAction.close_mapper(cfg.mapper2), scope=cfg.root)
 
     disko_path = prepare_disko_config(cfg)
-    cleanup.register("remove disko config", ["rm", "-rf", "/tmp/disko-install"])
+    cleanup.register(CleanupAction.remove(str(paths.disko_dir), "remove disko config"), scope=cfg.root)
 
     yield from run_cmd_streaming(
-        ["nix", "run", "github:nix-community/disko", "--", "--mode", "disko", str(disko_path)],
+        [
+            "nix", "run", "github:nix-community/disko", "--",
+            "--mode", "disko",
+            "--root-mountpoint", cfg.root,
+            str(disko_path),
+        ],
         dry_run=dry_run,
         dry_label=f"disko {disk}",
     )
 
     if not dry_run:
-        result = run_cmd(["findmnt", "--target", "/mnt"], capture=True, check=False)
+        result = run_cmd(["findmnt", "--target", cfg.root], capture=True, check=False)
         if result.stdout and log_fn:
             log_fn(result.stdout.strip())
 
-    # Temp swap for large installs (skip on btrfs RAID — swapfiles not supported)
-    if not dry_run and not cfg.dual_disk:
-        run_cmd(["dd", "if=/dev/zero", "of=/mnt/swapfile", "bs=1M", "count=8192", "status=progress"], log_fn=log_fn)
-        run_cmd(["chmod", "600", "/mnt/swapfile"], log_fn=log_fn)
-        run_cmd(["mkswap", "/mnt/swapfile"], log_fn=log_fn)
-        run_cmd(["swapon", "/mnt/swapfile"], log_fn=log_fn)
-        cleanup.register("swapoff", ["swapoff", "/mnt/swapfile"])
-        cleanup.register("remove swapfile", ["rm", "-f", "/mnt/swapfile"])
-    elif log_fn:
-        if cfg.dual_disk:
-            log_fn("Skipping temp swapfile (not supported on btrfs RAID)")
-        else:
-            log_fn("dry-run: create 8G swap")
+    provision_swap(cfg, dry_run, log_fn)
+    # Any new swap can back a larger live store
+    expand_store(dry_run, log_fn)
+
+
+def reset_root_subvolume(cfg: InstallConfig, device: str, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Swap the @ subvolume on *device* for an empty one, keeping the old one aside.
 
-    # Expand tmpfs
+    @nix, @home and the other subvolumes are left alone. The old root is
+    renamed to @pre-refresh-<time> for rollback, and the machine's
+    identity (machine-id, SSH host keys) is carried over to the new one.
+    """
+    top = target_paths(cfg).btrfs_top
     run_cmd(
-        ["mount", "-o", "remount,size=16G", "/nix/.rw-store"],
+        ["mount", "--mkdir", "-o", "subvolid=5", device, str(top)],
+        dry_run=dry_run, dry_label=f"mount top level of {device}", log_fn=log_fn,
+    )
+    try:
+        if not dry_run:
+            missing = [sv for sv in ("@", "@nix", "@home") if not (top / sv).is_dir()]
+            if missing:
+                raise StepError(f"{device} has no {', '.join(missing)} subvolume; it cannot be refreshed")
+        old = f"@pre-refresh-{datetime.now():%Y%m%d-%H%M%S}"
+        run_cmd(
+            ["mv", "--no-target-directory", str(top / "@"), str(top / old)],
+            dry_run=dry_run, log_fn=log_fn,
+        )
+        run_cmd(["btrfs", "subvolume", "create", str(top / "@")], dry_run=dry_run, log_fn=log_fn)
+        for pattern in MACHINE_STATE:
+            for path in [] if dry_run else (top / old).glob(pattern):
+                dest = top / "@" / path.relative_to(top / old)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(path, dest)
+        if log_fn:
+            log_fn(f"Reset the root subvolume; the old one is kept as {old}.")
+    finally:
+        run_cmd(["umount", str(top)], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+
+
+def refresh_target(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> Iterator[str]:
+    """Open and mount an existing install without formatting it.
+
+    The counterpart of run_disko for a refresh: only the root subvolume is
+    reset, so the target's /nix keeps the store paths a reinstall needs.
+    """
+    assert cfg.disk
+    problem = refresh_problem(cfg, dry_run)
+    if problem:
+        raise StepError(f"Cannot refresh: {problem}")
+    labels = partition_labels(cfg)
+    device = f"/dev/disk/by-partlabel/{labels.get('root', '')}"
+    if cfg.encrypted:
+        secret = str(target_paths(cfg).secret_key if dry_run else _write_key(cfg))
+        opens = [(f"/dev/disk/by-partlabel/{labels['luks']}", cfg.mapper)]
+        if cfg.dual_disk and cfg.disk2:
+            opens.append((cfg.disk2.device, cfg.mapper2))
+        for source, mapper in opens:
+            if not dry_run and Path(f"/dev/mapper/{mapper}").exists():
+                continue
+            run_cmd(
+                ["cryptsetup", "open", "--type", "luks", "--key-file", secret, source, mapper],
+                dry_run=dry_run, dry_label=f"cryptsetup open {source} {mapper}", log_fn=log_fn,
+            )
+            cleanup.register(CleanupAction.close_mapper(mapper), scope=cfg.root)
+        device = f"/dev/mapper/{cfg.mapper}"
+    if cfg.dual_disk:
+        # Let the kernel find both devices of the RAID0 filesystem
+        run_cmd(["btrfs", "device", "scan"], check=False, dry_run=dry_run, log_fn=log_fn)
+
+    reset_root_subvolume(cfg, device, dry_run, log_fn)
+
+    disko_path = prepare_disko_config(cfg)
+    cleanup.register(
+        CleanupAction.remove(str(target_paths(cfg).disko_dir), "remove disko config"), scope=cfg.root
+    )
+    yield from run_cmd_streaming(
+        [
+            "nix", "run", "github:nix-community/disko", "--",
+            "--mode", "mount",
+            "--root-mountpoint", cfg.root,
+            str(disko_path),
+        ],
         dry_run=dry_run,
-        dry_label="expand /nix/.rw-store to 16G",
-        log_fn=log_fn,
+        dry_label=f"disko --mode mount {cfg.disk.device}",
     )
+    provision_swap(cfg, dry_run, log_fn)
+    expand_store(dry_run, log_fn)
+
+
+def target_store_options(cfg: InstallConfig) -> list[str]:
+    """nix options letting a refresh substitute paths from the target's own store."""
+    if not cfg.refresh:
+        return []
+    return ["--option", "extra-substituters", f"local?root={cfg.root}&priority={TARGET_STORE_PRIORITY}"]
 
 
-def generate_hardware_config(host: str, dry_run: bool, log_fn: LogFn | None = None) -> None:
+def expand_store(dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Grow the live ISO's tmpfs-backed store to what RAM and swap can back."""
+    resize_store(rw_store_size(), dry_run, log_fn)
+
+
+def hardware_config_path(cfg: InstallConfig) -> Path:
+    assert cfg.host
+    return target_paths(cfg).flake / "hosts" / cfg.host.name / "hardware-configuration.nix"
+
+
+def generate_hardware_config(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
     """Generate hardware-configuration.nix for the target host."""
-    host_dir = SCRIPT_DIR / "hosts" / host
-    host_dir.mkdir(parents=True, exist_ok=True)
+    paths = target_paths(cfg)
+    hw_dst = hardware_config_path(cfg)
 
     if dry_run:
         if log_fn:
             log_fn("dry-run: nixos-generate-config")
     else:
-        tmp = Path("/tmp/nixos-config")
-        run_cmd(["nixos-generate-config", "--root", "/mnt", "--dir", str(tmp)], log_fn=log_fn)
+        hw_dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = paths.hardware_tmp
+        run_cmd(["nixos-generate-config", "--root", cfg.root, "--dir", str(tmp)], log_fn=log_fn)
         hw_src = tmp / "hardware-configuration.nix"
-        hw_dst = host_dir / "hardware-configuration.nix"
         hw_dst.write_text(hw_src.read_text())
         run_cmd(["rm", "-rf", str(tmp)], check=False, log_fn=log_fn)
         # Force-add to git so the flake evaluation can find it (it's in .gitignore)
-        run_cmd(["git", "-C", str(SCRIPT_DIR), "add", "--force", str(hw_dst)], log_fn=log_fn)
+        run_cmd(["git", "-C", str(paths.flake), "add", "--force", str(hw_dst)], log_fn=log_fn)
         if log_fn:
             log_fn(f"Generated {hw_dst}")
 
 
-def install_nixos(host: str, dry_run: bool) -> Iterator[str]:
-    """Run nixos-install for the target host."""
+def _governed(build: Callable[[], Iterator[str]], governor: MemoryGovernor | None) -> Iterator[str]:
+    """Run *build*, restarting it when the governor has reduced nix parallelism."""
+    while True:
+        lines = build()
+        try:
+            for line in lines:
+                yield line
+                if governor is not None and governor.throttle.is_set():
+                    break
+            else:
+                return
+        finally:
+            lines.close()
+        governor.throttle.clear()
+
+
+def missing_hardware_configs() -> list[Path]:
+    """Hardware configs that hosts import but the checkout does not contain."""
+    missing: list[Path] = []
+    for conf in sorted((SCRIPT_DIR / "hosts").glob("*/configuration.nix")):
+        hw = conf.with_name("hardware-configuration.nix")
+        if not hw.exists() and f"./{hw.name}" in conf.read_text():
+            missing.append(hw)
+    return missing
+
+
+_eval_lock = threading.Lock()
+_eval_stamp: tuple[str | None, tuple[Path, ...]] | None = None
+
+
+def eval_flake() -> Path:
+    """Flake to evaluate host closures from before a target has its hardware config.
+
+    SCRIPT_DIR itself when every host's hardware-configuration.nix is
+    present. Otherwise a copy in EVAL_FLAKE with HARDWARE_STUB in place of
+    each missing one (git-added, so a git flake sees it), made again
+    whenever flake.lock changes.
+    """
+    global _eval_stamp
+    missing = missing_hardware_configs()
+    if not missing:
+        return SCRIPT_DIR
+    stamp = (_flake_lock_hash(), tuple(missing))
+    with _eval_lock:
+        if stamp != _eval_stamp or not EVAL_FLAKE.is_dir():
+            hosts = ", ".join(hw.parent.name for hw in missing)
+            log(f"Evaluating from {EVAL_FLAKE} with a placeholder hardware config for {hosts}")
+            shutil.rmtree(EVAL_FLAKE, ignore_errors=True)
+            copy_flake(EVAL_FLAKE)
+            stubs = [EVAL_FLAKE / hw.relative_to(SCRIPT_DIR) for hw in missing]
+            for stub in stubs:
+                stub.write_text(HARDWARE_STUB)
+            if (EVAL_FLAKE / ".git").is_dir():
+                run_cmd(["git", "-C", str(EVAL_FLAKE), "add", "--force", *map(str, stubs)])
+            _eval_stamp = stamp
+    return EVAL_FLAKE
+
+
+def toplevel_attr(host: str, flake: Path = SCRIPT_DIR) -> str:
+    """Flake reference to the system closure of *host*."""
+    return f"{flake}#nixosConfigurations.{host}.config.system.build.toplevel"
+
+
+def prebuild_closure(
+    host: str,
+    dry_run: bool,
+    progress: NixProgress | None = None,
+    governor: MemoryGovernor | None = None,
+    options: list[str] | None = None,
+) -> Iterator[str]:
+    """Realise the host's system closure in the live store.
+
+    Runs before the target's hardware config is generated, so it evaluates
+    the committed one, or a placeholder for hosts without one (see
+    eval_flake). The toplevel itself therefore differs from the one
+    install_nixos builds later; everything underneath it (the bulk of the
+    download and build work) is shared and lands in the store.
+    *options* are extra nix options, e.g. target_store_options().
+    """
+    attr = toplevel_attr(host, SCRIPT_DIR if dry_run else eval_flake())
+    yield from _governed(
+        lambda: _nix_streaming(
+            [
+                "nix", "build", "--out-link", str(closure_link(host)), "--accept-flake-config",
+                *(options or []), attr,
+            ],
+            label="Prebuild closure",
+            progress=progress,
+            dry_run=dry_run,
+            dry_label=f"nix build .#{host} toplevel",
+        ),
+        governor,
+    )
+
+
+def install_nixos(
+    cfg: InstallConfig,
+    dry_run: bool,
+    progress: NixProgress | None = None,
+    governor: MemoryGovernor | None = None,
+) -> Iterator[str]:
+    """Build the host's system closure into the target store, then install it.
+
+    The build runs as a plain ``nix build --store <root>`` so its JSON log
+    can drive *progress* (nixos-install does not pass --log-format
+    through) while the closure still goes straight to disk, as it did with
+    ``nixos-install --flake``. Paths the prebuild already put in the live
+    store are substituted from it. nixos-install then finds the closure in
+    place and only sets the profile and the bootloader.
+    """
+    assert cfg.host
+    host = cfg.host.name
+    paths = target_paths(cfg)
+    yield from _governed(
+        lambda: _nix_streaming(
+            [
+                "nix", "build",
+                "--accept-flake-config",
+                "--store", cfg.root,
+                # The live store, as nixos-install itself does for --store builds
+                "--option", "extra-substituters", "auto?trusted=1",
+                "--out-link", str(paths.system_link),
+                "--option", "keep-outputs", "false",
+                toplevel_attr(host, paths.flake),
+            ],
+            label="Install NixOS",
+            progress=progress,
+            dry_run=dry_run,
+            dry_label=f"nix build --store {cfg.root} .#{host} toplevel",
+        ),
+        governor,
+    )
+    # The link names a path in the target store, which the live system lacks
+    system = paths.system_link if dry_run else Path(os.readlink(paths.system_link))
     yield from run_cmd_streaming(
         [
             "nixos-install",
-            "--flake", f"{SCRIPT_DIR}#{host}",
+            "--root", cfg.root,
+            "--system", str(system),
             "--no-root-passwd",
-            "--accept-flake-config",
             "--option", "keep-outputs", "false",
         ],
         dry_run=dry_run,
-        dry_label=f"nixos-install --flake .#{host}",
+        dry_label=f"nixos-install --system .#{host}",
     )
 
 
+def password_set(cfg: InstallConfig) -> bool:
+    """True if the target's /etc/shadow holds a password hash for cfg.user."""
+    try:
+        lines = Path(f"{cfg.root}/etc/shadow").read_text().splitlines()
+    except OSError:
+        return False
+    for line in lines:
+        name, _, rest = line.partition(":")
+        if name == cfg.user:
+            hashed = rest.split(":", 1)[0]
+            return bool(hashed) and not hashed.startswith(("!", "*"))
+    return False
+
+
 def set_user_password(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
     """Set the user password on the installed system."""
     password = cfg.user_password or cfg.luks_password
@@ -192,7 +677,7 @@ def set_user_password(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None =
             log_fn("dry-run: set user password")
     else:
         proc = subprocess.run(
-            ["nixos-enter", "--root", "/mnt", "--", "chpasswd"],
+            ["nixos-enter", "--root", cfg.root, "--", "chpasswd"],
             input=f"{cfg.user}:{password}",
             text=True,
             capture_output=True,
@@ -205,14 +690,26 @@ def set_user_password(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None =
 
 def setup_user_environment(cfg: InstallConfig, dry_run: bool, has_net: bool, log_fn: LogFn | None = None) -> None:
     """Copy nix repo and create first-login script."""
-    target = Path(f"/mnt/home/{cfg.user}/nix")
-    has_git = (SCRIPT_DIR / ".git").is_dir()
+    home = Path(f"{cfg.root}/home/{cfg.user}")
+    target = home / "nix"
+    source = target_paths(cfg).flake
+    has_git = (source / ".git").is_dir()
+    # A refresh keeps /home, and with it the user's checkout and local changes
+    keep = cfg.refresh and target.is_dir()
 
-    if has_git:
+    if keep:
+        if log_fn:
+            log_fn(f"Keeping /home/{cfg.user}/nix; updating its hardware config.")
+        hw = hardware_config_path(cfg)
+        dest = target / hw.relative_to(source)
+        if not dry_run and hw.exists() and dest.parent.is_dir():
+            shutil.copyfile(hw, dest)
+            run_cmd(["chown", "1000:100", str(dest)], log_fn=log_fn)
+    elif has_git:
         if log_fn:
             log_fn(f"Copying nix repo (with .git) to /home/{cfg.user}/nix...")
         if not dry_run:
-            run_cmd(["cp", "-a", str(SCRIPT_DIR), str(target)], log_fn=log_fn)
+            shutil.copytree(source, target, symlinks=True, ignore=_skip_bundle)
             run_cmd(
                 ["git", "-C", str(target), "remote", "set-url", "origin", REPO_SSH],
                 check=False,
@@ -227,14 +724,15 @@ def setup_user_environment(cfg: InstallConfig, dry_run: bool, has_net: bool, log
         if log_fn:
             log_fn("No .git and no network -- copying snapshot.")
         if not dry_run:
-            run_cmd(["cp", "-a", str(SCRIPT_DIR), str(target)], log_fn=log_fn)
+            shutil.copytree(source, target, symlinks=True, ignore=_skip_bundle)
 
-    if dry_run:
-        method = "copy with .git" if has_git else ("git clone" if has_net else "copy snapshot")
-        if log_fn:
-            log_fn(f"dry-run: {method} to /mnt/home/{cfg.user}/nix")
-    else:
-        run_cmd(["chown", "-R", "1000:100", str(target)], log_fn=log_fn)
+    if not keep:
+        if dry_run:
+            method = "copy with .git" if has_git else ("git clone" if has_net else "copy snapshot")
+            if log_fn:
+                log_fn(f"dry-run: {method} to {target}")
+        else:
+            run_cmd(["chown", "-R", "1000:100", str(target)], log_fn=log_fn)
 
     # First-login script
     if log_fn:
@@ -253,17 +751,18 @@ def setup_user_environment(cfg: InstallConfig, dry_run: bool, has_net: bool, log
     """)
 
     if not dry_run:
-        fl_path = Path(f"/mnt/home/{cfg.user}/.first-login.sh")
+        fl_path = home / ".first-login.sh"
         fl_path.write_text(first_login)
         fl_path.chmod(0o755)
 
         profile_line = '[ -f ~/.first-login.sh ] && ~/.first-login.sh\n'
         for name in (".bash_profile", ".zprofile"):
-            p = Path(f"/mnt/home/{cfg.user}/{name}")
+            p = home / name
             existing = p.read_text() if p.exists() else ""
-            p.write_text(existing + profile_line)
+            if profile_line not in existing:
+                p.write_text(existing + profile_line)
 
-        for f in (fl_path, Path(f"/mnt/home/{cfg.user}/.bash_profile"), Path(f"/mnt/home/{cfg.user}/.zprofile")):
+        for f in (fl_path, home / ".bash_profile", home / ".zprofile"):
             run_cmd(["chown", "1000:100", str(f)], log_fn=log_fn)
         if log_fn:
             log_fn("First-login script created.")
@@ -273,13 +772,540 @@ def setup_user_environment(cfg: InstallConfig, dry_run: bool, has_net: bool, log
 
 def finish(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
     """Clean up temp files, swap, and mounts."""
-    Path("/tmp/secret.key").unlink(missing_ok=True)
-    shutil.rmtree("/tmp/disko-install", ignore_errors=True)
+    paths = target_paths(cfg)
+    paths.secret_key.unlink(missing_ok=True)
+    shutil.rmtree(paths.disko_dir, ignore_errors=True)
+    paths.system_link.unlink(missing_ok=True)
 
-    run_cmd(["swapoff", "/mnt/swapfile"], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
-    run_cmd(["rm", "-f", "/mnt/swapfile"], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
-    run_cmd(["umount", "-R", "/mnt"], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+    release_swap(cfg, dry_run, log_fn)
+    run_cmd(["umount", "-R", cfg.root], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+    if cfg.slot is not None:
+        # Fleet disks get unplugged afterwards: close their LUKS mappings
+        # and drop the flake copy, which lives in the RAM-backed /tmp
+        for mapper in (cfg.mapper, cfg.mapper2):
+            run_cmd(["cryptsetup", "close", mapper], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+        if not dry_run:
+            shutil.rmtree(FLEET_DIR / str(cfg.slot), ignore_errors=True)
 
-    cleanup.clear()
+    cleanup.clear(cfg.root)
     if log_fn:
         log_fn("Cleanup complete.")
+
+
+def target_mounted(cfg: InstallConfig) -> bool:
+    """True if the partitioned target is still open and mounted under its root."""
+    if cfg.encrypted and not Path(f"/dev/mapper/{cfg.mapper}").exists():
+        return False
+    return os.path.ismount(cfg.root) and os.path.ismount(f"{cfg.root}/boot")
+
+
+def trim_target(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Drop the install swap and discard free space, so a loop-backed image stays sparse."""
+    release_swap(cfg, dry_run, log_fn)
+    for mountpoint in (f"{cfg.root}/boot", cfg.root):
+        run_cmd(["fstrim", "--verbose", mountpoint], check=False, dry_run=dry_run, log_fn=log_fn)
+
+
+def _image_partitions(cfg: InstallConfig, dry_run: bool) -> tuple[str, str]:
+    """(ESP, root) partition nodes of an image written to cfg.disk."""
+    assert cfg.disk
+    parts = partitions(cfg.disk.device, dry_run)
+    esp = next((p["node"] for p in parts if p.get("type", "").lower() == ESP_TYPE), None)
+    if esp is None or len(parts) < 2:
+        raise StepError(f"{cfg.disk.device} does not hold a written image")
+    return esp, parts[-1]["node"]
+
+
+def _write_key(cfg: InstallConfig) -> Path:
+    paths = target_paths(cfg)
+    if cfg.luks_password is None:
+        raise StepError("No LUKS password for the encrypted image.")
+    paths.secret_key.parent.mkdir(parents=True, exist_ok=True)
+    paths.secret_key.write_text(cfg.luks_password)
+    paths.secret_key.chmod(0o600)
+    cleanup.register(CleanupAction.remove(str(paths.secret_key), "remove secret key"), scope=cfg.root)
+    return paths.secret_key
+
+
+def write_image_target(cfg: InstallConfig, info: ImageInfo, dry_run: bool, log_fn: LogFn) -> None:
+    """Clear the old signatures on cfg.disk and write the image to it."""
+    assert cfg.disk
+    disk = cfg.disk.device
+    run_cmd(["wipefs", "--all", disk], dry_run=dry_run, dry_label=f"wipefs {disk}", log_fn=log_fn)
+    # Lets thin-provisioned and flash disks drop the old data; not all disks can
+    run_cmd(["blkdiscard", "--force", disk], check=False, dry_run=dry_run, dry_label=f"blkdiscard {disk}", log_fn=log_fn)
+    _drain(write_image(info, disk, dry_run), log_fn)
+
+
+def rekey_image_target(
+    cfg: InstallConfig, info: ImageInfo, reencrypt: bool, dry_run: bool, log_fn: LogFn | None = None
+) -> None:
+    """Give an encrypted image target its own passphrase (and volume key)."""
+    _esp, root = _image_partitions(cfg, dry_run)
+    key = target_paths(cfg).secret_key if dry_run else _write_key(cfg)
+    rekey_luks(root, info.key_path, key, reencrypt, dry_run, log_fn)
+
+
+def _mount_image_target(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    esp, root = _image_partitions(cfg, dry_run)
+    source = root
+    if cfg.encrypted:
+        secret = str(target_paths(cfg).secret_key)
+        run_cmd(
+            ["cryptsetup", "open", "--type", "luks", "--key-file", secret, root, cfg.mapper],
+            dry_run=dry_run, dry_label=f"cryptsetup open {root} {cfg.mapper}", log_fn=log_fn,
+        )
+        cleanup.register(CleanupAction.close_mapper(cfg.mapper), scope=cfg.root)
+        # The partition grew after the image was written
+        run_cmd(["cryptsetup", "resize", "--key-file", secret, cfg.mapper], dry_run=dry_run, log_fn=log_fn)
+        source = f"/dev/mapper/{cfg.mapper}"
+    for subvol, mountpoint in IMAGE_SUBVOLUMES:
+        target = f"{cfg.root}{mountpoint}"
+        run_cmd(
+            ["mount", "--mkdir", "-o", f"subvol={subvol},compress=zstd,noatime", source, target],
+            dry_run=dry_run, log_fn=log_fn,
+        )
+    run_cmd(["mount", "--mkdir", esp, f"{cfg.root}/boot"], dry_run=dry_run, log_fn=log_fn)
+    cleanup.register(CleanupAction.unmount(cfg.root), scope=cfg.root)
+    run_cmd(["btrfs", "filesystem", "resize", "max", cfg.root], dry_run=dry_run, log_fn=log_fn)
+
+
+def _reset_machine_state(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    root = Path(cfg.root)
+    for pattern in MACHINE_STATE:
+        if dry_run:
+            if log_fn:
+                log_fn(f"dry-run: rm -f {root / pattern}")
+            continue
+        for path in root.glob(pattern):
+            path.unlink(missing_ok=True)
+    if log_fn and not dry_run:
+        log_fn("Cleared machine-id, random seed and SSH host keys.")
+
+
+def standard_mapper_names(cfg: InstallConfig, hardware_config: str) -> str:
+    """Rename *cfg*'s slot mappers in a generated hardware config to the standard ones.
+
+    The target is opened as crypted-N while it is mounted next to others,
+    but the initrd opens it as "crypted" (the name the image was built
+    with): both the LUKS device key and the /dev/mapper paths the
+    filesystems mount from must use that name to boot, and to compare equal
+    to the image's config on identical hardware.
+    """
+    if cfg.slot is None:
+        return hardware_config
+    for mapper, standard in ((cfg.mapper, "crypted"), (cfg.mapper2, "crypted2")):
+        hardware_config = hardware_config.replace(f'"{mapper}"', f'"{standard}"')
+        hardware_config = hardware_config.replace(f'/dev/mapper/{mapper}"', f'/dev/mapper/{standard}"')
+    return hardware_config
+
+
+def personalize_image_target(
+    cfg: InstallConfig,
+    info: ImageInfo,
+    dry_run: bool,
+    progress: NixProgress | None = None,
+    governor: MemoryGovernor | None = None,
+    log_fn: LogFn | None = None,
+) -> None:
+    """Patch a written image into this machine's install.
+
+    Regenerates hardware-configuration.nix and, only if it differs from the
+    one the image was built with, rebuilds the system from it; then sets the
+    user password and clears the identity every machine must have its own of.
+    """
+    assert cfg.host
+    with _IMAGE_MOUNT_LOCK:
+        _mount_image_target(cfg, dry_run, log_fn)
+        generate_hardware_config(cfg, dry_run, log_fn=log_fn)
+        hw = hardware_config_path(cfg)
+        if not dry_run:
+            hw.write_text(standard_mapper_names(cfg, hw.read_text()))
+        changed = dry_run or hw.read_text() != info.hardware_config
+        if changed:
+            if log_fn:
+                log_fn("Hardware differs from the image's; rebuilding the system for it...")
+            _drain(install_nixos(cfg, dry_run, progress, governor), log_fn or log)
+            clone = Path(f"{cfg.root}/home/{cfg.user}/nix/hosts/{cfg.host.name}/hardware-configuration.nix")
+            if not dry_run and clone.parent.is_dir():
+                shutil.copyfile(hw, clone)
+                run_cmd(["chown", "1000:100", str(clone)], log_fn=log_fn)
+        elif log_fn:
+            log_fn("Hardware matches the image; keeping its system.")
+        set_user_password(cfg, dry_run, log_fn=log_fn)
+        _reset_machine_state(cfg, dry_run, log_fn)
+        finish(cfg, dry_run, log_fn=log_fn)
+        # Forget the device, or the next copy's identical UUID clashes with it
+        run_cmd(["btrfs", "device", "scan", "--forget"], check=False, dry_run=dry_run, log_fn=log_fn)
+
+
+def store_expanded() -> bool:
+    """True if /nix/.rw-store has already been grown to (about) rw_store_size()."""
+    try:
+        st = os.statvfs(RW_STORE)
+    except OSError:
+        return False
+    return st.f_blocks * st.f_frsize >= rw_store_size() - GIB
+
+
+def _drain(lines: Iterator[str], log_fn: LogFn) -> None:
+    for line in lines:
+        log_fn(line)
+
+
+@contextmanager
+def install_trace(cfgs: list[InstallConfig], dry_run: bool) -> Iterator[None]:
+    """Record a telemetry trace of the install steps run inside the block.
+
+    The trace files are written and the slowest steps logged on the way
+    out, whether the install succeeded or not.
+    """
+    disks = [d.device for cfg in cfgs for d in (cfg.disk, cfg.disk2) if d is not None]
+    trace.begin(
+        ", ".join(cfg.name for cfg in cfgs),
+        disks=[] if dry_run else disks,
+        store=RW_STORE,
+        meta={
+            "dry_run": dry_run,
+            "disks": disks,
+            "cpus": os.cpu_count(),
+            "mem_total": meminfo().get("MemTotal"),
+            "closure_bytes": [cfg.closure_bytes for cfg in cfgs] if len(cfgs) > 1 else cfgs[0].closure_bytes,
+            "nix_settings": nix_settings.describe(TUNED),
+        },
+    )
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        try:
+            trace.finish(success)
+        except OSError as e:
+            log(f"Could not write install trace: {e}")
+        for line in trace.summary_lines():
+            log(line)
+
+
+def _target_steps(
+    cfg: InstallConfig,
+    dry_run: bool,
+    has_net: bool,
+    governor: MemoryGovernor,
+    progress: NixProgress | None,
+    *,
+    ns: str = "",
+    closure: str = "closure",
+) -> list[Step]:
+    """Steps installing one target, needing the shared "store", "flake.lock" and *closure*.
+
+    Keys and target-local resources are prefixed with *ns*, so several
+    targets can share one pipeline. Fleet targets get their own copy of
+    the flake first.
+    """
+    assert cfg.host and cfg.disk
+    fleet = cfg.slot is not None
+    paths = target_paths(cfg)
+
+    def install(log_fn: LogFn) -> None:
+        with governor.watch(log_fn):
+            _drain(install_nixos(cfg, dry_run, progress, governor), log_fn)
+
+    steps = [
+        Step(
+            f"{ns}cleanup", "Cleanup previous",
+            lambda log_fn: cleanup_previous(cfg, dry_run, log_fn=log_fn),
+            provides=(f"{ns}clean",),
+            # Re-running it would unmount a target we can still use
+            verify=lambda: target_mounted(cfg),
+        ),
+        Step(
+            f"{ns}disko", "Mount existing" if cfg.refresh else "Partition disk",
+            lambda log_fn: _drain((refresh_target if cfg.refresh else run_disko)(cfg, dry_run, log_fn=log_fn), log_fn),
+            needs=(f"{ns}clean",),
+            provides=(f"{ns}target",),
+            verify=lambda: target_mounted(cfg),
+        ),
+        Step(
+            f"{ns}hardware", "Hardware config",
+            lambda log_fn: generate_hardware_config(cfg, dry_run, log_fn=log_fn),
+            needs=(f"{ns}target", f"{ns}flake") if fleet else (f"{ns}target",),
+            provides=(f"{ns}hardware-config",),
+            verify=lambda: hardware_config_path(cfg).exists(),
+        ),
+        Step(
+            f"{ns}install", "Install NixOS",
+            install,
+            needs=(f"{ns}hardware-config", closure, "flake.lock", "store"),
+            provides=(f"{ns}system",),
+            verify=lambda: Path(f"{cfg.root}/nix/var/nix/profiles/system").exists(),
+        ),
+        Step(
+            f"{ns}password", "Set password",
+            lambda log_fn: set_user_password(cfg, dry_run, log_fn=log_fn),
+            needs=(f"{ns}system",),
+            provides=(f"{ns}password",),
+            verify=lambda: password_set(cfg),
+        ),
+        Step(
+            f"{ns}environment", "Setup environment",
+            lambda log_fn: setup_user_environment(cfg, dry_run, has_net, log_fn=log_fn),
+            needs=(f"{ns}system",),
+            provides=(f"{ns}home",),
+            verify=lambda: Path(f"{cfg.root}/home/{cfg.user}/.first-login.sh").exists(),
+        ),
+        Step(
+            f"{ns}finish", "Finalize",
+            lambda log_fn: finish(cfg, dry_run, log_fn=log_fn),
+            needs=(f"{ns}password", f"{ns}home"),
+        ),
+    ]
+    if fleet:
+        steps.insert(1, Step(
+            f"{ns}copy", "Copy flake",
+            lambda log_fn: prepare_flake(cfg, dry_run, log_fn=log_fn),
+            needs=("flake.lock",),
+            provides=(f"{ns}flake",),
+            verify=lambda: (paths.flake / "flake.nix").exists(),
+        ))
+    return steps
+
+
+def _shared_steps(dry_run: bool, update: bool, progress: NixProgress | None) -> list[Step]:
+    return [
+        Step(
+            "store", "Expand store",
+            lambda log_fn: expand_store(dry_run, log_fn=log_fn),
+            provides=("store",),
+            verify=store_expanded,
+        ),
+        Step(
+            "flake", "Update flake",
+            lambda log_fn: run_flake_update(dry_run, progress, log_fn),
+            provides=("flake.lock",),
+            enabled=update,
+            verify=flake_updated,
+        ),
+    ]
+
+
+def install_plan(
+    cfg: InstallConfig,
+    dry_run: bool,
+    has_net: bool,
+    prefetch: ClosurePrefetch | None = None,
+    progress: NixProgress | None = None,
+) -> list[Step]:
+    """Build the install step graph for *cfg*.
+
+    The closure prebuild only depends on the flake and the live store, so it
+    runs while the disk is being partitioned. If the wizard already started
+    a prefetch for this host (and the lockfile is not being updated), the
+    step just waits for that one instead of starting over. A refresh
+    prebuilds once the target is mounted, substituting from its store.
+
+    Each ``verify`` probes whether a journaled step's effect survived, so a
+    resumed install keeps the open LUKS volume, the mounted target and the
+    realised store paths rather than wiping and rebuilding them.
+    """
+    assert cfg.host and cfg.disk
+    host = cfg.host.name
+    governor = MemoryGovernor(cfg, dry_run)
+
+    def prebuild(log_fn: LogFn) -> None:
+        with governor.watch(log_fn):
+            if prefetch is not None and prefetch.host == host and not cfg.update_flake and not cfg.refresh:
+                log_fn("Waiting for closure prefetch started by the wizard...")
+                prefetch.wait(log_fn)
+            else:
+                _drain(prebuild_closure(host, dry_run, progress, governor, target_store_options(cfg)), log_fn)
+
+    cleanup_step, *target = _target_steps(cfg, dry_run, has_net, governor, progress)
+    return [
+        # Listed first, as the sidebar shows steps in plan order
+        cleanup_step,
+        *_shared_steps(dry_run, cfg.update_flake, progress),
+        Step(
+            "prebuild", "Prebuild closure",
+            prebuild,
+            # A refresh substitutes from the target's store, so it has to be mounted
+            needs=("flake.lock", "store", "target") if cfg.refresh else ("flake.lock", "store"),
+            provides=("closure",),
+            optional=True,
+            verify=lambda: closure_link(host).exists(),
+        ),
+        *target,
+    ]
+
+
+def fleet_plan(
+    cfgs: list[InstallConfig],
+    dry_run: bool,
+    has_net: bool,
+    update: bool = False,
+    progress: dict[str, NixProgress] | None = None,
+) -> list[Step]:
+    """One step graph installing every fleet target concurrently.
+
+    Store expansion, the flake update and one closure prebuild per distinct
+    host are shared, so common paths are fetched into the live store once;
+    each target's own steps are keyed ``t<slot>.<step>`` and only copy the
+    finished closure to their disk. *progress* maps ``shared`` and each
+    target's ``t<slot>`` to the NixProgress its nix commands should feed.
+    """
+    progress = progress or {}
+    # One governor: memory pressure is machine-wide, and extra swap lands on the first target
+    governor = MemoryGovernor(cfgs[0], dry_run)
+    shared = progress.get("shared")
+    steps = _shared_steps(dry_run, update, shared)
+    hosts = sorted({cfg.host.name for cfg in cfgs if cfg.host})
+
+    def prebuild(host: str) -> Callable[[LogFn], None]:
+        def run(log_fn: LogFn) -> None:
+            with governor.watch(log_fn):
+                _drain(prebuild_closure(host, dry_run, shared, governor), log_fn)
+
+        return run
+
+    for host in hosts:
+        steps.append(Step(
+            f"prebuild.{host}", f"Prebuild {host}",
+            prebuild(host),
+            needs=("flake.lock", "store"),
+            provides=(f"closure.{host}",),
+            optional=True,
+            verify=lambda host=host: closure_link(host).exists(),
+        ))
+    for cfg in cfgs:
+        assert cfg.host and cfg.slot is not None
+        ns = f"t{cfg.slot}"
+        steps.extend(_target_steps(
+            cfg, dry_run, has_net, governor, progress.get(ns),
+            ns=f"{ns}.", closure=f"closure.{cfg.host.name}",
+        ))
+    return steps
+
+
+def image_build_plan(
+    cfg: InstallConfig,
+    image: Path,
+    compress: bool,
+    dry_run: bool,
+    has_net: bool,
+    progress: NixProgress | None = None,
+) -> list[Step]:
+    """Install *cfg* onto the loop-attached image file, then seal the image.
+
+    The usual install steps, followed by a trim so freed blocks become
+    holes in the image file, and the seal that records its data extents.
+    """
+    assert cfg.host and cfg.disk
+    host = cfg.host.name
+    governor = MemoryGovernor(cfg, dry_run)
+
+    def prebuild(log_fn: LogFn) -> None:
+        with governor.watch(log_fn):
+            _drain(prebuild_closure(host, dry_run, progress, governor), log_fn)
+
+    def seal(log_fn: LogFn) -> None:
+        hw = hardware_config_path(cfg)
+        seal_image(cfg, image, compress, "" if dry_run else hw.read_text(), dry_run, log_fn)
+
+    cleanup_step, *target, finish_step = _target_steps(cfg, dry_run, has_net, governor, progress)
+    return [
+        cleanup_step,
+        *_shared_steps(dry_run, cfg.update_flake, progress),
+        Step(
+            "prebuild", "Prebuild closure",
+            prebuild,
+            needs=("flake.lock", "store"),
+            provides=("closure",),
+            optional=True,
+        ),
+        *target,
+        Step(
+            "trim", "Trim image",
+            lambda log_fn: trim_target(cfg, dry_run, log_fn),
+            needs=("password", "home"),
+            provides=("trimmed",),
+        ),
+        replace(finish_step, needs=("trimmed",), provides=("unmounted",)),
+        Step("seal", "Seal image", seal, needs=("unmounted",)),
+    ]
+
+
+def _image_target_steps(
+    cfg: InstallConfig,
+    info: ImageInfo,
+    reencrypt: bool,
+    dry_run: bool,
+    governor: MemoryGovernor,
+    progress: NixProgress | None,
+) -> list[Step]:
+    assert cfg.disk
+    ns = f"t{cfg.slot}."
+    disk = cfg.disk.device
+
+    def grow(log_fn: LogFn) -> None:
+        grow_last_partition(disk, dry_run, log_fn)
+
+    return [
+        Step(
+            f"{ns}cleanup", "Cleanup previous",
+            lambda log_fn: cleanup_previous(cfg, dry_run, log_fn=log_fn),
+            provides=(f"{ns}clean",),
+        ),
+        Step(
+            f"{ns}write", "Write image",
+            lambda log_fn: write_image_target(cfg, info, dry_run, log_fn),
+            needs=(f"{ns}clean",),
+            provides=(f"{ns}written",),
+        ),
+        Step(
+            # Before growing, so re-encryption only covers the image's extent
+            f"{ns}rekey", "Replace LUKS key",
+            lambda log_fn: rekey_image_target(cfg, info, reencrypt, dry_run, log_fn),
+            needs=(f"{ns}written",),
+            provides=(f"{ns}keyed",),
+            enabled=cfg.encrypted,
+        ),
+        Step(
+            f"{ns}grow", "Grow partition",
+            grow,
+            needs=(f"{ns}written", f"{ns}keyed"),
+            provides=(f"{ns}grown",),
+        ),
+        Step(
+            f"{ns}copy", "Copy flake",
+            lambda log_fn: prepare_flake(cfg, dry_run, log_fn=log_fn),
+            needs=("flake.lock",),
+            provides=(f"{ns}flake",),
+        ),
+        Step(
+            f"{ns}personalize", "Personalize",
+            lambda log_fn: personalize_image_target(cfg, info, dry_run, progress, governor, log_fn),
+            needs=(f"{ns}grown", f"{ns}flake", "store"),
+        ),
+    ]
+
+
+def image_write_plan(
+    info: ImageInfo,
+    cfgs: list[InstallConfig],
+    dry_run: bool,
+    reencrypt: bool = True,
+    progress: dict[str, NixProgress] | None = None,
+) -> list[Step]:
+    """Write *info* to every target concurrently, then personalize each.
+
+    Targets are keyed ``t<slot>.<step>`` as in fleet_plan. Writes and
+    re-encryption run in parallel; personalization mounts one target at a
+    time.
+    """
+    progress = progress or {}
+    governor = MemoryGovernor(cfgs[0], dry_run)
+    steps = _shared_steps(dry_run, False, progress.get("shared"))
+    for cfg in cfgs:
+        assert cfg.disk and cfg.slot is not None
+        steps.extend(_image_target_steps(cfg, info, reencrypt, dry_run, governor, progress.get(f"t{cfg.slot}")))
+    return steps
@@ -0,0 +1,158 @@
+"""Probing and ranking of extra binary caches (substituters)."""
+
+from __future__ import annotations
+
+import json
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlparse
+
+from .nixsettings import nix_settings
+
+DEFAULT_SUBSTITUTER = "https://cache.nixos.org"
+PROBE_TIMEOUT = 3.0
+SAMPLE_SIZE = 20
+# Extra caches are ranked ahead of cache.nixos.org (priority 40)
+FIRST_PRIORITY = 10
+
+
+@dataclass
+class SubstituterProbe:
+    url: str
+    reachable: bool = False
+    latency: float | None = None
+    hits: int = 0
+    sampled: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.sampled if self.sampled else 0.0
+
+
+def sample_store_paths(root: str = "/run/current-system", n: int = SAMPLE_SIZE) -> list[str]:
+    """Evenly spaced store paths from the live system's closure.
+
+    The live ISO shares most of its low-level closure (glibc, systemd, ...)
+    with any host, so hits here are a fair proxy for hits on the install.
+    """
+    try:
+        result = subprocess.run(
+            ["nix-store", "--query", "--requisites", root],
+            capture_output=True,
+            text=True,
+            timeout=PROBE_TIMEOUT * 5,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    paths = result.stdout.split()
+    if len(paths) <= n:
+        return paths
+    step = len(paths) / n
+    return [paths[int(i * step)] for i in range(n)]
+
+
+def _hash_part(path: str) -> str:
+    return Path(path).name.split("-", 1)[0]
+
+
+def _probe_file(probe: SubstituterProbe, root: Path, paths: list[str]) -> None:
+    start = time.monotonic()
+    probe.reachable = (root / "nix-cache-info").is_file()
+    probe.latency = time.monotonic() - start
+    if probe.reachable:
+        probe.sampled = len(paths)
+        probe.hits = sum((root / f"{_hash_part(p)}.narinfo").is_file() for p in paths)
+
+
+def _http_ok(url: str, method: str, timeout: float) -> bool:
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method=method), timeout=timeout) as resp:
+            return resp.status == 200
+    except (urllib.error.URLError, OSError, ValueError):
+        return False
+
+
+def _probe_http(probe: SubstituterProbe, paths: list[str], timeout: float) -> None:
+    # Options such as ?priority=40 are for nix, not part of the cache's URL
+    base = urlparse(probe.url)._replace(query="").geturl().rstrip("/")
+    start = time.monotonic()
+    probe.reachable = _http_ok(f"{base}/nix-cache-info", "GET", timeout)
+    probe.latency = time.monotonic() - start
+    if probe.reachable and paths:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            found = pool.map(lambda p: _http_ok(f"{base}/{_hash_part(p)}.narinfo", "HEAD", timeout), paths)
+            probe.hits = sum(found)
+        probe.sampled = len(paths)
+
+
+def _probe_ssh(probe: SubstituterProbe, paths: list[str], timeout: float) -> None:
+    start = time.monotonic()
+    try:
+        ping = subprocess.run(
+            ["nix", "store", "ping", "--store", probe.url],
+            capture_output=True, env=nix_settings.env(), timeout=timeout * 3,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return
+    probe.latency = time.monotonic() - start
+    probe.reachable = ping.returncode == 0
+    if not probe.reachable or not paths:
+        return
+    try:
+        info = subprocess.run(
+            ["nix", "path-info", "--json", "--store", probe.url, *paths],
+            capture_output=True, text=True, env=nix_settings.env(), timeout=timeout * 5,
+        )
+        data = json.loads(info.stdout or "{}")
+    except (OSError, subprocess.TimeoutExpired, json.JSONDecodeError):
+        return
+    # Newer nix: {path: info-or-null}; older nix: list of valid path infos
+    valid = [v for v in data.values() if v] if isinstance(data, dict) else data
+    probe.sampled = len(paths)
+    probe.hits = len(valid)
+
+
+def probe_substituter(url: str, paths: list[str], timeout: float = PROBE_TIMEOUT) -> SubstituterProbe:
+    """Measure reachability, latency and narinfo hit rate of one substituter."""
+    probe = SubstituterProbe(url)
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        _probe_file(probe, Path(parsed.path), paths)
+    elif parsed.scheme in ("http", "https"):
+        _probe_http(probe, paths, timeout)
+    elif parsed.scheme in ("ssh", "ssh-ng"):
+        _probe_ssh(probe, paths, timeout)
+    return probe
+
+
+def probe_substituters(urls: list[str], paths: list[str] | None = None) -> list[SubstituterProbe]:
+    """Probe all *urls* concurrently."""
+    if paths is None:
+        paths = sample_store_paths()
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as pool:
+        return list(pool.map(lambda u: probe_substituter(u, paths), urls))
+
+
+def _with_priority(url: str, priority: int) -> str:
+    if "priority=" in url:
+        return url
+    return f"{url}{'&' if '?' in url else '?'}priority={priority}"
+
+
+def rank_substituters(probes: list[SubstituterProbe], include_default: bool = True) -> list[str]:
+    """Reachable caches, best first, followed by cache.nixos.org.
+
+    Nix orders substituters by their advertised priority, not by list
+    position, so each chosen cache gets an explicit ``priority`` ahead of
+    the default cache. Without network (*include_default* False) the
+    default cache is left out so nix does not stall trying to reach it.
+    """
+    usable = [p for p in probes if p.reachable and p.url != DEFAULT_SUBSTITUTER]
+    usable.sort(key=lambda p: (-p.hit_rate, p.latency or 0.0))
+    ranked = [_with_priority(p.url, FIRST_PRIORITY + i) for i, p in enumerate(usable)]
+    return [*ranked, DEFAULT_SUBSTITUTER] if include_default else ranked
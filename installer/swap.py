@@ -0,0 +1,163 @@
+"""Temporary swap for the install, sized from RAM and the closure."""
+
+from __future__ import annotations
+
+import math
+import os
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+from .models import InstallConfig
+from .runner import LogFn, cleanup, run_cmd
+from .teardown import CleanupAction
+
+GIB = 1024 ** 3
+SWAPFILE = "swapfile"
+# Closure size assumed when the wizard could not estimate it
+DEFAULT_CLOSURE = 8 * GIB
+# Memory nix and the builders need on top of the store contents
+BUILD_HEADROOM = 2 * GIB
+MAX_SWAP = 16 * GIB
+# zram swap is capped at this fraction of RAM (compressed pages still live in RAM)
+ZRAM_FRACTION = 0.5
+
+
+@dataclass
+class SwapPlan:
+    kind: str  # "btrfs", "file", "zram" or "none"
+    size: int
+    reason: str = ""
+
+
+def meminfo(path: Path = Path("/proc/meminfo")) -> dict[str, int]:
+    """/proc/meminfo values in bytes."""
+    info: dict[str, int] = {}
+    try:
+        for line in path.read_text().splitlines():
+            m = re.match(r"(\w+):\s+(\d+)(?:\s+kB)?", line)
+            if m:
+                info[m.group(1)] = int(m.group(2)) * 1024
+    except OSError:
+        pass
+    return info
+
+
+def _round_gib(n: int) -> int:
+    return math.ceil(n / GIB) * GIB
+
+
+def plan_swap(cfg: InstallConfig, mem: dict[str, int], fstype: str | None) -> SwapPlan:
+    """Decide how much swap the install needs and where to put it.
+
+    The live store is a tmpfs, so the whole closure ends up in RAM; swap
+    only needs to cover what does not fit next to the build headroom.
+    Multi-device btrfs cannot host a swapfile, so dual-disk installs get
+    a compressed zram device instead.
+    """
+    closure = cfg.closure_bytes if cfg.closure_bytes is not None else DEFAULT_CLOSURE
+    available = mem.get("MemAvailable", 0) + mem.get("SwapFree", 0)
+    need = closure + BUILD_HEADROOM - available
+    if need <= 0:
+        return SwapPlan("none", 0, "enough free memory")
+    size = min(_round_gib(need), MAX_SWAP)
+    if cfg.dual_disk:
+        limit = int(mem.get("MemTotal", 0) * ZRAM_FRACTION)
+        return SwapPlan("zram", min(size, _round_gib(limit)), "btrfs RAID0 cannot hold a swapfile")
+    if fstype == "btrfs":
+        return SwapPlan("btrfs", size)
+    return SwapPlan("file", size)
+
+
+def _fstype(path: str) -> str | None:
+    result = run_cmd(["findmnt", "-n", "-o", "FSTYPE", "--target", path], check=False)
+    return result.stdout.strip() or None
+
+
+# Swap devices and files enabled by this installer per target root, in creation order
+_active: dict[str, list[str]] = {}
+_lock = threading.Lock()
+
+
+def _enable(kind: str, size: int, root: str, dry_run: bool, log_fn: LogFn | None) -> str:
+    gib = size // GIB
+    active = _active.setdefault(root, [])
+    if kind == "zram":
+        run_cmd(["modprobe", "zram"], dry_run=dry_run, dry_label="modprobe zram", log_fn=log_fn)
+        result = run_cmd(
+            ["zramctl", "--find", "--size", f"{gib}G", "--algorithm", "zstd"],
+            dry_run=dry_run,
+            dry_label=f"zramctl --find --size {gib}G",
+            log_fn=log_fn,
+        )
+        device = result.stdout.strip() or f"/dev/zram{sum(map(len, _active.values()))}"
+        run_cmd(["mkswap", device], dry_run=dry_run, log_fn=log_fn)
+        # Prefer zram over any disk-backed swap the live system may have
+        run_cmd(["swapon", "--priority", "100", device], dry_run=dry_run, log_fn=log_fn)
+        cleanup.register(CleanupAction.swapoff(device), scope=root)
+        cleanup.register(CleanupAction.reset_zram(device), scope=root)
+        return device
+
+    base = f"{root}/{SWAPFILE}"
+    n = sum(1 for a in active if a.startswith(base))
+    swapfile = f"{base}{n or ''}"
+    if kind == "btrfs":
+        # Creates the file NOCOW and uncompressed, as btrfs swapfiles require
+        run_cmd(
+            ["btrfs", "filesystem", "mkswapfile", "--size", f"{gib}G", swapfile],
+            dry_run=dry_run,
+            dry_label=f"btrfs filesystem mkswapfile {gib}G {swapfile}",
+            log_fn=log_fn,
+        )
+    else:
+        run_cmd(["fallocate", "-l", f"{gib}G", swapfile], dry_run=dry_run, log_fn=log_fn)
+        run_cmd(["chmod", "600", swapfile], dry_run=dry_run, log_fn=log_fn)
+        run_cmd(["mkswap", swapfile], dry_run=dry_run, log_fn=log_fn)
+    run_cmd(["swapon", swapfile], dry_run=dry_run, log_fn=log_fn)
+    cleanup.register(CleanupAction.swapoff(swapfile), scope=root)
+    cleanup.register(CleanupAction.remove(swapfile), scope=root)
+    return swapfile
+
+
+def provision_swap(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Create and enable swap for the install according to plan_swap()."""
+    fstype = None if dry_run else _fstype(cfg.root)
+    plan = plan_swap(cfg, meminfo(), fstype)
+    if plan.kind == "none":
+        if log_fn:
+            log_fn(f"No temporary swap needed ({plan.reason})")
+        return
+    if log_fn:
+        note = f" ({plan.reason})" if plan.reason else ""
+        log_fn(f"Creating {plan.size // GIB}G {plan.kind} swap{note}")
+    with _lock:
+        _active.setdefault(cfg.root, []).append(_enable(plan.kind, plan.size, cfg.root, dry_run, log_fn))
+
+
+def grow_swap(cfg: InstallConfig, size: int, dry_run: bool, log_fn: LogFn | None = None) -> bool:
+    """Add another *size* bytes of swap; False if the target cannot take more."""
+    if not cfg.dual_disk and not dry_run and not os.path.ismount(cfg.root):
+        return False
+    kind = "zram" if cfg.dual_disk else ("btrfs" if dry_run or _fstype(cfg.root) == "btrfs" else "file")
+    if log_fn:
+        log_fn(f"Adding {size // GIB}G {kind} swap")
+    with _lock:
+        _active.setdefault(cfg.root, []).append(_enable(kind, size, cfg.root, dry_run, log_fn))
+    return True
+
+
+def release_swap(cfg: InstallConfig, dry_run: bool, log_fn: LogFn | None = None) -> None:
+    """Disable and remove the swap devices/files created for *cfg*'s target."""
+    with _lock:
+        active = list(reversed(_active.pop(cfg.root, [])))
+    # A previous run's swapfile may still be around even if we made none
+    swapfile = f"{cfg.root}/{SWAPFILE}"
+    if swapfile not in active:
+        active.append(swapfile)
+    for path in active:
+        run_cmd(["swapoff", path], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+        if path.startswith("/dev/zram"):
+            run_cmd(["zramctl", "--reset", path], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
+        else:
+            run_cmd(["rm", "-f", path], check=False, capture=True, dry_run=dry_run, log_fn=log_fn)
@@ -0,0 +1,246 @@
+"""Ordered, state-checked teardown of swap, mounts and block devices.
+
+Actions run in stages: swap is released before the filesystem holding it
+is unmounted, filesystems are unmounted before the LUKS mappers under
+them are closed, and mappers before the loop devices under those. The
+actions of one stage are independent (different targets, different
+mappers) and run in parallel.
+
+Every action first checks /proc/swaps, /proc/mounts, /dev/mapper or
+/sys/block, and does nothing when there is nothing to tear down. Running
+a teardown twice is therefore harmless.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+STAGE_SWAP = 0
+STAGE_FILES = 1
+STAGE_MOUNTS = 2
+STAGE_MAPPERS = 3
+STAGE_LOOPS = 4
+
+ACTION_TIMEOUT = 10.0
+# How long to wait for a killed command to go; one stuck in uninterruptible
+# sleep (a wedged umount) never does and is left behind
+KILL_WAIT = 1.0
+# A command plus its fallback, each killed when it overruns
+STAGE_TIMEOUT = 2 * (ACTION_TIMEOUT + KILL_WAIT) + 1.0
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+_OCTAL = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(text: str) -> str:
+    # /proc tables escape spaces and tabs in paths as octal (\040)
+    return _OCTAL.sub(lambda m: chr(int(m.group(1), 8)), text)
+
+
+def _column(path: str, index: int, skip: int = 0) -> list[str]:
+    with open(path) as f:
+        rows = f.read().splitlines()[skip:]
+    return [_unescape(row.split()[index]) for row in rows if len(row.split()) > index]
+
+
+def active_swaps() -> list[str]:
+    """Paths of the swap files and devices in use."""
+    return _column("/proc/swaps", 0, skip=1)
+
+
+def mountpoints() -> list[str]:
+    return _column("/proc/mounts", 1)
+
+
+def _swap_active(path: str) -> bool:
+    return os.path.realpath(path) in active_swaps()
+
+
+def _mounted(path: str) -> bool:
+    prefix = path.rstrip("/") + "/"
+    return any(m == path or m.startswith(prefix) for m in mountpoints())
+
+
+def _mapper_open(name: str) -> bool:
+    return os.path.exists(f"/dev/mapper/{name}")
+
+
+def _loop_attached(device: str) -> bool:
+    return os.path.exists(f"/sys/block/{os.path.basename(device)}/loop/backing_file")
+
+
+def _zram_in_use(device: str) -> bool:
+    try:
+        with open(f"/sys/block/{os.path.basename(device)}/disksize") as f:
+            return f.read().strip() != "0"
+    except FileNotFoundError:
+        return False
+
+
+@dataclass
+class CleanupAction:
+    """One teardown command, its stage, and the check that it is still needed.
+
+    *fallback* runs when the command fails or times out, e.g. a lazy
+    unmount for a filesystem that something still holds.
+    """
+
+    label: str
+    cmd: list[str]
+    stage: int
+    needed: Callable[[], bool]
+    fallback: list[str] | None = None
+
+    @classmethod
+    def swapoff(cls, path: str) -> CleanupAction:
+        return cls(f"swapoff {path}", ["swapoff", path], STAGE_SWAP, lambda: _swap_active(path))
+
+    @classmethod
+    def reset_zram(cls, device: str) -> CleanupAction:
+        return cls(f"reset {device}", ["zramctl", "--reset", device], STAGE_FILES, lambda: _zram_in_use(device))
+
+    @classmethod
+    def remove(cls, path: str, label: str | None = None) -> CleanupAction:
+        return cls(label or f"remove {path}", ["rm", "-rf", path], STAGE_FILES, lambda: os.path.lexists(path))
+
+    @classmethod
+    def unmount(cls, path: str) -> CleanupAction:
+        return cls(
+            f"unmount {path}", ["umount", "-R", path], STAGE_MOUNTS, lambda: _mounted(path),
+            fallback=["umount", "-R", "--lazy", path],
+        )
+
+    @classmethod
+    def close_mapper(cls, name: str) -> CleanupAction:
+        return cls(
+            f"close {name}", ["cryptsetup", "close", name], STAGE_MAPPERS, lambda: _mapper_open(name),
+            fallback=["cryptsetup", "close", "--deferred", name],
+        )
+
+    @classmethod
+    def detach_loop(cls, device: str) -> CleanupAction:
+        return cls(f"detach {device}", ["losetup", "--detach", device], STAGE_LOOPS, lambda: _loop_attached(device))
+
+    def run(self) -> tuple[str, str]:
+        """Run the action if still needed; returns (outcome, detail)."""
+        try:
+            if not self.needed():
+                return SKIPPED, ""
+        except OSError:
+            pass  # Can't tell: trying costs nothing
+        error = _try(self.cmd)
+        if error and self.fallback is not None:
+            if _try(self.fallback) is None:
+                return DONE, f"{error}; ran {' '.join(self.fallback)}"
+        if error:
+            return FAILED, error
+        return DONE, ""
+
+
+def _try(cmd: list[str]) -> str | None:
+    """Run *cmd*; None on success, else why it failed.
+
+    Never waits on the command longer than ACTION_TIMEOUT + KILL_WAIT.
+    subprocess.run would wait for a killed child without limit.
+    """
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+        return str(e)
+    try:
+        _, stderr = proc.communicate(timeout=ACTION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        try:
+            proc.communicate(timeout=KILL_WAIT)
+        except subprocess.TimeoutExpired:
+            pass
+        return f"timed out after {ACTION_TIMEOUT:.0f}s"
+    if proc.returncode != 0:
+        return stderr.strip().splitlines()[-1].rstrip(".") if stderr.strip() else f"rc={proc.returncode}"
+    return None
+
+
+def _run_batch(batch: list[CleanupAction]) -> list[tuple[str, str]]:
+    """Run one stage's actions in parallel, for at most STAGE_TIMEOUT.
+
+    Plain threads rather than an executor: run_all also runs from atexit,
+    where executors no longer accept work. An action still running at the
+    deadline is reported as failed and its thread left behind.
+    """
+    results: list[tuple[str, str]] = [(FAILED, "not run")] * len(batch)
+
+    def worker(i: int) -> None:
+        results[i] = batch[i].run()
+
+    threads = [threading.Thread(target=worker, args=(i,), name="cleanup", daemon=True) for i in range(len(batch))]
+    try:
+        for thread in threads:
+            thread.start()
+    except RuntimeError:
+        # Too late in shutdown for threads: finish the rest one by one
+        for i, thread in enumerate(threads):
+            if thread.ident is None:
+                worker(i)
+    deadline = time.monotonic() + STAGE_TIMEOUT
+    for thread in threads:
+        if thread.ident is not None:
+            thread.join(max(0.0, deadline - time.monotonic()))
+    return [
+        (FAILED, f"still running after {STAGE_TIMEOUT:.0f}s") if thread.is_alive() else result
+        for thread, result in zip(threads, results)
+    ]
+
+
+@dataclass
+class CleanupReport:
+    """What a teardown actually did."""
+
+    done: list[str] = field(default_factory=list)
+    skipped: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+
+    def lines(self) -> list[str]:
+        out: list[str] = []
+        if self.done:
+            out.append(f"Torn down: {', '.join(self.done)}")
+        if self.failed:
+            out.append(f"[red]Cleanup failed: {'; '.join(self.failed)}[/red]")
+        if self.skipped and not (self.done or self.failed):
+            out.append("Nothing to clean up.")
+        return out
+
+
+def teardown(actions: list[CleanupAction], dry_run: bool, log_fn: Callable[[str], None] | None = None) -> CleanupReport:
+    """Run *actions* stage by stage, each stage's actions in parallel."""
+    report = CleanupReport()
+    unique: dict[tuple[str, ...], CleanupAction] = {}
+    for action in actions:
+        unique.setdefault(tuple(action.cmd), action)
+    for stage in sorted({a.stage for a in unique.values()}):
+        batch = [a for a in unique.values() if a.stage == stage]
+        if dry_run:
+            for action in batch:
+                if log_fn:
+                    log_fn(f"dry-run cleanup: {action.label}")
+                report.done.append(action.label)
+            continue
+        results = _run_batch(batch)
+        for action, (outcome, detail) in zip(batch, results):
+            if outcome == DONE:
+                report.done.append(f"{action.label} ({detail})" if detail else action.label)
+            elif outcome == SKIPPED:
+                report.skipped.append(action.label)
+            else:
+                report.failed.append(f"{action.label}: {detail}")
+    return report
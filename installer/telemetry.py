@@ -0,0 +1,321 @@
+"""Install telemetry: timed spans, resource samples and trace files."""
+
+from __future__ import annotations
+
+import json
+import os
+import resource
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+# Written next to the install log (runner.LOG_FILE)
+TRACE_FILE = Path("/tmp/nixos-install.trace.json")
+CHROME_TRACE_FILE = Path("/tmp/nixos-install.chrome-trace.json")
+SAMPLE_INTERVAL = 1.0
+SECTOR_SIZE = 512
+SLOWEST_STEPS = 5
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+
+
+@dataclass
+class Span:
+    name: str
+    cat: str  # "step", "cmd" or "nix"
+    start: float  # seconds since the trace began
+    duration: float
+    thread: int
+    args: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+
+@dataclass
+class Sample:
+    t: float
+    mem_used: int
+    store_used: int
+    written: int  # bytes written to the target disks since the trace began
+
+
+@dataclass
+class Peaks:
+    mem_used: int = 0
+    store_used: int = 0
+    written: int = 0
+    write_rate: float = 0.0
+    child_rss: int = 0
+
+
+def format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    return f"{minutes}m{secs:02d}s" if minutes else f"{secs}s"
+
+
+def format_bytes(n: float) -> str:
+    return f"{n / GIB:.1f} GiB" if n >= GIB else f"{n / MIB:.0f} MiB"
+
+
+def _mem_used() -> int:
+    """MemTotal - MemAvailable, i.e. memory nothing can reclaim."""
+    # Imported here: swap imports runner, which imports this module
+    from .swap import meminfo
+
+    info = meminfo()
+    return info.get("MemTotal", 0) - info.get("MemAvailable", 0)
+
+
+def _store_used(path: Path | None) -> int:
+    if path is None:
+        return 0
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def _bytes_written(devices: set[str]) -> int:
+    """Bytes written to whole-disk *devices* (kernel names) since boot."""
+    sectors = 0
+    try:
+        with open("/proc/diskstats") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) > 9 and parts[2] in devices:
+                    sectors += int(parts[9])
+    except (OSError, ValueError):
+        return 0
+    return sectors * SECTOR_SIZE
+
+
+class InstallTrace:
+    """Structured timing trace of one install.
+
+    Spans are only kept between begin() and finish(), so the commands run by
+    preflight and the wizard stay out of it. Meanwhile a sampler thread
+    records memory use, live-store usage and bytes written to the target
+    disks every SAMPLE_INTERVAL.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._active = False
+        self._origin = time.monotonic()
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self.label = ""
+        self.started = ""
+        self.meta: dict[str, Any] = {}
+        self.duration = 0.0
+        self.success: bool | None = None
+        self.child_rss = 0
+        self.spans: list[Span] = []
+        self.samples: list[Sample] = []
+        self.threads: dict[int, str] = {}
+
+    def begin(
+        self,
+        label: str,
+        *,
+        disks: list[str] | None = None,
+        store: Path | None = None,
+        meta: dict[str, Any] | None = None,
+        interval: float = SAMPLE_INTERVAL,
+    ) -> None:
+        """Start a new trace, discarding the previous one."""
+        with self._lock:
+            self.label = label
+            self.started = datetime.now().isoformat(timespec="seconds")
+            self.meta = dict(meta or {})
+            self.duration = 0.0
+            self.success = None
+            self.spans = []
+            self.samples = []
+            self.threads = {}
+            self._origin = time.monotonic()
+            self._active = True
+        devices = {os.path.basename(os.path.realpath(d)) for d in disks or []}
+        self._stop.clear()
+        self._sampler = threading.Thread(
+            target=self._sample_loop, args=(devices, store, interval), name="telemetry", daemon=True
+        )
+        self._sampler.start()
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def _elapsed(self) -> float:
+        return time.monotonic() - self._origin
+
+    def _sample_loop(self, devices: set[str], store: Path | None, interval: float) -> None:
+        base = _bytes_written(devices)
+        while True:
+            sample = Sample(self._elapsed(), _mem_used(), _store_used(store), _bytes_written(devices) - base)
+            with self._lock:
+                self.samples.append(sample)
+            if self._stop.wait(interval):
+                return
+
+    @contextmanager
+    def span(self, name: str, cat: str, **args: Any) -> Iterator[dict[str, Any]]:
+        """Time the block; the yielded dict is stored as the span's args."""
+        start = time.monotonic()
+        try:
+            yield args
+        except Exception as e:
+            args["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            self._record(name, cat, start, args)
+
+    def _record(self, name: str, cat: str, start: float, args: dict[str, Any]) -> None:
+        end = time.monotonic()
+        tid = threading.get_native_id()
+        with self._lock:
+            if not self._active:
+                return
+            # Started before begin() (e.g. the wizard's prefetch): clip to the trace
+            offset = max(start, self._origin) - self._origin
+            self.spans.append(Span(name, cat, offset, end - self._origin - offset, tid, args))
+            self.threads.setdefault(tid, threading.current_thread().name)
+
+    def finish(self, success: bool, path: Path = TRACE_FILE, chrome_path: Path = CHROME_TRACE_FILE) -> None:
+        """Stop recording and write the JSON and Chrome trace files."""
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        with self._lock:
+            self._active = False
+            self.success = success
+            self.duration = self._elapsed()
+            self.child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        path.write_text(json.dumps(self.to_json(), indent=1))
+        chrome_path.write_text(json.dumps(self.to_chrome()))
+
+    def nested(self, outer: Span, cat: str) -> list[Span]:
+        """Spans of *cat* that ran inside *outer* on the same thread."""
+        return [
+            s for s in self.spans
+            if s.cat == cat and s.thread == outer.thread and outer.start <= s.start and s.end <= outer.end
+        ]
+
+    def slowest(self, n: int = SLOWEST_STEPS) -> list[Span]:
+        steps = [s for s in self.spans if s.cat == "step"]
+        return sorted(steps, key=lambda s: s.duration, reverse=True)[:n]
+
+    def peaks(self) -> Peaks:
+        peaks = Peaks(child_rss=self.child_rss)
+        prev: Sample | None = None
+        for s in self.samples:
+            peaks.mem_used = max(peaks.mem_used, s.mem_used)
+            peaks.store_used = max(peaks.store_used, s.store_used)
+            peaks.written = max(peaks.written, s.written)
+            if prev is not None and s.t > prev.t:
+                peaks.write_rate = max(peaks.write_rate, (s.written - prev.written) / (s.t - prev.t))
+            prev = s
+        return peaks
+
+    def _nix_totals(self, spans: list[Span]) -> tuple[int, int]:
+        nix = [s for s in spans if s.cat == "nix"]
+        return sum(s.args.get("downloaded", 0) for s in nix), sum(s.args.get("built", 0) for s in nix)
+
+    def to_json(self) -> dict[str, Any]:
+        downloaded, built = self._nix_totals(self.spans)
+        return {
+            "label": self.label,
+            "started": self.started,
+            "duration": self.duration,
+            "success": self.success,
+            "meta": self.meta,
+            "downloaded": downloaded,
+            "built": built,
+            "peaks": asdict(self.peaks()),
+            "threads": {str(tid): name for tid, name in self.threads.items()},
+            "spans": [asdict(s) for s in self.spans],
+            "samples": [asdict(s) for s in self.samples],
+        }
+
+    def to_chrome(self) -> dict[str, Any]:
+        """Trace Event Format, loadable in chrome://tracing and Perfetto."""
+        pid = os.getpid()
+        events: list[dict[str, Any]] = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self.threads.items()
+        ]
+        for s in self.spans:
+            events.append({
+                "name": s.name,
+                "cat": s.cat,
+                "ph": "X",
+                "ts": round(s.start * 1e6),
+                "dur": round(s.duration * 1e6),
+                "pid": pid,
+                "tid": s.thread,
+                "args": s.args,
+            })
+        prev: Sample | None = None
+        for s in self.samples:
+            ts = round(s.t * 1e6)
+            events.append({
+                "name": "memory MiB",
+                "ph": "C",
+                "ts": ts,
+                "pid": pid,
+                "args": {"used": s.mem_used // MIB, "live store": s.store_used // MIB},
+            })
+            if prev is not None and s.t > prev.t:
+                rate = (s.written - prev.written) / (s.t - prev.t)
+                events.append({
+                    "name": "disk write MiB/s",
+                    "ph": "C",
+                    "ts": ts,
+                    "pid": pid,
+                    "args": {"target": round(rate / MIB, 1)},
+                })
+            prev = s
+        other = {"label": self.label, "started": self.started, "success": self.success, **self.meta}
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": other}
+
+    def summary_lines(self, n: int = SLOWEST_STEPS) -> list[str]:
+        """Plain-text summary of the slowest steps and the resource peaks."""
+        slowest = self.slowest(n)
+        if not slowest:
+            return []
+        lines = [f"Install took {format_duration(self.duration)}; slowest steps:"]
+        width = max(len(s.name) for s in slowest)
+        for span in slowest:
+            downloaded, built = self._nix_totals(self.nested(span, "nix"))
+            details = []
+            if downloaded:
+                details.append(f"{format_bytes(downloaded)} downloaded")
+            if built:
+                details.append(f"{built} built")
+            if "error" in span.args:
+                details.append("failed")
+            suffix = f"  ({', '.join(details)})" if details else ""
+            lines.append(f"  {span.name:<{width}}  {format_duration(span.duration):>6}{suffix}")
+        peaks = self.peaks()
+        usage = [f"memory {format_bytes(peaks.mem_used)}"]
+        if peaks.store_used:
+            usage.append(f"live store {format_bytes(peaks.store_used)}")
+        if peaks.written:
+            usage.append(f"disk writes {format_bytes(peaks.written)} (max {peaks.write_rate / MIB:.0f} MiB/s)")
+        if peaks.child_rss:
+            usage.append(f"largest process {format_bytes(peaks.child_rss)}")
+        lines.append("Peak " + ", ".join(usage))
+        return lines
+
+
+trace = InstallTrace()